@@ -1,24 +1,46 @@
 import asyncio
+import csv
 import os
 import re
 import struct
+import sys
+import threading
 from bleak import BleakClient, BleakScanner
+from bleak.exc import BleakError
 #from Command import Command
 import time
-import json
 import pygame
 import numpy as np
 from libs.Keycodes import KEY_CODES
-
-DEBUG_UUID     = "45c1eda2-4473-42a3-8143-dc79c30a64bf"
-STATUS_UUID    = "6f04c0a3-f201-4091-a13d-5ecafc3dc54b"
-CMD_UUID       = "05c6cc87-7888-4588-b794-92bdf9a29330"
-COORDS_UUID    = "3794c841-1b53-4029-aebb-12319386fd28"
-TELEMETRY_UUID = "ccc03716-4f66-4cb8-b6fd-9b2278587add"
-KALMAN_UUID    = "933963ae-cc8e-4704-bd3c-dc53721ba956"
+from libs.DataRecorder import DataRecorder, RECORD_FOLDER
+from libs.PacketBuffer import PacketBuffer
+from libs.CommandQueue import CommandQueue
+from libs.Backoff import Backoff
+from libs.LiveState import LiveState
+from libs.SharedRing import SharedRing
+from libs.TelemetryLog import SCHEMAS
+from libs.FakeBoat import FakeBoat, FAKE_RATE
+from libs.Gatt import DEBUG_UUID, STATUS_UUID, CMD_UUID, COORDS_UUID, TELEMETRY_UUID, KALMAN_UUID
 
 LOOP_PERIOD = 0.01 # s
 
+# Longest connect and subscribe attempt (s)
+CONNECT_TIMEOUT: float = 10.
+
+# Link failures, retried after a backoff
+LINK_ERRORS = (BleakError, OSError, asyncio.TimeoutError)
+
+# Outages are appended to this file in the recording folder
+OUTAGE_FILE: str = "outages.csv"
+OUTAGE_FIELDS: tuple[str, ...] = ('lost', 'reconnected', 'attempts', 'reconnect_s', 'gap_s')
+
+# Longest wait for the device thread to disconnect after the window closes
+DISCONNECT_TIMEOUT: float = 5.
+
+# Wait for the boat to acknowledge drive commands, False writes them
+# without response for lower latency (a lost one is replaced by the next press)
+DRIVE_RESPONSE: bool = True
+
 pygame.init()
 FONT  = pygame.font.Font('freesansbold.ttf', 24)
 BLACK = (0, 0, 0)
@@ -27,20 +49,12 @@ GREEN = (0, 255, 0)
 RED   = (255, 0, 0)
 GRAY  = (180, 180, 180)
 
-g_debug = ""
-g_peripheral_connected = False
 g_GPS_AVAIL       : int = 1 << 0
 g_RC_AVAIL        : int = 1 << 1
 g_INIT            : int = 1 << 2
 g_RC_MODE         : int = 1 << 3
 g_MOVING_WAYPOINT : int = 1 << 4
 
-g_gps_avail       : bool = False
-g_rc_avail        : bool = False
-g_initialised     : bool = False
-g_rc_mode         : bool = True
-g_moving_waypoint : bool = False
-
 class KalmanState:
     def update(self, vals):
         self.x = vals[0]
@@ -63,129 +77,153 @@ class ArduinoState:
     def isReady(self) -> bool:
         return hasattr(self, 'motorLeft')
 
-g_kalmanState = KalmanState()
-g_arduinoState = ArduinoState()
-
-g_command : str | None = None
-
-class DataRecorder:
-    def __init__(self):
-        """Records telemetry using callback"""
-        self.telemetry: list[dict[str, float]] = []
-        self.kalman: list[dict[str, float]] = []
-    def appendTelem(self, named_data: dict[str, float]):
-        """Append telemetry with timestamp
-        -------
-        Parameters
-        named_data : dist[str, float]
-            Telemetry data as dict
-        """
-        self.telemetry.append(named_data)
+# Published by the device thread, read once per frame by the display
+g_state = LiveState(connected=False, gps_avail=False, rc_avail=False, initialised=False,
+                    rc_mode=True, moving_waypoint=False, kalman=KalmanState(), arduino=ArduinoState())
 
-    def appendKalman(self, named_state: dict[str, float]):
-        """Append kalman filter data with timestamp
-        -------
-        Parameters
-        named_state : dict[str, float]
-            Kalman values in dict form
-        """
-        self.kalman.append(named_state)
-
-    def save(self):
-        "Save received telemetry to file"
-        print('Saving file of length', len(self.telemetry))
-        if not os.path.exists('BoatData/telemetry'):
-            os.makedirs("BoatData/telemetry")
-        telemetry_file = "BoatData/telemetry/telem" + time.asctime().replace(':','.').replace(' ','_') + ".json"
-        kalman_file    = "BoatData/telemetry/kalman" + time.asctime().replace(':','.').replace(' ','_') + ".json"
-        with open(telemetry_file,'w') as f:
-            json.dump(self.telemetry, f)
-        with open(kalman_file,'w') as f:
-            json.dump(self.kalman, f)
-        self.telemetry = []
-        self.kalman = []
+g_commands = CommandQueue()
 
 class Peripheral:
-    def __init__(self, address: str):
+    def __init__(self, address: str, rings: dict[str, SharedRing] | None = None,
+                 makeClient=BleakClient, folder: str = RECORD_FOLDER, liveState: LiveState | None = None):
         """Used as connection object with arduino
         Parameters
         ----------
         address : str
             MAC address of arduino
+        rings : dict[str, SharedRing] | None
+            Shared memory rings to publish each stream to for other processes
+        makeClient : callable
+            Client class called with the address, eg. FakeBoat (default BleakClient)
+        folder : str
+            Recording folder (default DataRecorder.RECORD_FOLDER)
+        liveState : LiveState | None
+            State published for the display (default None, g_state)
         """
         self.address = address
-        self.dataRecorder = DataRecorder()
+        self.rings = rings if rings is not None else {}
+        self.makeClient = makeClient
+        self.dataRecorder = DataRecorder(folder)
+        # Callbacks only copy packets in, processPackets decodes them in batches
+        self.telemPackets = PacketBuffer('telem')
+        self.kalmanPackets = PacketBuffer('kalman')
+        self.client = None
+        self.folder = folder
+        self.lastPacket: float | None = None # Host time of the newest packet
+        self.lostAt: float | None = None # Link lost and not back yet
+        self.liveState = liveState if liveState is not None else g_state
 
     def debug_callback(self, _, val):
         "Callback used for debug messages from arduino"
-        global g_debug
-        g_debug += "\n" + val.decode('utf-8')
+        self.liveState.log(val.decode('utf-8'))
 
     def status_callback(self, _, val):
         "Callback used when status is changed"
         status: int = struct.unpack('<I', val)[0]
         print(f"Status received {status}")
-        global g_gps_avail
-        global g_rc_avail
-        global g_rc_mode
-        global g_initialised
-        global g_moving_waypoint
-        g_gps_avail = bool(status & g_GPS_AVAIL)
-        g_rc_avail = bool(status & g_RC_AVAIL)
-        g_rc_mode  = bool(status & g_RC_MODE)
-        g_initialised = bool(status & g_INIT)
-        g_moving_waypoint = bool(status & g_MOVING_WAYPOINT)
+        self.liveState.publish(gps_avail=bool(status & g_GPS_AVAIL),
+                        rc_avail=bool(status & g_RC_AVAIL),
+                        rc_mode=bool(status & g_RC_MODE),
+                        initialised=bool(status & g_INIT),
+                        moving_waypoint=bool(status & g_MOVING_WAYPOINT))
 
     def kalman_callback(self, _, val):
-        global g_kalmanState
-        state: list[float] = list(struct.unpack('<ffffff', val))
-        named_state = {
-            "timestamp": time.time(),
-            "x": state[0],
-            "y": state[1],
-            "dx" : state[2],
-            "dy" : state[3],
-            "heading" : state[4],
-            "d_heading" : state[5]
-        }
-        self.dataRecorder.appendKalman(named_state)
-        g_kalmanState.update(state)
+        self.kalmanPackets.append(time.time(), val)
 
     def telem_callback(self, _, val):
-        global g_arduinoState
-        telem: list[float] = list(struct.unpack('<ddddfffff', val))
-        named_telem = {
-            "timestamp": time.time(),
-            "gpsX" : telem[0],
-            "gpsY" : telem[1],
-            "lat" : telem[2],
-            "lng" : telem[3],
-            "powerLeft" : telem[4],
-            "powerRight" : telem[5],
-            "rz" : telem[6],
-            "wpHeading" : telem[7],
-            "wpDist" : telem[8],
-        }
-        self.dataRecorder.appendTelem(named_telem)
-        g_arduinoState.update(named_telem)
-
-    async def connect(self):
-        global g_status
-
+        self.telemPackets.append(time.time(), val)
+
+    def processPackets(self):
+        "Record and publish the packets received since the last call, a batch per stream"
+        changes = {}
+        telem = self.telemPackets.drain()
+        if len(telem):
+            self.dataRecorder.appendBatch('telem', telem)
+            if 'telem' in self.rings:
+                self.rings['telem'].extend(telem)
+            names = telem.dtype.names
+            changes['arduino'] = ArduinoState()
+            changes['arduino'].update(dict(zip(names, telem[-1].tolist())))
+        kalman = self.kalmanPackets.drain()
+        if len(kalman):
+            self.dataRecorder.appendBatch('kalman', kalman)
+            if 'kalman' in self.rings:
+                self.rings['kalman'].extend(kalman)
+            changes['kalman'] = KalmanState()
+            changes['kalman'].update(kalman[-1].tolist()[1:])
+        if changes:
+            self.lastPacket = max(records['timestamp'][-1] for records in (telem, kalman) if len(records))
+            self.liveState.publish(**changes)
+
+    async def subscribe(self):
         "Connect to bluetooth client and setup notify characteristics"
-        self.client = BleakClient(self.address)
         await self.client.connect()
         await self.client.start_notify(DEBUG_UUID, self.debug_callback)
         await self.client.start_notify(STATUS_UUID, self.status_callback)
         await self.client.start_notify(TELEMETRY_UUID, self.telem_callback)
         await self.client.start_notify(KALMAN_UUID, self.kalman_callback)
-        g_status = await self.client.read_gatt_char(STATUS_UUID)
+        # Status may have changed while disconnected
+        self.status_callback(None, await self.client.read_gatt_char(STATUS_UUID))
 
+    async def connect(self, timeout: float = CONNECT_TIMEOUT) -> bool:
+        """One connect attempt with a new client, the recorder, packet
+        buffers and host filter carry on from before any outage
+        -------
+        Parameters
+        timeout : float
+            Longest time for the attempt (default CONNECT_TIMEOUT)
+        -------
+        Return whether it connected : bool
+        """
+        if self.client is not None:
+            # The old link may be half up after a failed write
+            try:
+                await self.client.disconnect()
+            except LINK_ERRORS:
+                pass
+        self.client = self.makeClient(self.address)
+        try:
+            await asyncio.wait_for(self.subscribe(), timeout)
+        except LINK_ERRORS as e:
+            print(f"Connect failed: {e!r}")
+            try:
+                await self.client.disconnect()
+            except LINK_ERRORS:
+                pass
+            return False
         print('Notify is ready')
+        return True
 
     def isConnected(self) -> bool:
         "Return whether it is still connected to the arduino"
-        return self.client.is_connected
+        return self.client is not None and self.client.is_connected
+
+    def linkLost(self):
+        "Start timing an outage"
+        self.processPackets()
+        self.lostAt = time.time()
+        self.liveState.log("Link lost, reconnecting")
+
+    def linkRestored(self, attempts: int):
+        """Record the outage that just ended in OUTAGE_FILE
+        -------
+        Parameters
+        attempts : int
+            Connect attempts it took
+        """
+        now = time.time()
+        row = {'lost': self.lostAt, 'reconnected': now, 'attempts': attempts,
+               'reconnect_s': now - self.lostAt,
+               'gap_s': now - (self.lastPacket if self.lastPacket is not None else self.lostAt)}
+        self.lostAt = None
+        filename = os.path.join(self.folder, OUTAGE_FILE)
+        new = not os.path.exists(filename)
+        with open(filename, 'a', newline='') as f:
+            writer = csv.DictWriter(f, OUTAGE_FIELDS)
+            if new:
+                writer.writeheader()
+            writer.writerow(row)
+        self.liveState.log(f"Reconnected after {row['reconnect_s']:.1f} s, {attempts} attempts")
 
     async def disconnect(self):
         "Safely disconnect and stop all notify characteristics"
@@ -195,14 +233,16 @@ class Peripheral:
         await self.client.stop_notify(KALMAN_UUID);
         await self.client.disconnect()
 
-    async def writeCommand(self, data: str):
+    async def writeCommand(self, data: str, response: bool = True):
         """Write a command to the client
         -------
         Parameters
         data : str
             Command to write to arduino
+        response : bool
+            Wait for the write response (default True)
         """
-        await self.client.write_gatt_char(CMD_UUID, data.encode('utf-8'), True)
+        await self.client.write_gatt_char(CMD_UUID, data.encode('utf-8'), response)
 
     async def writeCoords(self, data: bytes):
         """Write coordinates to the client. Data must be 0 terminated
@@ -230,45 +270,96 @@ def getCoordsFromFile() -> bytes:
     # 0 terminated
     return ret + struct.pack('<d', 0)
 
-async def runDeviceLoop(address: str):
+async def runDeviceLoop(address: str, rings: dict[str, SharedRing] | None = None,
+                        makeClient=BleakClient, folder: str = RECORD_FOLDER,
+                        backoff: Backoff | None = None, liveState: LiveState | None = None,
+                        commands: CommandQueue | None = None):
     """Run arduino with commands
     ------
     Parameters
     address : str
         MAC address of arduino
+    rings : dict[str, SharedRing] | None
+        Shared memory rings kept across reconnects, see Peripheral
+    makeClient : callable
+        Client class, see Peripheral (default BleakClient)
+    folder : str
+        Recording folder (default DataRecorder.RECORD_FOLDER)
+    backoff : Backoff | None
+        Waits between connect attempts (default None, a new Backoff)
+    liveState : LiveState | None
+        State published for the display (default None, g_state)
+    commands : CommandQueue | None
+        Commands to run (default None, g_commands)
     """
-    global g_peripheral_connected
-    global g_command
-
+    # One peripheral for the session so nothing recorded is lost on reconnect
+    liveState = liveState if liveState is not None else g_state
+    commands = commands if commands is not None else g_commands
+    peripheral = Peripheral(address, rings, makeClient, folder, liveState)
+    backoff = backoff if backoff is not None else Backoff()
     running = True
     while running:
-        g_peripheral_connected = False
-        peripheral = Peripheral(address)
-        await peripheral.connect()
-        g_peripheral_connected = True
+        liveState.publish(connected=False)
+        if not await peripheral.connect():
+            # Waiting still takes commands, so exit works during an outage
+            command = await commands.get(backoff.next())
+            if command is not None:
+                try:
+                    if command.text in ('x', 'exit'):
+                        peripheral.dataRecorder.close()
+                        running = False
+                    else:
+                        liveState.log(f"Not connected, '{command.text}' not sent")
+                finally:
+                    commands.done(command)
+            continue
+        if peripheral.lostAt is not None:
+            peripheral.linkRestored(backoff.attempts + 1)
+        backoff.reset()
+        liveState.publish(connected=True)
 
         while peripheral.isConnected():
-            c: str | None = g_command
-            if c == None:
-                await asyncio.sleep(LOOP_PERIOD)
-            else:
-                g_command = None
-                if c == 's' or c == 'send':
-                    coords = getCoordsFromFile()
-                    print('Coords:', len(coords), coords)
-                    await peripheral.writeCoords(coords)
-                elif c == 'x' or c == 'exit':
-                    print('Disconnecting...')
-                    await peripheral.disconnect()
-                    running = False
-                    g_peripheral_connected = False
-                    break
-                elif c == 't' or c == 'telemetry':
-                    peripheral.dataRecorder.save()
-                    global g_debug
-                    g_debug += "\nTelemetry saved"
-                else:
-                    await peripheral.writeCommand(c)
+            peripheral.processPackets()
+            # Wakes on a key press, otherwise every loop period for packets
+            command = await commands.get(LOOP_PERIOD)
+            if command is not None:
+                c = command.text
+                # Every command taken is done, however the loop is left
+                try:
+                    if c == 's' or c == 'send':
+                        coords = getCoordsFromFile()
+                        print('Coords:', len(coords), coords)
+                        try:
+                            await peripheral.writeCoords(coords)
+                        except LINK_ERRORS as e:
+                            liveState.log(f"Coords not sent, {e!r}")
+                            break
+                    elif c == 'x' or c == 'exit':
+                        print('Disconnecting...')
+                        try:
+                            await peripheral.disconnect()
+                        except LINK_ERRORS:
+                            pass # Closing the recorder matters more
+                        peripheral.processPackets()
+                        peripheral.dataRecorder.close()
+                        running = False
+                        liveState.publish(connected=False)
+                        break
+                    elif c == 't' or c == 'telemetry':
+                        # Written in the background, never blocks the loop
+                        peripheral.dataRecorder.save()
+                        liveState.log("Saving telemetry")
+                    else:
+                        try:
+                            await peripheral.writeCommand(c, DRIVE_RESPONSE or not commands.isDrive(command))
+                        except LINK_ERRORS as e:
+                            liveState.log(f"'{c}' not sent, {e!r}")
+                            break
+                finally:
+                    commands.done(command)
+        if running:
+            peripheral.linkLost()
+    print(commands.report())
 
 class Radial:
     def __init__(self, x, y, width, height, title):
@@ -335,17 +426,31 @@ class Indicator:
         pygame.draw.rect(screen, color, self.indicator)
         screen.blit(self.text, self.text_rect)
 
-async def runDisplay():
-    global g_command
-    global g_debug
-
+def runDisplay(duration: float | None = None, liveState: LiveState | None = None,
+               commands: CommandQueue | None = None) -> int:
+    """Draw the newest state once per frame until the window is closed
+    -------
+    Parameters
+    duration : float | None
+        Stop after this many seconds, None runs until closed
+    liveState : LiveState | None
+        State to draw (default None, g_state)
+    commands : CommandQueue | None
+        Queue for key presses (default None, g_commands)
+    -------
+    Return frames drawn : int"""
+    liveState = liveState if liveState is not None else g_state
+    commands = commands if commands is not None else g_commands
     screen = pygame.display.set_mode((1280, 720))
     #clock = pygame.time.Clock()
     running = True
      
     # Debug text
     debug_text = TextField(40, 10, lines=3)
-    g_debug = "\nPress any key to start motor init"
+    liveState.log("Press any key to start motor init")
+    drawn = -1 # Version on screen
+    frames = 0
+    end = None if duration is None else time.monotonic() + duration
 
     # Indicators
     peripheral_indicator = Indicator(40, 100, "Arduino connected")
@@ -362,7 +467,7 @@ async def runDisplay():
     yText = TextField(250, 580, 1)
     motor  = Radial(40, 520, 200, 200, "Motors")
 
-    while running:
+    while running and (end is None or time.monotonic() < end):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
@@ -370,47 +475,87 @@ async def runDisplay():
 
             if event.type == pygame.KEYDOWN:
                 if (event.key in KEY_CODES.keys()):
-                    g_command = KEY_CODES[event.key]
+                    if not commands.put(KEY_CODES[event.key]):
+                        liveState.log("Command queue full, key ignored")
             if event.type == pygame.MOUSEBUTTONUP:
                 pass
+
+        # One snapshot per frame, only redrawn when it changed
+        state = liveState.snapshot()
+        if state.version == drawn:
+            time.sleep(LOOP_PERIOD)
+            continue
+        drawn = state.version
         screen.fill("white")
 
         # Draw indicators
-        peripheral_indicator.blit(screen, g_peripheral_connected)
-        gps_indicator.blit(screen, g_gps_avail)
-        rc_indicator.blit(screen, g_rc_avail)
-        rc_mode.blit(screen, g_rc_mode)
-        init_indicator.blit(screen, g_initialised)
-        moving_waypoint_indicator.blit(screen, g_moving_waypoint)
+        peripheral_indicator.blit(screen, state.connected)
+        gps_indicator.blit(screen, state.gps_avail)
+        rc_indicator.blit(screen, state.rc_avail)
+        rc_mode.blit(screen, state.rc_mode)
+        init_indicator.blit(screen, state.initialised)
+        moving_waypoint_indicator.blit(screen, state.moving_waypoint)
 
         # Radials
-        if g_kalmanState.isReady():
-            velocity.blit(screen, g_kalmanState.vx, g_kalmanState.vy)
+        kalman = state.kalman
+        arduino = state.arduino
+        if kalman.isReady():
+            velocity.blit(screen, kalman.vx, kalman.vy)
             heading.blit(screen, 
-                         0.5*np.sin(np.deg2rad(g_kalmanState.heading)),
-                         0.5*np.cos(np.deg2rad(g_kalmanState.heading)),
-                         0.5*np.sin(np.deg2rad(g_arduinoState.wpHeading)),
-                         0.5*np.cos(np.deg2rad(g_arduinoState.wpHeading)))
-            distText.blit(screen, "Dist: " + str(g_arduinoState.wpDist) + "m")
-            xText.blit(screen, "X: " + str(g_kalmanState.x) + "m")
-            yText.blit(screen, "Y: " + str(g_kalmanState.y) + "m")
-        if g_arduinoState.isReady():
-            l = g_arduinoState.motorLeft
-            r = g_arduinoState.motorRight
+                         0.5*np.sin(np.deg2rad(kalman.heading)),
+                         0.5*np.cos(np.deg2rad(kalman.heading)),
+                         0.5*np.sin(np.deg2rad(arduino.wpHeading)),
+                         0.5*np.cos(np.deg2rad(arduino.wpHeading)))
+            distText.blit(screen, "Dist: " + str(arduino.wpDist) + "m")
+            xText.blit(screen, "X: " + str(kalman.x) + "m")
+            yText.blit(screen, "Y: " + str(kalman.y) + "m")
+        if arduino.isReady():
+            l = arduino.motorLeft
+            r = arduino.motorRight
             motor.blit(screen, l - r, l + r)
 
         # Debug stream
-        debug_text.blit(screen, g_debug)
+        debug_text.blit(screen, state.debug)
 
         pygame.display.flip()
-        await asyncio.sleep(LOOP_PERIOD)
-    pygame.quit()
+        frames += 1
+        time.sleep(LOOP_PERIOD)
+    return frames
 
-async def main():
-    "Find device with name boat and run device"
-    devices = await BleakScanner.discover(1.)
+def runBoat(address: str, makeClient=BleakClient):
+    """Run the device on its own thread and event loop so drawing never
+    holds up notifications, and the display until it is closed
+    ------
+    Parameters
+    address : str
+        MAC address of arduino
+    makeClient : callable
+        Client class, see Peripheral (default BleakClient)
+    """
+    # Live packets for consumers in other processes, eg. live_filter.py
+    rings = {stream: SharedRing(stream) for stream in SCHEMAS}
+    device = threading.Thread(target=asyncio.run, args=(runDeviceLoop(address, rings, makeClient),),
+                              name="Device", daemon=True)
+    device.start()
+    runDisplay()
+    pygame.quit()
+    # Disconnect and close the recorder before exiting
+    g_commands.put('x')
+    device.join(DISCONNECT_TIMEOUT)
+    for ring in rings.values():
+        ring.close()
+
+def main():
+    "Find device with name boat and run it, --fake[=rate] runs a FakeBoat"
+    fake = [arg for arg in sys.argv[1:] if arg.startswith('--fake')]
+    if fake:
+        rate = float(fake[0].split('=')[1]) if '=' in fake[0] else FAKE_RATE
+        runBoat('fake', lambda address: FakeBoat(address, rate))
+        return
+    devices = asyncio.run(BleakScanner.discover(1.))
     for d in devices:
         if d.name == 'Boat':
-            await asyncio.gather(runDisplay(), runDeviceLoop(d.address))
+            runBoat(d.address)
 
-asyncio.run(main())
+if __name__ == "__main__":
+    main()
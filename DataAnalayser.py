@@ -1,33 +1,66 @@
 import matplotlib.pyplot as plt
-import json
+import os
 import sys
 import numpy as np
 
 from libs.Simulation import Simulation
-from libs.DataObject import DataObject
+from libs.JsonStream import readStore, iterChunks
+from libs.TelemetryArchive import Archive, ARCHIVE_EXT, iterArchive
+from libs.FilterMetrics import FilterMetrics
+from libs.LegacyImport import IMPORT_FOLDER
 
 def main():
     args = sys.argv
-    if len(args) != 2:
-        print('No filename given')
+    if len(args) not in (2, 4):
+        print('No filename given (python DataAnalayser.py telem.json [start end])')
         #exit()
-        args.append("Telemetry/Path_FriMay2612.48.312023")
+        args.append(os.path.join(IMPORT_FOLDER, "FriMay2612.48.312023.json"))
 
     filename = args[1]
-    with open(filename, 'r') as f:
-        data = json.load(f)
-    decoded_data = DataObject(data)
+    if not os.path.exists(filename):
+        print(f"{filename} not found, old sessions are converted by import_legacy.py")
+        exit()
+    if filename.endswith(ARCHIVE_EXT):
+        archive = Archive(filename)
+        decoded_data = archive.toStore()
+        archive.close()
+        chunks = lambda: iterArchive(filename)
+    else:
+        decoded_data = readStore(filename)
+        chunks = lambda: iterChunks(filename)
+    if len(args) == 4:
+        # Window in seconds from the start of the session
+        start = decoded_data.index.start
+        decoded_data = decoded_data.window(start + float(args[2]), start + float(args[3]))
+        print(f"Using {len(decoded_data)} records from {args[2]}s to {args[3]}s")
 
     sim = Simulation(decoded_data)
     sim.createScaleFromGPS(1000, 600)
     sim.run()
     sim.showStatic()
     while(1):
-        print("\n(tune) (show) (exit)")
+        print("\n(tune) (show) (smooth) (stream) (metrics) (exit)")
         command = input("Command:")
         if command == "show":
             sim.run()
             sim.show()
+        elif command == "stream":
+            # Filter and animate straight from the file
+            sim.filter.reset()
+            sim.stream(chunks())
+            sim.data = decoded_data
+        elif command == "smooth":
+            sim.run(smooth=True)
+            sim.show()
+        elif command == "metrics":
+            # Toggle collection, csv is optional
+            if sim.filter.metrics is None:
+                sim.filter.metrics = FilterMetrics()
+                csvFile = input("Csv file (blank for none): ").strip()
+                sim.run(metricsFile=csvFile or None)
+            else:
+                sim.filter.metrics = None
+                print("Metrics off")
         elif command == "tune":
             sim.tune()
         elif command == "exit":
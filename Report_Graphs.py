@@ -1,26 +1,22 @@
 import matplotlib.pyplot as plt
 import numpy as np
-import json
 import sys
 
 from libs.Simulation import Simulation
-from libs.DataObject import DataObject
+from libs.JsonStream import readStore
 
 class Grapher(Simulation):
-    def run(self):
-        for i in range(len(self.data)):
-            self.step(self.data.at(i))
-        self.stateHistory = np.array(self.tempStateHistory)
-        self.motorHistory = np.array(self.tempMotorHistory)
+    def run(self, smooth: bool = False):
+        self.replay(smooth)
 
-    def graph_states(self):
+    def graph_states(self, smooth: bool = False):
         self.reset()
-        self.run()
+        self.run(smooth)
 
-        time = np.arange(0, len(self.stateHistory), 1) / 10
-        print(len(time))
-        print(time)
-        print(len(self.stateHistory))
+        if 'timestamp' in self.data:
+            time = self.data['timestamp'] - self.data.index.start
+        else:
+            time = np.arange(0, len(self.stateHistory), 1) * self.period()
         assert(len(time) == len(self.stateHistory))
         plt.subplot(3, 1, 1)
         plt.title('Heading')
@@ -51,14 +47,13 @@ class Grapher(Simulation):
 
 def main():
     args = sys.argv
-    if len(args) != 2:
-        print("Must give filename")
+    if len(args) not in (2, 3):
+        print("Must give filename (and optionally smooth)")
         exit()
 
-    with open(args[1],"r") as f:
-        data = DataObject(json.load(f))
+    data = readStore(args[1])
     grapher = Grapher(data)
-    grapher.graph_states()
+    grapher.graph_states(smooth=len(args) == 3 and args[2] == "smooth")
 
 if __name__ == "__main__":
     main()
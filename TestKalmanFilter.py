@@ -0,0 +1,233 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+from libs.KalmanFilter import KalmanFilter, UPDATE_METHODS
+from libs.BufferedKalmanFilter import BufferedKalmanFilter, transitionMatrices
+from libs.SteadyStateKalmanFilter import SteadyStateKalmanFilter
+from libs.Diagnostics import FilterDiagnostics
+from libs.RingBuffer import RingBuffer
+from libs.FilterMetrics import FilterMetrics
+from libs.Replay import Replay
+from TestReplay import columns
+from TestReplay import makeTelemetry
+
+
+def runMethod(method: str, joseph: bool, data: list[dict[str, float]],
+              cls: type = KalmanFilter) -> tuple[np.ndarray, np.ndarray]:
+    kf = cls()
+    kf.updateMethod = method
+    kf.josephForm = joseph
+    states, covariances = [], []
+    for d in data:
+        kf.predict(np.array([[d['powerLeft'], d['powerRight']]]).T, 0.1)
+        kf.update(dict(d))
+        states.append(kf.x[:, 0].copy())
+        covariances.append(kf.P.copy())
+    return np.array(states), np.array(covariances)
+
+
+class TestUpdateMethods(unittest.TestCase):
+    def test_methods_match_inverse(self):
+        data = makeTelemetry(seed=7)
+        states, covariances = runMethod('inverse', False, data)
+        for method in UPDATE_METHODS:
+            for joseph in (False, True):
+                with self.subTest(method=method, joseph=joseph):
+                    s, P = runMethod(method, joseph, data)
+                    np.testing.assert_allclose(s, states, rtol=1e-9, atol=1e-9)
+                    np.testing.assert_allclose(P, covariances, rtol=1e-9, atol=1e-9)
+
+    def test_joseph_symmetric(self):
+        _, covariances = runMethod('sequential', True, makeTelemetry(seed=8))
+        np.testing.assert_allclose(covariances, covariances.transpose(0, 2, 1), atol=1e-12)
+
+    def test_gps_flag(self):
+        kf = KalmanFilter()
+        # Off by default, updates aren't timed or recorded
+        self.assertIsNone(kf.diagnostics)
+        self.assertFalse(kf.recording)
+        kf.update_nogps({'rz': 1.})
+        with self.assertRaises(ValueError):
+            kf.gpsUpdated
+        kf.reset()
+        kf.diagnostics = FilterDiagnostics()
+        kf.update_nogps({'rz': 1.})
+        kf.update_gps({'gpsX': 1., 'gpsY': 1., 'rz': 1., 'course_gps': 45., 'dist_gps': 1.})
+        self.assertEqual(kf.gpsUpdated.toArray().tolist(), [False, True])
+
+    def test_reset_forgets_gps(self):
+        kf = KalmanFilter()
+        kf.diagnostics = FilterDiagnostics()
+        kf.update({'gpsX': 1., 'gpsY': 1., 'rz': 0.})
+        kf.reset()
+        # A fix before the reset doesn't make the first one after an update
+        kf.update({'gpsX': 2., 'gpsY': 1., 'rz': 0.})
+        self.assertEqual(kf.gpsUpdated.toArray().tolist(), [False])
+
+    def test_load_params(self):
+        kf = KalmanFilter()
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'params.json')
+            with open(filename, 'w') as f:
+                json.dump({'b1': 2., 'P': 1., 'x': 3.}, f)
+            with contextlib.redirect_stdout(io.StringIO()):
+                kf.loadParams(filename)
+        self.assertEqual(kf.b1, 2.)
+        # Filter state isn't a parameter
+        self.assertEqual(kf.P.shape, (6, 6))
+        self.assertEqual(kf.x.shape, (6, 1))
+
+
+class TestBufferedKalmanFilter(unittest.TestCase):
+    def test_matches_kalman_filter(self):
+        data = makeTelemetry(seed=9)
+        for method in UPDATE_METHODS:
+            for joseph in (False, True):
+                with self.subTest(method=method, joseph=joseph):
+                    states, covariances = runMethod(method, joseph, data)
+                    s, P = runMethod(method, joseph, data, BufferedKalmanFilter)
+                    np.testing.assert_allclose(s, states, rtol=1e-9, atol=1e-9)
+                    np.testing.assert_allclose(P, covariances, rtol=1e-9, atol=1e-9)
+
+    def test_in_place(self):
+        kf = BufferedKalmanFilter()
+        x, P = kf.x, kf.P
+        kf.predict(np.array([[0.5], [0.2]]), 0.1)
+        kf.update_nogps({'rz': 3.})
+        self.assertIs(kf.x, x)
+        self.assertIs(kf.P, P)
+        # Replaced arrays are picked up again
+        kf.x = kf.x.copy()
+        old = x.copy()
+        kf.predict(np.array([[0.5], [0.2]]), 0.1)
+        np.testing.assert_array_equal(x, old)
+        self.assertFalse(np.array_equal(kf.x, old))
+
+    def test_transition_cached(self):
+        F, _ = transitionMatrices(0.1, 0.8, 3.)
+        self.assertIs(transitionMatrices(0.1, 0.8, 3.)[0], F)
+        self.assertFalse(F.flags.writeable)
+        np.testing.assert_array_equal(F, KalmanFilter().transition(0.1))
+
+
+class TestSteadyStateKalmanFilter(unittest.TestCase):
+    def test_close_to_kalman_filter(self):
+        data = makeTelemetry(2000, seed=10)
+        states, covariances = runMethod('sequential', False, data)
+        s, P = runMethod('sequential', False, data, lambda: SteadyStateKalmanFilter(gpsPeriod=7))
+        # Same until warm up ends, then the heading block is still exact
+        np.testing.assert_allclose(s[:100], states[:100], rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(s[:, 4:], states[:, 4:], rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(s[:, :4], states[:, :4], atol=0.05)
+        # P is kept up to date while steady, gps every 7 records has converged
+        np.testing.assert_allclose(P, covariances, rtol=1e-6, atol=1e-9)
+
+    def test_fall_back(self):
+        kf = SteadyStateKalmanFilter(maxOutage=20, warmupFixes=3)
+        u = np.array([[0.5], [0.2]])
+        for d in makeTelemetry(40, seed=11):
+            kf.predict(u, 0.1)
+            kf.update(d)
+        self.assertTrue(kf.steady)
+        # Long gps outage
+        for _ in range(25):
+            kf.predict(u, 0.1)
+            kf.update_nogps({'rz': 1.})
+        self.assertFalse(kf.steady)
+        self.assertTrue(np.all(np.isfinite(kf.P)))
+        np.testing.assert_allclose(kf.P, kf.P.T)
+        # Changed parameters
+        for d in makeTelemetry(40, seed=11):
+            kf.predict(u, 0.1)
+            kf.update(d)
+        self.assertTrue(kf.steady)
+        kf.b1 = 1.
+        kf.predict(u, 0.1)
+        self.assertFalse(kf.steady)
+
+
+class TestDiagnostics(unittest.TestCase):
+    def test_ring_buffer(self):
+        ring = RingBuffer(4, (2,))
+        for i in range(6):
+            ring.append((i, -i))
+        self.assertEqual(len(ring), 4)
+        self.assertEqual(ring.start, 2)
+        np.testing.assert_array_equal(ring[5], (5, -5))
+        np.testing.assert_array_equal(ring[-4], (2, -2))
+        with self.assertRaises(IndexError):
+            ring[1]
+        ring.extend([(i, -i) for i in range(6, 9)])
+        np.testing.assert_array_equal(ring.toArray()[:, 0], [5, 6, 7, 8])
+        ring.extend([(i, -i) for i in range(9, 20)])
+        np.testing.assert_array_equal(ring.toArray()[:, 0], [16, 17, 18, 19])
+
+        full = RingBuffer(None)
+        full.extend(np.arange(3000))
+        full.append(3000)
+        np.testing.assert_array_equal(full.toArray(), np.arange(3001))
+        self.assertEqual(full[0], 0)
+
+    def test_bounded(self):
+        kf = KalmanFilter()
+        kf.diagnostics = FilterDiagnostics(50)
+        data = makeTelemetry(120, seed=12)
+        for d in data:
+            kf.predict(np.array([[d['powerLeft'], d['powerRight']]]).T, 0.1)
+            kf.update(dict(d))
+        self.assertEqual(len(kf.diagnostics), 50)
+        self.assertEqual(kf.gpsUpdated.count, 120)
+        self.assertTrue(kf.gpsUpdated[119] or not kf.gpsUpdated[118])
+        kf.reset()
+        self.assertEqual(kf.diagnostics.capacity, 50)
+        self.assertEqual(len(kf.gpsUpdated), 0)
+
+    def test_nis_matches_methods(self):
+        data = makeTelemetry(seed=13)
+        nis = {}
+        for method in UPDATE_METHODS:
+            kf = KalmanFilter()
+            kf.diagnostics = FilterDiagnostics()
+            kf.updateMethod = method
+            for d in data:
+                kf.predict(np.array([[d['powerLeft'], d['powerRight']]]).T, 0.1)
+                kf.update(dict(d))
+            nis[method] = kf.diagnostics.nis.toArray()
+            innovations = kf.diagnostics.innovations.toArray()
+            np.testing.assert_array_equal(np.isnan(innovations[:, 0]), ~kf.gpsUpdated.toArray())
+        for method in UPDATE_METHODS:
+            np.testing.assert_allclose(nis[method], nis['inverse'], rtol=1e-9)
+
+
+class TestFilterMetrics(unittest.TestCase):
+    def test_matches_diagnostics(self):
+        data = makeTelemetry(seed=14)
+        kf = KalmanFilter()
+        self.assertIsNone(kf.metrics)
+        kf.metrics = FilterMetrics()
+        kf.diagnostics = FilterDiagnostics()
+        Replay(kf).run(*columns(data))
+        summary = kf.metrics.summary()
+
+        gps = kf.gpsUpdated.toArray()
+        nis = kf.diagnostics.nis.toArray()
+        innovations = kf.diagnostics.innovations.toArray()
+        self.assertEqual(summary['predict.count'], len(data))
+        self.assertAlmostEqual(summary['elapsed_s'], 0.1*len(data))
+        self.assertEqual(summary['gps.count'], gps.sum())
+        self.assertAlmostEqual(summary['gps.nis_mean'], nis[gps].mean())
+        self.assertAlmostEqual(summary['gyro.nis_mean'], nis[~gps].mean())
+        self.assertAlmostEqual(summary['gps.course.var'], innovations[gps, 2].var(ddof=1))
+        self.assertAlmostEqual(summary['gyro.rz.mean'], innovations[~gps, 3].mean())
+        self.assertIn('course', kf.metrics.report())
+
+        kf.reset()
+        self.assertEqual(kf.metrics.summary()['predict.count'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
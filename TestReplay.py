@@ -0,0 +1,349 @@
+import csv
+import json
+import math
+import os
+import tempfile
+import unittest
+import numpy as np
+from libs.Diagnostics import FilterDiagnostics
+from libs.FilterMetrics import FilterMetrics
+from libs.KalmanFilter import KalmanFilter, MAX_DT
+from libs.Replay import Replay, REPLAY_COLUMNS
+from libs.Ensemble import EnsembleFilter
+from libs.Fit import EvaluationCache, ParameterFit, initWorker
+from libs.Parity import checkParity, divergenceWindows, findPairs, hostStates, STATE_FIELDS
+from libs.TelemetryStore import TelemetryStore
+from libs.TimeIndex import recordDts
+from libs.BatchAnalysis import BatchAnalyser, analyseSession, findSessions
+
+
+def makeTelemetry(n: int = 400, seed: int = 0) -> list[dict[str, float]]:
+    "Random drive with gps fixes held over several records like the real gps"
+    rng = np.random.default_rng(seed)
+    data = []
+    gpsX, gpsY = 0., 0.
+    for i in range(n):
+        if i % 7 == 3:
+            gpsX += rng.normal(0, 1)
+            gpsY += rng.normal(0, 1)
+        data.append({
+            "timestamp": 0.1 * i,
+            "gpsX": gpsX,
+            "gpsY": gpsY,
+            "rz": rng.normal(0, 20),
+            "powerLeft": rng.uniform(-1, 1),
+            "powerRight": rng.uniform(-1, 1),
+        })
+    return data
+
+
+def stepAll(kf: KalmanFilter, data: list[dict[str, float]], dts=None) -> tuple[np.ndarray, np.ndarray]:
+    "Reference predict/update on every record, long delta times in MAX_DT steps"
+    states, covariances = [], []
+    for i, d in enumerate(data):
+        kf.step(dict(d), 0.1 if dts is None else dts[i])
+        states.append(kf.x[:, 0])
+        covariances.append(kf.P)
+    return np.array(states), np.array(covariances)
+
+
+def columns(data: list[dict[str, float]]) -> list[list[float]]:
+    return [[d[k] for d in data] for k in ('gpsX', 'gpsY', 'rz', 'powerLeft', 'powerRight')]
+
+
+class TestReplay(unittest.TestCase):
+    def assertSameRun(self, kf: KalmanFilter, batch_kf: KalmanFilter, data, dts=None):
+        for f in (kf, batch_kf):
+            if f.diagnostics is None:
+                f.diagnostics = FilterDiagnostics(None)
+        states, covariances = stepAll(kf, data, dts)
+        replay = Replay(batch_kf)
+        replay.run(*columns(data), dts=dts)
+        self.assertEqual(replay.states.shape, (len(data), 6))
+        self.assertEqual(replay.covariances.shape, (len(data), 6, 6))
+        np.testing.assert_allclose(replay.states, states, rtol=1e-12, atol=1e-9)
+        np.testing.assert_allclose(replay.covariances, covariances, rtol=1e-12, atol=1e-12)
+        self.assertEqual(kf.gpsUpdated.toArray().tolist(), batch_kf.gpsUpdated.toArray().tolist())
+        np.testing.assert_allclose(batch_kf.x, kf.x, rtol=1e-12, atol=1e-9)
+
+    def test_matches_step(self):
+        data = makeTelemetry()
+        self.assertSameRun(KalmanFilter(), KalmanFilter(), data)
+
+    def test_continues_from_filter(self):
+        data = makeTelemetry(seed=1)
+        kf, batch_kf = KalmanFilter(), KalmanFilter()
+        self.assertSameRun(kf, batch_kf, data[:150])
+        self.assertSameRun(kf, batch_kf, data[150:])
+
+    def test_coupled_covariance(self):
+        data = makeTelemetry(100, seed=2)
+        kf, batch_kf = KalmanFilter(), KalmanFilter()
+        kf.P[0, 1] = kf.P[1, 0] = 1.
+        batch_kf.P[0, 1] = batch_kf.P[1, 0] = 1.
+        self.assertFalse(Replay(batch_kf).isBlockDiagonal())
+        self.assertSameRun(kf, batch_kf, data)
+
+    def test_record_dts(self):
+        data = makeTelemetry(200, seed=3)
+        dts = recordDts(np.random.default_rng(3).uniform(0.05, 0.15, len(data)).cumsum())
+        dts[100] = 1. # Gap split into MAX_DT steps
+        self.assertSameRun(KalmanFilter(), KalmanFilter(), data, dts)
+        kf, batch_kf = KalmanFilter(), KalmanFilter()
+        kf.P[0, 1] = kf.P[1, 0] = batch_kf.P[0, 1] = batch_kf.P[1, 0] = 1.
+        self.assertSameRun(kf, batch_kf, data, dts)
+        with self.assertRaises(ValueError):
+            Replay(KalmanFilter()).run(*columns(data), dts=dts[1:])
+
+    def test_empty(self):
+        replay = Replay(KalmanFilter())
+        replay.run([], [], [], [], [])
+        self.assertEqual(replay.states.shape, (0, 6))
+
+
+class TestSmoother(unittest.TestCase):
+    def naiveSmooth(self, replay: Replay, dts=None) -> tuple[np.ndarray, np.ndarray]:
+        "Textbook RTS pass with explicit inverses"
+        xs = replay.states.copy()
+        Ps = np.array(replay.covariances)
+        for k in range(len(xs) - 2, -1, -1):
+            if dts is None:
+                F = replay.filter.transition(replay.dt)
+            else:
+                steps = max(1, math.ceil(dts[k+1] / MAX_DT))
+                F = np.linalg.matrix_power(replay.filter.transition(dts[k+1] / steps), steps)
+            C = Ps[k]@F.T@np.linalg.inv(replay.predictedCovariances[k+1])
+            d = xs[k+1] - replay.predictedStates[k+1]
+            d[4] = (d[4] + 180) % 360 - 180
+            xs[k] = xs[k] + C@d
+            Ps[k] = Ps[k] + C@(Ps[k+1] - replay.predictedCovariances[k+1])@C.T
+        xs[:, 4] %= 360
+        return xs, Ps
+
+    def test_matches_naive(self):
+        replay = Replay(KalmanFilter(), keepPredicted=True)
+        replay.run(*columns(makeTelemetry(seed=5)))
+        xs, Ps = self.naiveSmooth(replay)
+        replay.smooth(chunk=64)
+        np.testing.assert_allclose(replay.states, xs, rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(replay.covariances, Ps, rtol=1e-9, atol=1e-9)
+
+    def test_record_dts(self):
+        dts = np.random.default_rng(7).uniform(0.05, 0.15, 400)
+        dts[[50, 300]] = 0.5, 1.
+        replay = Replay(KalmanFilter(), keepPredicted=True)
+        replay.run(*columns(makeTelemetry(seed=7)), dts=dts)
+        xs, Ps = self.naiveSmooth(replay, dts)
+        replay.smooth(chunk=64)
+        np.testing.assert_allclose(replay.states, xs, rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(replay.covariances, Ps, rtol=1e-9, atol=1e-9)
+
+    def test_spill(self):
+        data = columns(makeTelemetry(seed=6))
+        replay = Replay(KalmanFilter(), keepPredicted=True)
+        replay.run(*data)
+        replay.smooth()
+        with tempfile.TemporaryDirectory() as folder:
+            spilled = Replay(KalmanFilter(), keepPredicted=True, spillDir=folder)
+            spilled.run(*data)
+            self.assertIsInstance(spilled.covariances, np.memmap)
+            spilled.smooth(chunk=50)
+            np.testing.assert_allclose(spilled.states, replay.states, rtol=1e-12, atol=1e-12)
+            np.testing.assert_allclose(spilled.covariances, replay.covariances, rtol=1e-12, atol=1e-12)
+            del spilled
+
+    def test_needs_predicted(self):
+        replay = Replay(KalmanFilter())
+        replay.run(*columns(makeTelemetry(20)))
+        with self.assertRaises(ValueError):
+            replay.smooth()
+
+
+class TestEnsembleFilter(unittest.TestCase):
+    def test_members_match_replay(self):
+        data = makeTelemetry(seed=3)
+        b1 = [0.5, 0.8, 2.]
+        gyroNoise = [0.1, 0.3, 1.]
+        ensemble = EnsembleFilter({'b1': b1, 'gyroNoise': gyroNoise})
+        ensemble.run(*columns(data))
+        self.assertEqual(ensemble.states.shape, (3, len(data), 6))
+        for i in range(3):
+            kf = KalmanFilter()
+            kf.b1 = b1[i]
+            kf.gyroNoise = gyroNoise[i]
+            replay = Replay(kf)
+            replay.run(*columns(data))
+            np.testing.assert_allclose(ensemble.states[i], replay.states, rtol=1e-9, atol=1e-9)
+        # Real record times, with a gap split into MAX_DT steps
+        dts = recordDts(np.random.default_rng(5).uniform(0.05, 0.15, len(data)).cumsum())
+        dts[100] = 1.
+        ensemble.run(*columns(data), dts=dts)
+        kf = KalmanFilter()
+        kf.b1 = b1[1]
+        kf.gyroNoise = gyroNoise[1]
+        replay = Replay(kf)
+        replay.run(*columns(data), dts=dts)
+        np.testing.assert_allclose(ensemble.states[1], replay.states, rtol=1e-9, atol=1e-9)
+
+    def test_innovation_stats(self):
+        data = makeTelemetry(seed=4)
+        ensemble = EnsembleFilter.sweep('gpsNoise', [1., 4., 16.])
+        ensemble.run(*columns(data), keepStates=False)
+        stats = ensemble.innovationStats()
+        self.assertEqual(stats['gps']['count'] + stats['gyro']['count'], len(data))
+        self.assertEqual(stats['gps']['mean'].shape, (3, 4))
+        self.assertTrue(np.all(np.isfinite(ensemble.logLikelihood)))
+
+    def test_unknown_param(self):
+        with self.assertRaises(ValueError):
+            EnsembleFilter({'w': [1., 2.]})
+
+
+class TestParameterFit(unittest.TestCase):
+    def test_cache_key(self):
+        session = dict(zip(REPLAY_COLUMNS, np.array(columns(makeTelemetry(100, seed=40)))))
+        session.update(hash='a', dt=0.1)
+        initWorker([session])
+        cache = EvaluationCache(None)
+        grid = np.zeros((1, 1), dtype=np.int64)
+        value = ParameterFit([session], ('b1',), cache, workers=1).evaluate(grid)
+        again = ParameterFit([session], ('b1',), cache, workers=1)
+        self.assertEqual(again.evaluate(grid).tolist(), value.tolist())
+        self.assertEqual(again.cacheHits, 1)
+        # Other parameters or delta time aren't the same evaluation
+        base = KalmanFilter()
+        base.b2 = 5.
+        other = ParameterFit([session], ('b1',), cache, workers=1, base=base)
+        self.assertNotEqual(other.evaluate(grid).tolist(), value.tolist())
+        session['dt'] = 0.2
+        slower = ParameterFit([session], ('b1',), cache, workers=1)
+        self.assertNotEqual(slower.evaluate(grid).tolist(), value.tolist())
+        self.assertEqual(other.cacheHits + slower.cacheHits, 0)
+        # Real record times replace the fixed delta time
+        session['dts'] = np.full(100, 0.1)
+        real = ParameterFit([session], ('b1',), cache, workers=1)
+        np.testing.assert_allclose(real.evaluate(grid), value, rtol=1e-12)
+        self.assertEqual(real.cacheHits, 0)
+
+
+class TestBatchAnalysis(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        for seed in range(3):
+            with open(os.path.join(self.folder.name, f'telem{seed}.json'), 'w') as f:
+                json.dump(makeTelemetry(200, seed=40 + seed), f)
+        with open(os.path.join(self.folder.name, 'kalman.json'), 'w') as f:
+            json.dump([{'timestamp': 0., 'heading': 1.}], f)
+        with open(os.path.join(self.folder.name, 'notes.txt'), 'w') as f:
+            f.write('not telemetry')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_session(self):
+        row = analyseSession(os.path.join(self.folder.name, 'telem0.json'), {})
+        self.assertEqual(row['records'], 200)
+        self.assertAlmostEqual(row['duration_s'], 19.9)
+        self.assertGreater(row['distance_m'], 0)
+        self.assertEqual(row['gps_fixes'], 29)
+        self.assertEqual(row['gps_dropouts'], 0)
+        self.assertTrue(np.isfinite(row['gps_nis_mean']))
+        # Jittered records are stepped as they happened
+        records = makeTelemetry(200, seed=43)
+        times = np.random.default_rng(44).uniform(0.05, 0.15, len(records)).cumsum()
+        for record, t in zip(records, times):
+            record['timestamp'] = t
+        filename = os.path.join(self.folder.name, 'jitter.json')
+        with open(filename, 'w') as f:
+            json.dump(records, f)
+        kf = KalmanFilter()
+        kf.metrics = FilterMetrics()
+        Replay(kf).run(*columns(records), dts=recordDts(times))
+        self.assertAlmostEqual(analyseSession(filename, {})['gps_nis_mean'], kf.metrics.summary()['gps.nis_mean'])
+
+    def test_skips_unchanged(self):
+        sessions = findSessions([self.folder.name])
+        self.assertEqual(len(sessions), 4)
+        cacheFile = os.path.join(self.folder.name, 'cache.json')
+        summary = os.path.join(self.folder.name, 'summary.csv')
+        first = BatchAnalyser({}, cacheFile, workers=2)
+        first.run(sessions, summary)
+        self.assertEqual((first.analysed, first.cached), (4, 0))
+        with open(summary) as f:
+            rows = {row['session']: row for row in csv.DictReader(f)}
+        self.assertIn('no gpsX', rows[sessions[0]]['error'])
+
+        # One session changes
+        with open(sessions[1], 'w') as f:
+            json.dump(makeTelemetry(150, seed=50), f)
+        second = BatchAnalyser({}, cacheFile, workers=2)
+        second.run(sessions, summary)
+        self.assertEqual((second.analysed, second.cached), (1, 3))
+        with open(summary) as f:
+            again = {row['session']: row for row in csv.DictReader(f)}
+        self.assertEqual(again[sessions[2]], rows[sessions[2]])
+        self.assertEqual(again[sessions[1]]['records'], '150')
+
+
+class TestParity(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.telem = os.path.join(self.folder.name, 'telemA.json')
+        self.kalman = os.path.join(self.folder.name, 'kalmanA.json')
+        records = makeTelemetry(300, seed=60)
+        with open(self.telem, 'w') as f:
+            json.dump(records, f)
+        # Onboard packets are the host filter, received a little later
+        self.onboard = hostStates(TelemetryStore.fromRecords(records), KalmanFilter())
+        self.onboard['timestamp'][:] += 0.02
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def writeOnboard(self):
+        with open(self.kalman, 'w') as f:
+            json.dump(self.onboard.toRecords(), f)
+
+    def test_matching_filters(self):
+        self.writeOnboard()
+        self.assertEqual(findPairs([self.folder.name]), [(self.telem, self.kalman)])
+        # Saved as json beside the binary logs, the logs are paired once
+        for name in ('telemA.bin', 'kalmanA.bin'):
+            open(os.path.join(self.folder.name, name), 'wb').close()
+        self.assertEqual(findPairs([self.folder.name]),
+                         [(os.path.join(self.folder.name, 'telemA.bin'), os.path.join(self.folder.name, 'kalmanA.bin'))])
+        for name in ('telemA.bin', 'kalmanA.bin'):
+            os.remove(os.path.join(self.folder.name, name))
+        row = checkParity(self.telem, self.kalman, {})
+        self.assertEqual(row['matched'], 300)
+        self.assertEqual(row['windows'], 0)
+        for field in STATE_FIELDS:
+            self.assertLess(row[f'{field}_max'], 1e-6)
+
+    def test_divergence(self):
+        # Onboard heading off by 45 deg from 10 s to 15 s
+        self.onboard['heading'][100:150] += 45.
+        self.writeOnboard()
+        row = checkParity(self.telem, self.kalman, {})
+        self.assertEqual(row['windows'], 1)
+        self.assertAlmostEqual(row['heading_max'], 45., places=4)
+        self.assertAlmostEqual(row['diverged_frac'], 50/300)
+        self.assertEqual(row['worst_windows'], '10.0-14.9s')
+        windows = divergenceWindows(np.arange(10.), np.isin(np.arange(10), [1, 2, 5, 9]), merge=1.5)
+        np.testing.assert_array_equal(windows, [[1., 2.], [5., 5.], [9., 9.]])
+
+    def test_real_steps(self):
+        # Jittered records and a link gap are stepped as they happened
+        records = makeTelemetry(200, seed=61)
+        times = np.random.default_rng(62).uniform(0.05, 0.15, len(records)).cumsum()
+        times[120:] += 2.
+        for record, t in zip(records, times):
+            record['timestamp'] = t
+        states = hostStates(TelemetryStore.fromRecords(records), KalmanFilter())
+        expected, _ = stepAll(KalmanFilter(), records, recordDts(times))
+        for i, field in enumerate(STATE_FIELDS):
+            np.testing.assert_allclose(states[field], expected[:, i], rtol=1e-9, atol=1e-9)
+
+
+if __name__ == "__main__":
+    unittest.main()
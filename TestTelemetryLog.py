@@ -0,0 +1,514 @@
+import asyncio
+import contextlib
+import csv
+import io
+import json
+import multiprocessing
+import random
+import os
+import struct
+import tempfile
+import threading
+import unittest
+import numpy as np
+from bleak.exc import BleakError
+import BT
+from libs.DataRecorder import DataRecorder
+from libs.TelemetryLog import LogWriter, readLog, logToStore, SCHEMAS, HEADER_SIZE
+from libs.TelemetryArchive import Archive, ArchiveWriter, archiveStores, iterArchive, CODECS
+from libs.TelemetryStore import TelemetryStore
+from libs.PacketBuffer import PacketBuffer
+from libs.CommandQueue import CommandQueue
+from libs.LiveState import LiveState
+from libs.SharedRing import SharedRing, RingReader, WRITING_WORD
+from libs.FakeBoat import FakeBoat, packStreams
+from libs.Backoff import Backoff
+from libs.Gatt import TELEMETRY_UUID, KALMAN_UUID, CMD_UUID
+from TestReplay import makeTelemetry
+
+
+def telemPacket(i: int) -> bytes:
+    "Packed telemetry like the boat sends"
+    return struct.pack(SCHEMAS['telem'][0], 1.5*i, -2.*i, -37.8, 144.9, 0.25, -0.5, float(i), 90., 10.)
+
+
+class TestTelemetryLog(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.folder.name, 'telem.bin')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_round_trip(self):
+        log = LogWriter(self.filename, 'telem')
+        for i in range(5):
+            log.append(100. + i, telemPacket(i))
+        records = readLog(self.filename)
+        self.assertEqual(len(records), 5)
+        np.testing.assert_array_equal(records['timestamp'], 100. + np.arange(5))
+        np.testing.assert_array_equal(records['gpsX'], 1.5*np.arange(5))
+        self.assertEqual(records['rz'].dtype, np.float32)
+        values = struct.unpack(SCHEMAS['telem'][0], telemPacket(3))
+        self.assertEqual(tuple(records[3].tolist()[1:]), values)
+        log.close()
+
+    def test_append_after_crash(self):
+        log = LogWriter(self.filename, 'telem')
+        log.append(1., telemPacket(1))
+        # Half written record
+        log.file.write(b'\1\2\3')
+        log.close()
+        self.assertEqual(len(readLog(self.filename)), 1)
+
+        log = LogWriter(self.filename, 'telem')
+        log.append(2., telemPacket(2))
+        log.close()
+        np.testing.assert_array_equal(readLog(self.filename)['timestamp'], [1., 2.])
+        with self.assertRaises(ValueError):
+            LogWriter(self.filename, 'kalman')
+
+    def test_bad_payload(self):
+        log = LogWriter(self.filename, 'kalman')
+        with self.assertRaises(ValueError):
+            log.append(1., telemPacket(1))
+        log.close()
+        self.assertEqual(os.path.getsize(self.filename), HEADER_SIZE)
+        self.assertEqual(len(logToStore(self.filename)), 0)
+        with open(self.filename, 'r+b') as f:
+            f.write(b'NOTALOG!')
+        with self.assertRaises(ValueError):
+            readLog(self.filename)
+
+
+class TestTelemetryArchive(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.folder.name, 'telem.arc')
+        self.data = TelemetryStore.fromRecords(makeTelemetry(250, seed=30))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_round_trip(self):
+        self.data['gpsY'][7] = np.nan
+        for codec in CODECS:
+            # Written in pieces that don't line up with chunks
+            pieces = [self.data[i:i+70] for i in range(0, 250, 70)]
+            self.assertEqual(archiveStores(pieces, self.filename, chunkRecords=100, codec=codec), 250)
+            archive = Archive(self.filename)
+            self.assertEqual(len(archive), 250)
+            self.assertEqual([chunk['records'] for chunk in archive.chunks], [100, 100, 50])
+            np.testing.assert_array_equal(archive.toStore()['gpsY'], self.data['gpsY'])
+            self.assertEqual(archive.toStore().toRecords()[8:], self.data.toRecords()[8:])
+            archive.close()
+
+    def test_random_access(self):
+        writer = ArchiveWriter(self.filename, chunkRecords=125)
+        writer.write(self.data)
+        # Float32 columns from binary logs keep their type
+        writer.write(TelemetryStore({'timestamp': np.arange(1000., 1010.), 'rz': np.ones(10, np.float32)}))
+        writer.close()
+        archive = Archive(self.filename)
+        chunk = archive.chunk(1, ['rz'])
+        self.assertEqual(chunk.fields, ['rz'])
+        np.testing.assert_array_equal(chunk['rz'], self.data['rz'][125:])
+        self.assertEqual(archive.chunk(2)['rz'].dtype, np.float32)
+        t = self.data['timestamp']
+        window = archive.window(t[120], t[230], ['gpsX'])
+        self.assertEqual(window.fields, ['timestamp', 'gpsX'])
+        np.testing.assert_array_equal(window['gpsX'], self.data['gpsX'][120:230])
+        self.assertEqual(len(archive.window(2000., 3000.)), 0)
+        archive.close()
+        # Streamed from the file, opened and closed by the iterator
+        self.assertEqual([len(chunk) for chunk in iterArchive(self.filename, ['rz'])], [125, 125, 10])
+
+    def test_unclosed(self):
+        writer = ArchiveWriter(self.filename)
+        writer.write(self.data)
+        writer.file.close()
+        with self.assertRaises(ValueError):
+            Archive(self.filename)
+
+
+class TestDataRecorder(unittest.TestCase):
+    def test_save_json(self):
+        with tempfile.TemporaryDirectory() as folder:
+            recorder = DataRecorder(folder)
+            for i in range(3):
+                recorder.appendTelem(10. + i, telemPacket(i))
+            recorder.appendKalman(11., struct.pack('<ffffff', 1., 2., 3., 4., 5., 6.))
+            telemFile, kalmanFile = recorder.save().result(timeout=10)
+            with open(telemFile) as f:
+                telem = json.load(f)
+            with open(kalmanFile) as f:
+                kalman = json.load(f)
+            self.assertEqual(len(telem), 3)
+            self.assertEqual(list(telem[2]), ['timestamp'] + list(SCHEMAS['telem'][1]))
+            self.assertEqual(telem[2]['gpsX'], 3.)
+            self.assertEqual(kalman, [{'timestamp': 11., 'x': 1., 'y': 2., 'dx': 3., 'dy': 4.,
+                                       'heading': 5., 'd_heading': 6.}])
+            # New logs after saving
+            recorder.close()
+            self.assertNotEqual(recorder.logs['telem'].filename, os.path.splitext(telemFile)[0] + '.bin')
+            self.assertEqual(recorder.logs['telem'].records, 0)
+
+    def test_rotate_and_flush(self):
+        with tempfile.TemporaryDirectory() as folder:
+            recorder = DataRecorder(folder, flushRecords=10, rotateBytes=HEADER_SIZE + 60*25)
+            for i in range(60):
+                recorder.appendTelem(float(i), telemPacket(i))
+            recorder.close()
+            # Every record is in exactly one log, no log over the size
+            logs = sorted((os.path.join(folder, f) for f in os.listdir(folder) if f.startswith('telem') and f.endswith('.bin')),
+                          key=lambda f: readLog(f)['timestamp'][0] if len(readLog(f)) else np.inf)
+            timestamps = np.concatenate([readLog(f)['timestamp'] for f in logs])
+            np.testing.assert_array_equal(timestamps, np.arange(60))
+            self.assertTrue(all(os.path.getsize(f) <= HEADER_SIZE + 60*25 for f in logs))
+            # Closing exports the rotated logs and the last one, none were saved
+            self.assertEqual(recorder.unsaved, [])
+            for f in logs:
+                with open(os.path.splitext(f)[0] + '.json') as j:
+                    self.assertEqual(len(json.load(j)), len(readLog(f)))
+
+    def test_full_queue_drops(self):
+        with tempfile.TemporaryDirectory() as folder:
+            recorder = DataRecorder(folder, queueSize=2)
+            # Nothing takes packets once the writer has stopped
+            recorder.close()
+            for i in range(3):
+                recorder.appendTelem(float(i), telemPacket(i))
+            self.assertEqual(recorder.dropped, 1)
+            # Doesn't wait on the full queue
+            recorder.close()
+            threads = [threading.Thread(target=lambda: [recorder.appendTelem(0., telemPacket(0)) for _ in range(2000)])
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(recorder.dropped, 8001)
+
+    def test_batches(self):
+        with tempfile.TemporaryDirectory() as folder:
+            recorder = DataRecorder(folder)
+            packets = PacketBuffer('telem')
+            for i in range(5):
+                packets.append(10. + i, telemPacket(i))
+            recorder.appendBatch('telem', packets.drain())
+            recorder.appendTelem(15., telemPacket(5))
+            telemFile, _ = recorder.save().result(timeout=10)
+            recorder.close()
+            with open(telemFile) as f:
+                telem = json.load(f)
+        self.assertEqual([r['timestamp'] for r in telem], [10., 11., 12., 13., 14., 15.])
+        self.assertEqual(telem[4]['rz'], 4.)
+
+
+class TestPacketBuffer(unittest.TestCase):
+    def test_drain(self):
+        packets = PacketBuffer('telem', capacity=4)
+        self.assertIsNone(packets.latest())
+        self.assertEqual(len(packets.drain()), 0)
+        for i in range(3):
+            packets.append(float(i), telemPacket(i))
+        self.assertEqual(packets.latest(), struct.unpack(SCHEMAS['telem'][0], telemPacket(2)))
+        np.testing.assert_array_equal(packets.drain()['timestamp'], [0., 1., 2.])
+        # Wraps around the end, the oldest packets are overwritten
+        for i in range(3, 9):
+            packets.append(float(i), telemPacket(i))
+        records = packets.drain()
+        np.testing.assert_array_equal(records['timestamp'], [5., 6., 7., 8.])
+        np.testing.assert_array_equal(records['gpsX'], 1.5*np.arange(5, 9))
+        self.assertEqual(packets.lost, 2)
+        with self.assertRaises(ValueError):
+            packets.append(9., telemPacket(9)[:-1])
+        self.assertEqual(len(packets), 0)
+
+
+class TestCommandQueue(unittest.TestCase):
+    def test_order_and_coalescing(self):
+        async def run():
+            commands = CommandQueue(size=4)
+            self.assertIsNone(await commands.get(0.01))
+            for key in 'ffbff':
+                self.assertTrue(commands.put(key))
+            # Other commands are never merged, a full queue refuses
+            self.assertTrue(commands.put('s'))
+            self.assertFalse(commands.put('s'))
+            self.assertEqual(commands.refused, 1)
+            written = []
+            while len(commands):
+                command = await commands.get()
+                commands.done(command)
+                written.append((command.text, command.presses))
+            return commands, written
+        commands, written = asyncio.run(run())
+        self.assertEqual(written, [('f', 2), ('b', 1), ('f', 2), ('s', 1)])
+        self.assertEqual(commands.coalesced, 2)
+        self.assertEqual(len(commands.latencies), 4)
+        self.assertIn("Latency ms", commands.report())
+
+    def test_wakes_on_put(self):
+        async def run():
+            commands = CommandQueue()
+            loop = asyncio.get_running_loop()
+            loop.call_later(0.01, commands.put, 'x')
+            return await commands.get(5.)
+        self.assertEqual(asyncio.run(run()).text, 'x')
+
+    def test_put_from_thread(self):
+        async def run():
+            commands = CommandQueue()
+            self.assertIsNone(await commands.get(0.))
+            threading.Timer(0.01, commands.put, ('s',)).start()
+            return await commands.get(5.)
+        self.assertEqual(asyncio.run(run()).text, 's')
+
+
+class TestLiveState(unittest.TestCase):
+    def test_snapshots(self):
+        state = LiveState(debugLines=2, connected=False, kalman=None)
+        first = state.snapshot()
+        state.publish(connected=True)
+        state.log("a")
+        state.log("b")
+        # Snapshots held by a reader never change
+        self.assertFalse(first.connected)
+        self.assertEqual(first.version, 0)
+        latest = state.snapshot()
+        self.assertEqual(latest.version, 3)
+        self.assertTrue(latest.connected)
+        self.assertIsNone(latest.kalman)
+        self.assertEqual(latest.debug, "a\nb")
+        with self.assertRaises(AttributeError):
+            latest.missing
+
+    def test_threaded_publishers(self):
+        state = LiveState(count=0)
+        def publish():
+            for _ in range(1000):
+                state.publish(count=state.snapshot().count)
+                state.log("line")
+        threads = [threading.Thread(target=publish) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(state.snapshot().version, 8000)
+
+
+def readRing(name: str, results):
+    "Reader in another process"
+    reader = RingReader(name, fromStart=True)
+    results.put(reader.read()['timestamp'].tolist())
+    reader.close()
+
+
+class TestSharedRing(unittest.TestCase):
+    def setUp(self):
+        self.name = f"test_ring_{os.getpid()}"
+        self.ring = SharedRing('telem', self.name, capacity=8)
+
+    def tearDown(self):
+        self.ring.close()
+
+    def records(self, start: int, stop: int) -> np.ndarray:
+        packets = PacketBuffer('telem', capacity=stop - start)
+        for i in range(start, stop):
+            packets.append(float(i), telemPacket(i))
+        return packets.drain()
+
+    def test_readers(self):
+        first = RingReader(self.name)
+        self.assertEqual(first.schema, 'telem')
+        self.ring.extend(self.records(0, 5))
+        late = RingReader(self.name, fromStart=True)
+        np.testing.assert_array_equal(first.read(limit=3)['timestamp'], [0., 1., 2.])
+        self.ring.append(5., telemPacket(5))
+        # Independent cursors
+        np.testing.assert_array_equal(first.read()['gpsX'], 1.5*np.arange(3, 6))
+        np.testing.assert_array_equal(late.read()['timestamp'], np.arange(6.))
+        self.assertEqual(len(first.read()), 0)
+        with self.assertRaises(ValueError):
+            self.ring.extend(np.zeros(2))
+        first.close()
+        late.close()
+
+    def test_overrun(self):
+        reader = RingReader(self.name)
+        # Laps the reader, and wraps the end of the ring
+        self.ring.extend(self.records(0, 3))
+        self.ring.extend(self.records(3, 13))
+        records = reader.read()
+        np.testing.assert_array_equal(records['timestamp'], np.arange(5., 13.))
+        self.assertEqual(reader.overrun, 5)
+        self.ring.extend(self.records(13, 30))
+        np.testing.assert_array_equal(reader.read()['timestamp'], np.arange(22., 30.))
+        self.assertEqual(reader.overrun, 14)
+        reader.close()
+
+    def test_read_during_extend(self):
+        reader = RingReader(self.name, fromStart=True)
+        self.ring.extend(self.records(0, 8))
+        # A batch of 4 half way through being written, not published yet
+        self.ring.header[WRITING_WORD] = 12
+        self.ring.records[:4] = self.records(8, 12)
+        records = reader.read()
+        np.testing.assert_array_equal(records['timestamp'], [4., 5., 6., 7.])
+        self.assertEqual(reader.overrun, 4)
+        self.ring.header[0] = 12
+        np.testing.assert_array_equal(reader.read()['timestamp'], [8., 9., 10., 11.])
+        reader.close()
+
+    def test_other_process(self):
+        self.ring.extend(self.records(0, 4))
+        results = multiprocessing.Queue()
+        reader = multiprocessing.Process(target=readRing, args=(self.name, results))
+        reader.start()
+        self.assertEqual(results.get(timeout=10), [0., 1., 2., 3.])
+        reader.join()
+        # Still there for other readers after that process exits
+        late = RingReader(self.name, fromStart=True)
+        self.assertEqual(len(late), 4)
+        late.close()
+
+
+class TestFakeBoat(unittest.TestCase):
+    def test_packets(self):
+        async def run():
+            boat = FakeBoat('fake', rate=200.)
+            received = {TELEMETRY_UUID: [], KALMAN_UUID: []}
+            for uuid, packets in received.items():
+                await boat.start_notify(uuid, lambda _, val, packets=packets: packets.append(bytes(val)))
+            await boat.connect()
+            await asyncio.sleep(0.2)
+            await boat.write_gatt_char(CMD_UUID, b'f', True)
+            await boat.disconnect()
+            await asyncio.sleep(0)
+            return boat, received
+        boat, received = asyncio.run(run())
+        self.assertFalse(boat.is_connected)
+        self.assertEqual(boat.writes, [(CMD_UUID, b'f')])
+        self.assertGreater(boat.sent['telem'], 20)
+        self.assertEqual(len(received[TELEMETRY_UUID]), boat.sent['telem'])
+        self.assertEqual(len(received[KALMAN_UUID]), boat.sent['kalman'])
+        self.assertEqual(received[TELEMETRY_UUID][0], boat.packets['telem'][0])
+        self.assertIn("Delivery delay", boat.report())
+
+    def test_replay_layout(self):
+        source = TelemetryStore.fromRecords(makeTelemetry(5))
+        packets = packStreams(source)
+        telem = struct.unpack(SCHEMAS['telem'][0], packets['telem'][3])
+        self.assertEqual(telem[0], source['gpsX'][3])
+        # Fields the recording doesn't have are sent as 0
+        self.assertEqual(telem[2], 0.)
+        self.assertEqual(len(packets['kalman'][0]), struct.calcsize(SCHEMAS['kalman'][0]))
+        # Velocity over the recording's time steps
+        source = TelemetryStore({'timestamp': np.array([0., 0.5, 1.]), 'gpsX': np.array([0., 1., 2.]),
+                                 'gpsY': np.zeros(3)})
+        kalman = struct.unpack(SCHEMAS['kalman'][0], packStreams(source)['kalman'][1])
+        self.assertAlmostEqual(kalman[2], 2.)
+
+
+class TestBackoff(unittest.TestCase):
+    def test_delays(self):
+        backoff = Backoff(initial=1., maximum=5., factor=2., jitter=0.)
+        self.assertEqual([backoff.next() for _ in range(5)], [1., 2., 4., 5., 5.])
+        self.assertEqual(backoff.attempts, 5)
+        backoff.reset()
+        self.assertEqual(backoff.next(), 1.)
+
+    def test_jitter(self):
+        backoff = Backoff(initial=1., maximum=8., jitter=0.5, rng=random.Random(3))
+        delays = [backoff.next() for _ in range(200)]
+        self.assertTrue(all(4. <= d <= 8. for d in delays[4:]))
+        self.assertGreater(len(set(delays)), 150)
+        with self.assertRaises(ValueError):
+            Backoff(jitter=2.)
+
+
+class FlakyBoat(FakeBoat):
+    def __init__(self, address: str, plan: dict):
+        """FakeBoat whose first link drops after plan['drop'] s, then refuses
+        the next plan['refuse'] connects and fails the next plan['fail']
+        writes (default 0), the plan is shared by every client"""
+        super().__init__(address, rate=200.)
+        self.plan = plan
+
+    async def connect(self):
+        if self.plan['drop'] is None and self.plan['refuse'] > 0:
+            self.plan['refuse'] -= 1
+            raise BleakError("Refused")
+        await super().connect()
+        if self.plan['drop'] is not None:
+            asyncio.get_running_loop().call_later(self.plan['drop'], self.emitter.cancel)
+            self.plan['drop'] = None
+
+    async def write_gatt_char(self, uuid: str, data: bytes, response: bool = False):
+        if self.plan.get('fail', 0) > 0:
+            self.plan['fail'] -= 1
+            raise BleakError("Write failed")
+        await super().write_gatt_char(uuid, data, response)
+
+
+class TestReconnect(unittest.TestCase):
+    def runLoop(self, plan: dict, presses: list[tuple[float, str]], folder: str) -> tuple[list[FlakyBoat], Backoff]:
+        "Run BT's device loop against FlakyBoats, pressing keys after each delay"
+        boats = []
+        def makeBoat(address: str) -> FlakyBoat:
+            boats.append(FlakyBoat(address, plan))
+            return boats[-1]
+        backoff = Backoff(initial=0.01, maximum=0.05, jitter=0.)
+        self.commands = commands = CommandQueue()
+
+        async def run():
+            async def press():
+                for delay, text in presses:
+                    await asyncio.sleep(delay)
+                    commands.put(text)
+            presser = asyncio.create_task(press())
+            await asyncio.wait_for(BT.runDeviceLoop('fake', None, makeBoat, folder, backoff, commands=commands), 10.)
+            await presser
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(run())
+        return boats, backoff
+
+    def test_outage(self):
+        with tempfile.TemporaryDirectory() as folder:
+            boats, backoff = self.runLoop({'drop': 0.3, 'refuse': 3}, [(0.8, 'x')], folder)
+            self.assertEqual(len(boats), 5)
+            # One recording holds every packet from before and after the outage
+            logs = [f for f in os.listdir(folder) if f.startswith('telem') and f.endswith('.bin')]
+            self.assertEqual(len(logs), 1)
+            sent = sum(boat.sent['telem'] for boat in boats)
+            self.assertGreater(boats[-1].sent['telem'], 0)
+            self.assertEqual(len(readLog(os.path.join(folder, logs[0]))), sent)
+            with open(os.path.join(folder, BT.OUTAGE_FILE)) as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(rows[0]['attempts'], '4')
+            # Waited out 0.01 + 0.02 + 0.04 s of backoff
+            self.assertGreaterEqual(float(rows[0]['reconnect_s']), 0.07)
+            self.assertGreaterEqual(float(rows[0]['gap_s']), float(rows[0]['reconnect_s']))
+            self.assertEqual(backoff.attempts, 0)
+
+    def test_exit_during_outage(self):
+        with tempfile.TemporaryDirectory() as folder:
+            boats, backoff = self.runLoop({'drop': None, 'refuse': 10**6}, [(0.05, 'f'), (0.05, 'x')], folder)
+            self.assertGreater(backoff.attempts, 1)
+            self.assertFalse(any(boat.is_connected or boat.writes for boat in boats))
+            self.assertFalse(os.path.exists(os.path.join(folder, BT.OUTAGE_FILE)))
+        # Commands not sent are still done
+        self.assertEqual(self.commands.latencies.count, 2)
+
+    def test_failed_write(self):
+        with tempfile.TemporaryDirectory() as folder:
+            boats, _ = self.runLoop({'drop': None, 'refuse': 0, 'fail': 1}, [(0.1, 'f'), (0.2, 'x')], folder)
+        # The failed write drops the link, it is done before reconnecting
+        self.assertEqual(len(boats), 2)
+        self.assertEqual(self.commands.latencies.count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+import json
+import os
+import pickle
+import struct
+import tempfile
+import unittest
+import numpy as np
+from libs.DataObject import DataObject
+from libs.TelemetryStore import TelemetryStore
+from libs.TimeIndex import TimeIndex
+from libs.StreamJoin import asofJoin
+from libs.JsonStream import iterRecords, iterChunks, readStore
+from libs.LegacyImport import loadLegacy, importDirectory, LEGACY_FOLDER
+from TestReplay import makeTelemetry
+
+
+class TestTelemetryStore(unittest.TestCase):
+    def test_data_object_api(self):
+        records = makeTelemetry(50, seed=20)
+        data = DataObject(records)
+        self.assertEqual(len(data), 50)
+        self.assertEqual(data['gpsX'].tolist(), [r['gpsX'] for r in records])
+        self.assertEqual(data.at(7), records[7])
+        self.assertEqual(data.toRecords(), records)
+        # Columns are not copied
+        self.assertIs(data['rz'], data['rz'])
+
+    def test_slice(self):
+        data = DataObject(makeTelemetry(50, seed=21))
+        part = data[10:20]
+        self.assertEqual(len(part), 10)
+        self.assertTrue(np.shares_memory(part['gpsY'], data['gpsY']))
+        self.assertEqual(part.at(0), data.at(10))
+
+    def test_missing_fields(self):
+        data = DataObject([{'a': 1., 'b': 2.}, {'a': 3., 'c': 4}])
+        self.assertEqual(data.fields, ['a', 'b', 'c'])
+        self.assertTrue(np.isnan(data['b'][1]))
+        self.assertTrue(np.isnan(data['c'][0]))
+        self.assertEqual(len(DataObject([])), 0)
+        with self.assertRaises(ValueError):
+            TelemetryStore({'a': np.zeros(2), 'b': np.zeros(3)})
+
+    def test_load(self):
+        records = makeTelemetry(20, seed=22)
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'telem.json')
+            with open(filename, 'w') as f:
+                json.dump(records, f)
+            store = TelemetryStore.load(filename)
+            data = DataObject.load(filename)
+        np.testing.assert_array_equal(store['powerLeft'], [r['powerLeft'] for r in records])
+        # Class methods make the class they are called on
+        self.assertIsInstance(data, DataObject)
+        self.assertEqual(data.toRecords(), records)
+        joined = DataObject.concat([data, store])
+        self.assertIsInstance(joined, DataObject)
+        # Slices and windows keep the class too
+        self.assertIsInstance(joined[2:5], DataObject)
+        self.assertIsInstance(joined[np.array([0, 2])], DataObject)
+        self.assertIsInstance(data.window(0.5, 1.), DataObject)
+        self.assertEqual(len(joined), 40)
+
+
+class TestJsonStream(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.folder.name, 'telem.json')
+        self.records = makeTelemetry(100, seed=23)
+        with open(self.filename, 'w') as f:
+            json.dump(self.records, f, indent=1)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_records(self):
+        # Reads much smaller than a record
+        self.assertEqual(list(iterRecords(self.filename, readSize=7)), self.records)
+        self.assertEqual(list(iterRecords(self.filename)), self.records)
+
+    def test_chunks(self):
+        chunks = list(iterChunks(self.filename, chunk=30, readSize=100))
+        self.assertEqual([len(chunk) for chunk in chunks], [30, 30, 30, 10])
+        self.assertEqual(readStore(self.filename, chunk=30).toRecords(), self.records)
+
+    def test_bad_files(self):
+        for text in ('', '[{"a": 1}', '[{"a": 1}; {"a": 2}]', '{"a": 1}', '[1, 2]'):
+            with open(self.filename, 'w') as f:
+                f.write(text)
+            with self.assertRaises(ValueError):
+                list(iterRecords(self.filename, readSize=4))
+        with open(self.filename, 'w') as f:
+            f.write(' [ ] ')
+        self.assertEqual(len(readStore(self.filename)), 0)
+
+
+class TestTimeIndex(unittest.TestCase):
+    def setUp(self):
+        # 10 Hz with a 2 s gap after the fifth record
+        times = np.r_[np.arange(5) * 0.1, 2.4 + np.arange(5) * 0.1]
+        self.data = TelemetryStore({'timestamp': times, 'gpsX': np.arange(10.)})
+
+    def test_window(self):
+        part = self.data.window(0.1, 2.5)
+        self.assertEqual(part['gpsX'].tolist(), [1., 2., 3., 4., 5.])
+        self.assertTrue(np.shares_memory(part['gpsX'], self.data['gpsX']))
+        self.assertEqual(len(self.data.window(1., 2.)), 0)
+        self.assertEqual(len(self.data.window()), 10)
+
+    def test_backwards(self):
+        # Clock set back 0.25 s after the third record
+        times = np.r_[np.arange(3) * 0.1, 0.05 + np.arange(3) * 0.1]
+        data = TelemetryStore({'timestamp': times, 'gpsX': np.arange(6.)})
+        index = data.index
+        self.assertEqual(index.order.tolist(), [0, 3, 1, 4, 2, 5])
+        self.assertEqual((index.start, index.end), (0., 0.25))
+        self.assertEqual(data.window(0.05, 0.2)['gpsX'].tolist(), [3., 1., 4.])
+        np.testing.assert_allclose(data.resample(0.05)['gpsX'], [0., 3., 1., 4., 2., 5.])
+        joined = asofJoin(TelemetryStore({'timestamp': np.array([0.12, 0.3])}), data)
+        self.assertEqual(joined['right_gpsX'].tolist(), [1., 5.])
+        self.assertIsNone(TimeIndex(np.arange(3.)).order)
+
+    def test_gaps(self):
+        index = self.data.index
+        self.assertEqual(index.gaps(0.5).tolist(), [5])
+        self.assertEqual(index.segments(0.5), [slice(0, 5), slice(5, 10)])
+        self.assertAlmostEqual(index.period(), 0.1)
+
+    def test_resample(self):
+        uniform = self.data.resample(0.05, t1=0.4)
+        np.testing.assert_allclose(uniform['timestamp'], np.arange(9) * 0.05)
+        np.testing.assert_allclose(uniform['gpsX'], np.arange(9) * 0.5)
+        held = self.data.resample(0.5, method='previous', maxGap=0.5)
+        np.testing.assert_array_equal(held['gpsX'], [0., np.nan, np.nan, np.nan, np.nan, 6.])
+        nearest = self.data.index.resample(self.data['gpsX'], [0.04, 0.06, 3.], 'nearest')
+        np.testing.assert_array_equal(nearest, [0., 1., np.nan])
+
+
+class TestStreamJoin(unittest.TestCase):
+    def setUp(self):
+        self.telem = TelemetryStore({'timestamp': np.array([1.0, 1.1, 1.2, 1.3, 5.0]),
+                                     'gpsX': np.arange(5.)})
+        self.kalman = TelemetryStore({'timestamp': np.array([0.98, 1.16, 1.31]),
+                                      'heading': np.array([10., 20., 30.], np.float32)})
+
+    def test_directions(self):
+        expected = {'backward': [10., 10., 20., 20., 30.],
+                    'forward': [20., 20., 30., 30., np.nan],
+                    'nearest': [10., 20., 20., 30., 30.]}
+        for direction, headings in expected.items():
+            joined = asofJoin(self.telem, self.kalman, prefix='kalman_', direction=direction)
+            np.testing.assert_array_equal(joined['kalman_heading'], headings)
+        self.assertEqual(joined.fields, ['timestamp', 'gpsX', 'kalman_timestamp', 'kalman_heading'])
+        self.assertEqual(joined['kalman_timestamp'][1], 1.16)
+
+    def test_tolerance(self):
+        joined = asofJoin(self.telem, self.kalman, direction='nearest', tolerance=0.05)
+        np.testing.assert_array_equal(joined['right_heading'], [10., np.nan, 20., 30., np.nan])
+        with self.assertRaises(ValueError):
+            asofJoin(self.telem, self.kalman, prefix='')
+        empty = asofJoin(self.telem, self.kalman[0:0])
+        self.assertTrue(np.isnan(empty['right_heading']).all())
+
+
+class TestLegacyImport(unittest.TestCase):
+    def test_matches_struct(self):
+        filename = os.path.join(LEGACY_FOLDER, 'FriMay2612.48.312023')
+        with open(filename, 'rb') as f:
+            packets = pickle.load(f)
+        store = loadLegacy(filename)
+        self.assertEqual(len(store), len(packets))
+        for i in (0, 1, len(packets) - 1):
+            timestamp, packet = packets[i]
+            gpsX, gpsY, lat, lng, left, right, rz, ax, ay, az = struct.unpack('<ddddiiffff', packet)
+            record = store.at(i)
+            self.assertEqual(record['timestamp'], timestamp)
+            self.assertEqual((record['gpsX'], record['lat'], record['rz'], record['az']), (gpsX, lat, rz, az))
+            self.assertAlmostEqual(record['powerLeft'], (left - 1500) / 400)
+            self.assertAlmostEqual(record['powerRight'], (right - 1500) / 400)
+            self.assertEqual(record['wpDist'], 0.)
+
+    def test_directory(self):
+        with tempfile.TemporaryDirectory() as folder:
+            source = os.path.join(folder, 'old')
+            os.makedirs(source)
+            packet = struct.pack('<ddddiiffff', 1., 2., 3., 4., 1900, 1100, .5, 0., 0., 1.)
+            with open(os.path.join(source, 'good'), 'wb') as f:
+                pickle.dump([[10., bytearray(packet)], [11., bytearray(packet)]], f)
+            with open(os.path.join(source, 'short'), 'wb') as f:
+                pickle.dump([[10., bytearray(packet[:-4])]], f)
+            saved = importDirectory(source, os.path.join(folder, 'json'), workers=2)
+            self.assertEqual([os.path.basename(name) for name in saved], ['good.json'])
+            store = TelemetryStore.load(saved[0])
+        self.assertEqual(store['powerLeft'].tolist(), [1., 1.])
+        self.assertEqual(store['powerRight'].tolist(), [-1., -1.])
+        self.assertEqual(store['timestamp'].tolist(), [10., 11.])
+
+
+if __name__ == "__main__":
+    unittest.main()
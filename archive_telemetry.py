@@ -0,0 +1,23 @@
+import os
+import sys
+
+from libs.JsonStream import iterChunks
+from libs.TelemetryArchive import archiveStores, ARCHIVE_EXT, CODECS
+
+def main():
+    args = sys.argv[1:]
+    codec = 'zlib'
+    if args and args[0] in CODECS:
+        codec = args.pop(0)
+    if not args:
+        print(f"Usage: python archive_telemetry.py [{'|'.join(CODECS)}] telem.json [telem.json ...]")
+        exit()
+
+    for filename in args:
+        archive = os.path.splitext(filename)[0] + ARCHIVE_EXT
+        records = archiveStores(iterChunks(filename), archive, codec=codec)
+        ratio = os.path.getsize(filename) / os.path.getsize(archive)
+        print(f"{filename} -> {archive} ({records} records, {ratio:.1f}x smaller)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import sys
+
+from libs.BatchAnalysis import BatchAnalyser, findSessions
+from libs.KalmanFilter import KalmanFilter, PARAMS
+
+def main():
+    args = sys.argv[1:]
+    options = {}
+    while args and args[0].startswith('--'):
+        option, _, value = args.pop(0)[2:].partition('=')
+        options[option] = value
+    if len(args) < 2 or set(options) - {'params', 'workers'}:
+        print("Usage: python batch_analyse.py [--params=params.json] [--workers=N] summary.csv session|folder [...]")
+        exit()
+
+    kf = KalmanFilter()
+    if 'params' in options:
+        kf.loadParams(options['params'])
+    params = {param: getattr(kf, param) for param in PARAMS}
+    workers = int(options['workers']) if 'workers' in options else None
+
+    sessions = findSessions(args[1:])
+    analyser = BatchAnalyser(params, workers=workers)
+    analyser.run(sessions, args[0])
+    print(f"{len(sessions)} sessions, {analyser.analysed} analysed, {analyser.cached} unchanged -> {args[0]}")
+
+if __name__ == "__main__":
+    main()
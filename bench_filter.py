@@ -0,0 +1,78 @@
+import time
+import tracemalloc
+import numpy as np
+
+from libs.KalmanFilter import KalmanFilter
+from libs.BufferedKalmanFilter import BufferedKalmanFilter
+from libs.SteadyStateKalmanFilter import SteadyStateKalmanFilter
+
+# Micro benchmark of one predict/update step at the fixed Simulation dt
+
+STEPS: int = 2000
+WARMUP: int = 100
+DT: float = 0.1
+
+def makeFilter(name: str) -> KalmanFilter:
+    if name == "inverse":
+        kf = KalmanFilter()
+        kf.updateMethod = 'inverse'
+    elif name == "sequential":
+        kf = KalmanFilter()
+    elif name == "buffered":
+        kf = BufferedKalmanFilter()
+    else:
+        kf = SteadyStateKalmanFilter(warmupFixes=5)
+    return kf
+
+def records(n: int) -> list[dict[str, float]]:
+    "Gyro every record with a new gps fix every 10th, like the real telemetry"
+    rng = np.random.default_rng(0)
+    data = []
+    for i in range(n):
+        data.append({'gpsX': float(i // 10), 'gpsY': float(i // 10), 'rz': float(rng.normal(0, 10)),
+                     'powerLeft': 0.3, 'powerRight': 0.2})
+    return data
+
+def bench(name: str) -> tuple[float, float, float]:
+    """Time and measure allocations of a filter step
+    -------
+    Return us per step, peak bytes allocated during a step, bytes kept per step : tuple[float, float, float]
+    """
+    kf = makeFilter(name)
+    data = records(STEPS + WARMUP)
+    u = np.zeros((2, 1))
+
+    def step(d: dict[str, float]):
+        u[0, 0] = d['powerLeft']
+        u[1, 0] = d['powerRight']
+        kf.predict(u, DT)
+        kf.update(d)
+
+    for d in data[:WARMUP]:
+        step(d)
+    start = time.perf_counter()
+    for d in data[WARMUP:]:
+        step(d)
+    us = (time.perf_counter() - start) / STEPS * 1e6
+
+    # Peak above the start of each step is what the step had allocated at once
+    tracemalloc.start()
+    peak = 0
+    kept = tracemalloc.get_traced_memory()[0]
+    for d in data[WARMUP:]:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        step(d)
+        peak += tracemalloc.get_traced_memory()[1] - before
+    kept = tracemalloc.get_traced_memory()[0] - kept
+    tracemalloc.stop()
+    return us, peak / STEPS, kept / STEPS
+
+def main():
+    print(f"{'filter':>12} {'us/step':>10} {'peak B/step':>12} {'kept B/step':>12}")
+    for name in ("inverse", "sequential", "buffered", "steady"):
+        us, peak, kept = bench(name)
+        print(f"{name:>12} {us:>10.1f} {peak:>12.0f} {kept:>12.1f}")
+
+if __name__ == "__main__":
+    main()
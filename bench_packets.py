@@ -0,0 +1,57 @@
+import struct
+import tempfile
+import time
+import numpy as np
+
+from libs.DataRecorder import DataRecorder
+from libs.LiveState import LiveState
+from libs.PacketBuffer import PacketBuffer
+from libs.TelemetryLog import SCHEMAS
+
+# Throughput of the BLE telemetry callback path, receive to recorder queue
+# and display state, in packets per second
+
+PACKETS: int = 100000
+# Packets per display loop at a high notify rate
+BATCH: int = 10
+FIELDS: tuple[str, ...] = ('timestamp',) + SCHEMAS['telem'][1]
+
+def packets(n: int) -> list[bytes]:
+    rng = np.random.default_rng(0)
+    return [struct.pack(SCHEMAS['telem'][0], *rng.normal(size=9)) for _ in range(n)]
+
+def perPacket(payloads: list[bytes], recorder: DataRecorder, state: LiveState) -> float:
+    "Unpack, name, queue and publish every packet in the callback"
+    start = time.perf_counter()
+    for val in payloads:
+        telem = list(struct.unpack('<ddddfffff', val))
+        timestamp = time.time()
+        recorder.appendTelem(timestamp, val)
+        state.publish(arduino=dict(zip(FIELDS, [timestamp] + telem)))
+    return time.perf_counter() - start
+
+def batched(payloads: list[bytes], recorder: DataRecorder, state: LiveState) -> float:
+    "Copy into a PacketBuffer, decode, queue and publish a batch per display loop"
+    buffer = PacketBuffer('telem')
+    start = time.perf_counter()
+    for i, val in enumerate(payloads):
+        buffer.append(time.time(), val)
+        if i % BATCH == BATCH - 1:
+            records = buffer.drain()
+            recorder.appendBatch('telem', records)
+            state.publish(arduino=dict(zip(FIELDS, records[-1].tolist())))
+    return time.perf_counter() - start
+
+def main():
+    payloads = packets(PACKETS)
+    print(f"{'path':>12} {'packets/s':>12} {'us/packet':>10}")
+    for name, run in (("per packet", perPacket), ("batched", batched)):
+        with tempfile.TemporaryDirectory() as folder:
+            recorder = DataRecorder(folder, queueSize=PACKETS)
+            seconds = run(payloads, recorder, LiveState(arduino=None))
+            recorder.close()
+            assert recorder.dropped == 0
+        print(f"{name:>12} {PACKETS / seconds:>12.0f} {seconds / PACKETS * 1e6:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,38 @@
 import matplotlib.pyplot as plt
-import json
+import sys
 import numpy as np
 
-from libs.DataObject import DataObject
+from libs.JsonStream import readStore
+from libs.StreamJoin import asofJoin
+
+# Kalman packets further than this from a telemetry packet aren't matched (s)
+JOIN_TOLERANCE: float = 0.2
 
 def main():
-    with open("telemetry/telemTue_Sep_26_15.40.53_2023.json") as f:
-        telem = DataObject(json.load(f))
-    with open("telemetry/kalmanTue_Sep_26_15.40.53_2023.json") as f:
-        kalman = DataObject(json.load(f))
+    args = sys.argv
+    if len(args) != 3:
+        print("Usage: python compare_telem_kalman.py telem.json kalman.json")
+        args = [args[0], "telemetry/telemTue_Sep_26_15.40.53_2023.json",
+                "telemetry/kalmanTue_Sep_26_15.40.53_2023.json"]
+
+    telem = readStore(args[1])
+    kalman = readStore(args[2])
+    # Onboard estimate nearest each telemetry packet
+    joined = asofJoin(telem, kalman, prefix='kalman_', direction='nearest', tolerance=JOIN_TOLERANCE)
+    matched = ~np.isnan(joined['kalman_timestamp'])
+    print(f"{matched.sum()} of {len(joined)} telemetry packets matched a kalman packet")
 
+    time = joined['timestamp'] - joined.index.start
     plt.subplot(2, 1, 1)
     plt.title("Heading")
-    plt.plot(kalman["heading"])
+    plt.xlabel("Time (s)")
+    plt.plot(time, joined["kalman_heading"], label="onboard")
+    plt.legend()
     plt.subplot(2, 1, 2)
     plt.title("x y")
-    plt.plot(telem["gpsX"], telem["gpsY"])
+    plt.plot(joined["gpsX"], joined["gpsY"], label="gps")
+    plt.plot(joined["kalman_x"], joined["kalman_y"], label="onboard")
+    plt.legend()
     plt.show()
 
 if __name__ == "__main__":
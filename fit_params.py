@@ -0,0 +1,34 @@
+import os
+import sys
+
+from libs.Fit import ParameterFit, EvaluationCache, loadSession
+from libs.KalmanFilter import KalmanFilter, PARAMS, PARAMS_FILE
+
+def main():
+    args = sys.argv
+    if len(args) < 3:
+        print(f"Usage: python fit_params.py params.json telem.json [telem.json ...]"
+              f" (BT.py and Simulation use {PARAMS_FILE})")
+        exit()
+
+    params_file = args[1]
+    kf = KalmanFilter()
+    start = None
+    spread = 0.5
+    if os.path.exists(params_file):
+        # Refit starts near the last fit
+        kf.loadParams(params_file)
+        start = {param: getattr(kf, param) for param in PARAMS}
+        spread = 0.1
+
+    sessions = [loadSession(filename) for filename in args[2:]]
+    fit = ParameterFit(sessions, cache=EvaluationCache(), base=kf)
+    best = fit.fit(start, spread)
+    for param, value in best.items():
+        setattr(kf, param, value)
+    kf.showVars()
+    kf.saveParams(params_file)
+    print(f"Saved {params_file}, log likelihood {fit.bestLogLikelihood:.1f}")
+
+if __name__ == "__main__":
+    main()
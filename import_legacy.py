@@ -0,0 +1,17 @@
+import sys
+
+from libs.LegacyImport import importDirectory, LEGACY_FOLDER, IMPORT_FOLDER
+
+def main():
+    args = sys.argv
+    if len(args) > 3:
+        print("Usage: python import_legacy.py [old_telemetry folder] [json folder]")
+        exit()
+
+    source = args[1] if len(args) > 1 else LEGACY_FOLDER
+    folder = args[2] if len(args) > 2 else IMPORT_FOLDER
+    saved = importDirectory(source, folder)
+    print(f"Imported {len(saved)} sessions to {folder}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import random
+
+# First wait after a failed attempt, and the longest (s)
+BACKOFF_INITIAL: float = 0.5
+BACKOFF_MAX: float = 20.
+
+# Growth of the wait per failed attempt
+BACKOFF_FACTOR: float = 2.
+
+# Fraction of each wait taken off at random, so retries don't line up
+BACKOFF_JITTER: float = 0.5
+
+
+class Backoff:
+    def __init__(self, initial: float = BACKOFF_INITIAL, maximum: float = BACKOFF_MAX,
+                 factor: float = BACKOFF_FACTOR, jitter: float = BACKOFF_JITTER,
+                 rng: random.Random | None = None):
+        """Exponential backoff with jitter between reconnect attempts
+        -------
+        Parameters
+        initial : float
+            First wait (default BACKOFF_INITIAL)
+        maximum : float
+            Longest wait before jitter (default BACKOFF_MAX)
+        factor : float
+            Growth per attempt (default BACKOFF_FACTOR)
+        jitter : float
+            Fraction [0, 1] of the wait that is random (default BACKOFF_JITTER)
+        rng : random.Random | None
+            Random source, eg. seeded for tests
+        """
+        if not 0. <= jitter <= 1.:
+            raise ValueError("Backoff jitter must be in [0, 1]")
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.rng = rng if rng is not None else random.Random()
+        self.attempts = 0 # Failed attempts since the last reset
+
+    def next(self) -> float:
+        """Wait before the next attempt, counting a failed one
+        -------
+        Return seconds : float
+        """
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay * (1. - self.jitter * self.rng.random())
+
+    def reset(self):
+        "Connected, start from the initial wait again"
+        self.attempts = 0
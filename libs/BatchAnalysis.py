@@ -0,0 +1,260 @@
+import csv
+import hashlib
+import json
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from libs.FilterMetrics import FilterMetrics
+from libs.JsonStream import readStore
+from libs.KalmanFilter import KalmanFilter, PARAMS, paramsKey
+from libs.LegacyImport import loadLegacy
+from libs.Replay import Replay, REPLAY_COLUMNS, gpsColumns
+from libs.TelemetryArchive import Archive, ARCHIVE_MAGIC
+from libs.TelemetryLog import logToStore, LOG_MAGIC
+from libs.TelemetryStore import TelemetryStore
+from libs.TimeIndex import recordDts, DEFAULT_DT
+
+BATCH_CACHE: str = "BoatData/batch_cache.json"
+
+# Part of the cache key, bump when analyseSession changes so cached rows
+# are analysed again
+BATCH_VERSION: int = 2
+
+# Longer than this between gps fixes is a dropout (s)
+DROPOUT_SECONDS: float = 2.
+
+# Fixes closer than this to the last (m) give no useful course, same as the
+# filter's gps angle noise cut off
+MIN_COURSE_DIST: float = 0.5
+
+# Columns of the summary table
+SUMMARY_FIELDS: tuple[str, ...] = (
+    'session', 'records', 'duration_s', 'distance_m', 'gps_fixes', 'gps_rate_hz',
+    'gps_dropouts', 'gps_dropout_frac', 'gps_nis_mean', 'gps_nis_over95', 'gyro_nis_mean',
+    'heading_err_mean_deg', 'heading_err_rms_deg', 'error', 'hash')
+
+HASH_BLOCK: int = 1 << 20
+
+
+def fileHash(filename: str) -> str:
+    "sha1 of the file contents, read a block at a time"
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while block := f.read(HASH_BLOCK):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sessionFormat(filename: str) -> str | None:
+    """Telemetry format from the start of a file
+    -------
+    Parameters
+    filename : str
+        File to check
+    -------
+    Return 'archive', 'log', 'legacy', 'json' or None : str | None
+    """
+    with open(filename, 'rb') as f:
+        start = f.read(64)
+    if start.startswith(ARCHIVE_MAGIC):
+        return 'archive'
+    if start.startswith(LOG_MAGIC):
+        return 'log'
+    if start.startswith(b'\x80'): # Pickle protocol 2+
+        return 'legacy'
+    if start.lstrip().startswith(b'['):
+        return 'json'
+    return None
+
+
+def loadTelemetry(filename: str) -> TelemetryStore:
+    """Load json, an archive, a binary log or a legacy pickle
+    -------
+    Parameters
+    filename : str
+        Telemetry file
+    """
+    kind = sessionFormat(filename)
+    if kind == 'archive':
+        archive = Archive(filename)
+        store = archive.toStore()
+        archive.close()
+        return store
+    if kind == 'log':
+        return logToStore(filename)
+    if kind == 'legacy':
+        return loadLegacy(filename)
+    if kind == 'json':
+        return readStore(filename)
+    raise ValueError("not a telemetry file")
+
+
+def findSessions(paths: list[str]) -> list[str]:
+    """Expand folders to the telemetry files in them
+    -------
+    Parameters
+    paths : list[str]
+        Files and folders
+    -------
+    Return files : list[str]
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                found = (os.path.join(root, name) for name in sorted(names))
+                files.extend(file for file in found if sessionFormat(file) is not None)
+        else:
+            files.append(path)
+    return files
+
+
+def analyseSession(filename: str, params: dict[str, float]) -> dict[str, float]:
+    """Replay the filter over a session and summarise it, stepping the
+    real time between records like Simulation.run
+    -------
+    Parameters
+    filename : str
+        Telemetry file
+    params : dict[str, float]
+        KalmanFilter parameters
+    -------
+    Return row of SUMMARY_FIELDS (without session and hash) : dict[str, float]
+    """
+    data = loadTelemetry(filename)
+    missing = [col for col in REPLAY_COLUMNS if col not in data]
+    if missing:
+        raise ValueError(f"not telemetry, no {', '.join(missing)}")
+    n = len(data)
+    if n == 0:
+        raise ValueError("no records")
+    columns = [np.asarray(data[col], dtype=np.float64) for col in REPLAY_COLUMNS]
+    times = data['timestamp'] if 'timestamp' in data else DEFAULT_DT*np.arange(n)
+
+    kf = KalmanFilter()
+    for param, value in params.items():
+        setattr(kf, param, value)
+    kf.metrics = FilterMetrics()
+    replay = Replay(kf, DEFAULT_DT)
+    replay.run(*columns, dts=recordDts(times))
+    metrics = kf.metrics.summary()
+
+    updated, dist, course = gpsColumns(columns[0], columns[1])
+    fixTimes = times[updated]
+    fixGaps = np.diff(fixTimes)
+    duration = float(times[-1] - times[0])
+    dropouts = fixGaps[fixGaps > DROPOUT_SECONDS]
+
+    # Heading after each moving fix against the course made good
+    moving = updated & (dist > MIN_COURSE_DIST)
+    error = (replay.states[moving, 4] - course[moving] + 180.) % 360. - 180.
+    nan = float('nan')
+    return {
+        'records': n,
+        'duration_s': duration,
+        'distance_m': float(dist[updated].sum()),
+        'gps_fixes': int(updated.sum()),
+        'gps_rate_hz': len(fixTimes) / duration if duration > 0 else nan,
+        'gps_dropouts': len(dropouts),
+        'gps_dropout_frac': float(dropouts.sum()) / duration if duration > 0 else nan,
+        'gps_nis_mean': metrics['gps.nis_mean'],
+        'gps_nis_over95': metrics['gps.nis_over95'],
+        'gyro_nis_mean': metrics['gyro.nis_mean'],
+        'heading_err_mean_deg': float(np.mean(np.abs(error))) if len(error) else nan,
+        'heading_err_rms_deg': float(np.sqrt(np.mean(error**2))) if len(error) else nan,
+        'error': '',
+    }
+
+
+def analyseWorker(filename: str, params: dict[str, float]) -> dict[str, float]:
+    "Pool task, failures become the row's error"
+    try:
+        return analyseSession(filename, params)
+    except (ValueError, KeyError, OSError, EOFError) as e:
+        return {'error': str(e)}
+
+
+class BatchAnalyser:
+    def __init__(self, params: dict[str, float] | None = None, cacheFile: str | None = BATCH_CACHE,
+                 workers: int | None = None):
+        """Headless filter replay and statistics over many sessions
+        Sessions unchanged since the last run (same contents and filter
+        parameters) are taken from the cache
+        -------
+        Parameters
+        params : dict[str, float] | None
+            KalmanFilter parameters (default the filter defaults)
+        cacheFile : str | None
+            Json file of earlier results, None keeps them in memory
+            (default BATCH_CACHE)
+        workers : int | None
+            Worker processes (default cpu count)
+        """
+        if params is None:
+            kf = KalmanFilter()
+            params = {param: getattr(kf, param) for param in PARAMS}
+        self.params = params
+        self.key = f"{paramsKey(params)}:v{BATCH_VERSION}"
+        self.cacheFile = cacheFile
+        self.workers = workers
+        self.cache: dict[str, dict] = {}
+        if cacheFile is not None and os.path.exists(cacheFile):
+            with open(cacheFile, 'r') as f:
+                self.cache = json.load(f)
+        self.analysed = 0
+        self.cached = 0
+
+    def saveCache(self):
+        if self.cacheFile is None:
+            return
+        folder = os.path.dirname(self.cacheFile)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(self.cacheFile, 'w') as f:
+            json.dump(self.cache, f)
+
+    def run(self, filenames: list[str], summaryFile: str) -> list[dict]:
+        """Analyse sessions in parallel, each row is written to the summary
+        csv as it finishes
+        -------
+        Parameters
+        filenames : list[str]
+            Session files
+        summaryFile : str
+            Csv of SUMMARY_FIELDS, overwritten
+        -------
+        Return rows in finishing order : list[dict]
+        """
+        rows = []
+        with open(summaryFile, 'w', newline='') as f:
+            writer = csv.DictWriter(f, SUMMARY_FIELDS)
+            writer.writeheader()
+
+            def emit(row: dict):
+                writer.writerow(row)
+                f.flush()
+                rows.append(row)
+                status = row['error'] or f"{row['distance_m']:.0f} m, gps NIS {row['gps_nis_mean']:.2f}"
+                print(f"{row['session']}: {status}")
+
+            pending = {}
+            for filename in filenames:
+                key = f"{fileHash(filename)}:{self.key}"
+                if key in self.cache:
+                    self.cached += 1
+                    emit({**self.cache[key], 'session': filename, 'hash': key})
+                else:
+                    pending[filename] = key
+
+            with ProcessPoolExecutor(self.workers) as pool:
+                futures = {pool.submit(analyseWorker, filename, self.params): filename for filename in pending}
+                for future in as_completed(futures):
+                    filename = futures[future]
+                    result = dict.fromkeys(SUMMARY_FIELDS, '') | future.result()
+                    self.cache[pending[filename]] = {field: result[field] for field in SUMMARY_FIELDS
+                                                     if field not in ('session', 'hash')}
+                    self.analysed += 1
+                    emit({**result, 'session': filename, 'hash': pending[filename]})
+        self.saveCache()
+        return rows
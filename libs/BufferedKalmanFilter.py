@@ -0,0 +1,162 @@
+import functools
+import math
+import time
+import numpy as np
+from libs.KalmanFilter import KalmanFilter
+
+
+@functools.lru_cache(maxsize=8)
+def transitionMatrices(dt: float, b1: float, b2: float) -> tuple[np.ndarray, np.ndarray]:
+    """Memoised F and its contiguous transpose, both read only
+    -------
+    Parameters
+    dt : float
+        Delta time
+    b1 : float
+        Drag on water
+    b2 : float
+        Rotational drag
+    -------
+    Return F, F' : tuple[np.ndarray, np.ndarray]
+    """
+    F = np.array([[1., 0., dt, 0., 0., 0.],
+                  [0., 1., 0., dt, 0., 0.],
+                  [0., 0., 1.-dt*b1, 0., 0., 0.],
+                  [0., 0., 0., 1.-dt*b1, 0., 0.],
+                  [0., 0., 0., 0., 1., dt],
+                  [0., 0., 0., 0., 0., 1-dt*b2]], dtype=np.float64)
+    Ft = np.ascontiguousarray(F.T)
+    F.flags.writeable = False
+    Ft.flags.writeable = False
+    return F, Ft
+
+
+class BufferedKalmanFilter(KalmanFilter):
+    """KalmanFilter that updates x and P in place through preallocated
+    work buffers, so a fixed dt step with the 'sequential' update method
+    allocates no new arrays. It isn't allocation free, the python floats,
+    the transitionMatrices cache key and update's gps Point are still
+    made each step (about 220 B peak in bench_filter.py), but that is
+    bounded and freed by the end of the step
+
+    Only np.dot and same shape ufuncs with out= are used, matmul and
+    broadcasting ufuncs allocate iterator buffers even with out=
+
+    NOTE: x and P are the same objects between steps, copy them to keep a
+    history
+    """
+
+    def reset(self):
+        """Set all states to initial defaults and allocate work buffers"""
+        super().reset()
+        self._Fx = np.zeros((6, 1))
+        self._Bu = np.zeros((6, 1))
+        self._FP = np.zeros((6, 6))
+        self._outer = np.zeros((6, 6))
+        self._scale = np.zeros((6, 6))
+        self._col = np.zeros(6)
+        self._row = np.zeros(6)
+        self._k = np.zeros(6)
+        self._ky = np.zeros(6)
+        self._fill = np.zeros(6)
+        # Fixed row/column views of the vectors for outer products
+        self._kCol = self._k.reshape(6, 1)
+        self._kRow = self._k.reshape(1, 6)
+        self._colCol = self._col.reshape(6, 1)
+        self._colRow = self._col.reshape(1, 6)
+        self._rowRow = self._row.reshape(1, 6)
+        self.bind()
+
+    def bind(self):
+        """Make views onto x and P, needed again if they are replaced"""
+        self._boundX = self.x
+        self._boundP = self.P
+        self._xv = self.x[:, 0]
+        self._pCols = [self.P[:, i] for i in range(6)]
+        self._pRows = [self.P[i] for i in range(6)]
+
+    def checkBound(self):
+        "Rebind if x or P were assigned new arrays"
+        if self.x is not self._boundX or self.P is not self._boundP:
+            self.bind()
+
+    def transition(self, dt: float) -> np.ndarray:
+        """Memoised state transition matrix (read only)
+        --------
+        Parameters
+        dt : float
+            Delta time
+        -------
+        Return F : np.ndarray
+        """
+        return transitionMatrices(dt, self.b1, self.b2)[0]
+
+    def predict(self, u: np.ndarray, dt: float):
+        """ Kalman filter predict cycle, in place
+        Parameters
+        --------
+        u : np.ndarry
+            Input (motor) matrix
+        dt : float
+            Delta time
+        """
+        if self.metrics is not None:
+            start = time.perf_counter()
+        self.checkBound()
+        F, Ft = transitionMatrices(dt, self.b1, self.b2)
+
+        theta_r = math.radians(self.x[4, 0]) # Heading
+        B = self.B
+        B[2, 0] = B[2, 1] = self.motorForce*dt*math.sin(theta_r)
+        B[3, 0] = B[3, 1] = self.motorForce*dt*math.cos(theta_r)
+        B[5, 0] = self.motorTorque*dt
+        B[5, 1] = -self.motorTorque*dt
+
+        np.dot(F, self.x, out=self._Fx)
+        np.dot(B, u, out=self._Bu)
+        np.add(self._Fx, self._Bu, out=self.x)
+        np.dot(F, self.P, out=self._FP)
+        np.dot(self._FP, Ft, out=self.P)
+        np.add(self.P, self.Q, out=self.P)
+        self.wrapTheta()
+        if self.metrics is not None:
+            self.metrics.recordPredict(time.perf_counter() - start, dt)
+
+    def scalarUpdate(self, state: int, y: float, r: float) -> float:
+        """Update with one direct measurement of a state, in place
+        --------
+        Parameters
+        state : int
+            Index of the measured state (H is a unit row)
+        y : float
+            Innovation
+        r : float
+            Measurement noise variance
+        -------
+        Return innovation variance s : float
+        """
+        self.checkBound()
+        P = self.P
+        np.copyto(self._col, self._pCols[state])
+        s = self._col[state] + r
+        self._fill.fill(s)
+        np.divide(self._col, self._fill, out=self._k)
+        self._fill.fill(y)
+        np.multiply(self._k, self._fill, out=self._ky)
+        np.add(self._xv, self._ky, out=self._xv)
+        if self.josephForm:
+            # (I - kh)P(I - kh)' + krk'
+            np.dot(self._kCol, self._colRow, out=self._outer)
+            np.subtract(P, self._outer, out=P)
+            np.dot(self._colCol, self._kRow, out=self._outer)
+            np.subtract(P, self._outer, out=P)
+            np.dot(self._kCol, self._kRow, out=self._outer)
+            self._scale.fill(s)
+            np.multiply(self._outer, self._scale, out=self._outer)
+            np.add(P, self._outer, out=P)
+        else:
+            # (I - kh)P
+            np.copyto(self._row, self._pRows[state])
+            np.dot(self._kCol, self._rowRow, out=self._outer)
+            np.subtract(P, self._outer, out=P)
+        return s
@@ -0,0 +1,134 @@
+import asyncio
+import collections
+import threading
+import time
+import numpy as np
+from libs.RingBuffer import RingBuffer
+
+# Commands waiting to be written, key presses past this are refused
+COMMAND_QUEUE_SIZE: int = 32
+
+# Drive keys (the arrows), a held key is one command until it is written
+DRIVE_COMMANDS: frozenset[str] = frozenset(('f', 'b', 'l', 'r'))
+
+# Key press to write latencies kept for the report
+LATENCY_CAPACITY: int = 1024
+
+
+class Command:
+    def __init__(self, text: str):
+        """A key press waiting to be written to the boat
+        -------
+        Parameters
+        text : str
+            Command, eg. a KEY_CODES value
+        """
+        self.text = text
+        self.pressed = time.perf_counter()
+        self.written: float | None = None
+        self.presses = 1 # Presses coalesced into this command
+
+    @property
+    def latency(self) -> float | None:
+        "Seconds from key press to the write completing, None until written"
+        return None if self.written is None else self.written - self.pressed
+
+
+class CommandQueue:
+    def __init__(self, size: int = COMMAND_QUEUE_SIZE, drive: frozenset[str] = DRIVE_COMMANDS,
+                 capacity: int = LATENCY_CAPACITY):
+        """Bounded queue of commands from the display to the device loop
+        Commands are put from any thread and taken on the device loop's
+        asyncio loop
+        A command repeated while the last one is still waiting is merged
+        into it if it is a drive command, otherwise presses are queued in
+        order. A full queue refuses presses, it never drops queued ones
+        -------
+        Parameters
+        size : int
+            Commands waiting at most (default COMMAND_QUEUE_SIZE)
+        drive : frozenset[str]
+            Commands that are coalesced (default DRIVE_COMMANDS)
+        capacity : int
+            Latencies kept (default LATENCY_CAPACITY)
+        """
+        if size < 1:
+            raise ValueError("CommandQueue size must be at least 1")
+        self.size = size
+        self.drive = drive
+        self.pending: collections.deque[Command] = collections.deque()
+        self.ready = asyncio.Event()
+        self.lock = threading.Lock()
+        self.loop: asyncio.AbstractEventLoop | None = None # Set by the first get
+        self.latencies = RingBuffer(capacity)
+        self.coalesced = 0
+        self.refused = 0
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def isDrive(self, command: Command) -> bool:
+        return command.text in self.drive
+
+    def put(self, text: str) -> bool:
+        """Queue a key press without waiting
+        -------
+        Parameters
+        text : str
+            Command to write
+        -------
+        Return whether it was queued or merged, False if the queue is full : bool
+        """
+        with self.lock:
+            if self.pending and self.pending[-1].text == text and text in self.drive:
+                self.pending[-1].presses += 1
+                self.coalesced += 1
+                return True
+            if len(self.pending) >= self.size:
+                self.refused += 1
+                return False
+            self.pending.append(Command(text))
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self.loop is None or self.loop is running:
+            self.ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self.ready.set)
+        return True
+
+    async def get(self, timeout: float | None = None) -> Command | None:
+        """Oldest waiting command, waking as soon as one is queued
+        -------
+        Parameters
+        timeout : float | None
+            Longest wait, None waits for a command
+        -------
+        Return command, None if none came : Command | None
+        """
+        self.loop = asyncio.get_running_loop()
+        if not self.pending:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        with self.lock:
+            # A wake up from another thread can arrive after its command was taken
+            return self.pending.popleft() if self.pending else None
+
+    def done(self, command: Command):
+        "Mark a command written or given up on, recording its latency"
+        command.written = time.perf_counter()
+        self.latencies.append(command.latency)
+
+    def report(self) -> str:
+        "Key press to write latency summary"
+        latencies = self.latencies.toArray() * 1000.
+        lines = [f"Commands written: {self.latencies.count}, coalesced presses: {self.coalesced},"
+                 f" refused (queue full): {self.refused}"]
+        if len(latencies):
+            lines.append(f"Latency ms  median {np.median(latencies):.1f}"
+                         f"  p95 {np.percentile(latencies, 95):.1f}  max {latencies.max():.1f}")
+        return "\n".join(lines)
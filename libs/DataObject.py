@@ -1,35 +1,15 @@
-class DataObject:
-    def __init__(self, json_data: list[dict[str, float]]):
-        """Create data object from serialised data
-        ------
-        Parameters
-        json_data : list[dict[str, float]]
-            List of timestamped dict telemetry
-        """
-        self.data = json_data
+import numpy as np
+from libs.TelemetryStore import TelemetryStore, columnsFromRecords
 
-    def __getitem__(self, item: str) -> list[float]:
-        """Allows dict-like referenceing
-        ------
-        Return list of data : list[float]"""
-        arr = []
-        for pt in self.data:
-            arr.append(pt[item])
-        return arr
 
-    def at(self, idx: int) -> dict[str, float]:
-        """Get all data as dictionary at index
-        -------
-        Parameters
-        idx : int
-            Index to view raw telemetry
-        """
-        return self.data[idx]
-
-
-    def __len__(self):
-        """Allows for length checking len(DataObject)
+class DataObject(TelemetryStore):
+    def __init__(self, json_data: list[dict[str, float]] | dict[str, np.ndarray]):
+        """Create data object from serialised data
+        Stored as numpy columns, data["gpsX"] is an array view
         ------
-        Return length of telemetry : int
+        Parameters
+        json_data : list[dict[str, float]] | dict[str, np.ndarray]
+            List of timestamped dict telemetry, or columns by field name
+            (as the TelemetryStore class methods pass)
         """
-        return len(self.data)
+        super().__init__(json_data if isinstance(json_data, dict) else columnsFromRecords(json_data))
@@ -0,0 +1,248 @@
+import os
+import queue
+import threading
+import time
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from libs.TelemetryLog import LogWriter, logToJson, LOG_EXT
+
+RECORD_FOLDER: str = "BoatData/telemetry"
+
+# Packets waiting for the writer thread, more than this are dropped
+QUEUE_SIZE: int = 10000
+
+# Flush to disk after this many records or seconds, whichever comes first
+FLUSH_RECORDS: int = 100
+FLUSH_SECONDS: float = 1.
+
+# Start new logs after this many bytes or seconds
+ROTATE_BYTES: int = 8 << 20
+ROTATE_SECONDS: float = 3600.
+
+# Longest the writer waits for a packet before checking flush and rotation
+WRITER_POLL: float = 0.1
+
+STREAMS: tuple[str, ...] = ('telem', 'kalman')
+
+
+class DataRecorder:
+    def __init__(self, folder: str = RECORD_FOLDER, flushRecords: int = FLUSH_RECORDS,
+                 flushSeconds: float = FLUSH_SECONDS, rotateBytes: int = ROTATE_BYTES,
+                 rotateSeconds: float = ROTATE_SECONDS, queueSize: int = QUEUE_SIZE):
+        """Streams telemetry and kalman packets to binary logs (see
+        TelemetryLog) from a background writer thread
+        Appending never blocks, packets are dropped (and counted) if the
+        writer falls more than queueSize behind
+        -------
+        Parameters
+        folder : str
+            Folder for the logs and saved json (default RECORD_FOLDER)
+        flushRecords : int
+            Records per flush (default FLUSH_RECORDS)
+        flushSeconds : float
+            Longest time between flushes (default FLUSH_SECONDS)
+        rotateBytes : int
+            Log size to start new logs at (default ROTATE_BYTES)
+        rotateSeconds : float
+            Log age to start new logs at (default ROTATE_SECONDS)
+        queueSize : int
+            Packets buffered for the writer (default QUEUE_SIZE)
+        """
+        self.folder = folder
+        self.flushRecords = flushRecords
+        self.flushSeconds = flushSeconds
+        self.rotateBytes = rotateBytes
+        self.rotateSeconds = rotateSeconds
+        self.dropped = 0 # Counted by the appending threads and the writer
+        self.dropLock = threading.Lock()
+        self.stopped = threading.Event()
+        self.queue: queue.Queue = queue.Queue(queueSize)
+        self.saveRequests: queue.SimpleQueue = queue.SimpleQueue()
+        self.unsaved: list[dict[str, str]] = [] # Closed logs not exported yet
+        self.exporter = ThreadPoolExecutor(1)
+        self.open()
+        self.writer = threading.Thread(target=self.run, name="DataRecorder", daemon=True)
+        self.writer.start()
+
+    def logName(self, prefix: str) -> str:
+        "New log filename from the time, not reusing an existing one"
+        stamp = time.asctime().replace(':','.').replace(' ','_')
+        filename = os.path.join(self.folder, prefix + stamp + LOG_EXT)
+        i = 1
+        while os.path.exists(filename):
+            filename = os.path.join(self.folder, f"{prefix}{stamp}_{i}{LOG_EXT}")
+            i += 1
+        return filename
+
+    def open(self):
+        "Start new log files"
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.logs = {stream: LogWriter(self.logName(stream), stream) for stream in STREAMS}
+        self.opened = time.monotonic()
+
+    def closeLogs(self):
+        "Close the current logs, keeping them for the next export unless empty"
+        for log in self.logs.values():
+            log.close()
+        if any(log.records for log in self.logs.values()):
+            self.unsaved.append({stream: log.filename for stream, log in self.logs.items()})
+
+    def rotate(self):
+        "Close the current logs and start new ones"
+        self.closeLogs()
+        self.open()
+
+    def flush(self):
+        for log in self.logs.values():
+            log.flush()
+
+    def appendTelem(self, timestamp: float, payload: bytes):
+        """Queue a telemetry packet
+        -------
+        Parameters
+        timestamp : float
+            Host receive time
+        payload : bytes
+            Raw '<ddddfffff' packet
+        """
+        try:
+            self.queue.put_nowait(('telem', timestamp, bytes(payload)))
+        except queue.Full:
+            self.drop(1)
+
+    def appendKalman(self, timestamp: float, payload: bytes):
+        """Queue a kalman filter packet
+        -------
+        Parameters
+        timestamp : float
+            Host receive time
+        payload : bytes
+            Raw '<ffffff' packet
+        """
+        try:
+            self.queue.put_nowait(('kalman', timestamp, bytes(payload)))
+        except queue.Full:
+            self.drop(1)
+
+    def appendBatch(self, stream: str, records: np.ndarray):
+        """Queue a batch of packets, eg. from PacketBuffer.drain
+        -------
+        Parameters
+        stream : str
+            One of STREAMS
+        records : np.ndarray
+            (N,) log records of the stream
+        """
+        if len(records) == 0:
+            return
+        try:
+            self.queue.put_nowait((stream, records))
+        except queue.Full:
+            self.drop(len(records))
+
+    def drop(self, n: int):
+        "Count packets that won't be recorded"
+        with self.dropLock:
+            self.dropped += n
+
+    def save(self) -> Future:
+        """Save everything received since the last save as json next to
+        the logs, without waiting. New logs are started
+        -------
+        Return future of the json files written : Future
+        """
+        future: Future = Future()
+        self.saveRequests.put(future)
+        return future
+
+    def export(self, logs: list[dict[str, str]]) -> list[str]:
+        "Write json for closed logs, runs on the exporter"
+        saved = []
+        for pair in logs:
+            for stream in STREAMS:
+                filename = os.path.splitext(pair[stream])[0] + ".json"
+                records = logToJson(pair[stream], filename)
+                print(f'Saved {stream} file of length', records)
+                saved.append(filename)
+        return saved
+
+    def run(self):
+        "Writer thread, batches queued packets into the logs"
+        pending = 0
+        lastFlush = time.monotonic()
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=WRITER_POLL)
+            except queue.Empty:
+                item = None
+            if item is not None: # None only wakes the writer
+                pending += self.write(item)
+            # Everything queued before close is written
+            stopping = self.stopped.is_set() and self.queue.empty()
+
+            now = time.monotonic()
+            if pending and (stopping or pending >= self.flushRecords or now - lastFlush >= self.flushSeconds):
+                self.flush()
+                pending = 0
+                lastFlush = now
+            if (now - self.opened >= self.rotateSeconds
+                    or any(log.size >= self.rotateBytes for log in self.logs.values())):
+                self.rotate()
+            while not self.saveRequests.empty():
+                self.startExport(self.saveRequests.get())
+
+    def write(self, item: tuple) -> int:
+        """Write a queued packet or batch, without flushing
+        -------
+        Return records written : int
+        """
+        batch = len(item) == 2 # (stream, records) or (stream, timestamp, payload)
+        n = len(item[1]) if batch else 1
+        try:
+            if batch:
+                self.logs[item[0]].appendRecords(item[1], flush=False)
+            else:
+                self.logs[item[0]].append(item[1], item[2], flush=False)
+        except ValueError as e:
+            print(e)
+            self.drop(n)
+            return 0
+        return n
+
+    def startExport(self, future: Future):
+        "Rotate and export everything unsaved on the exporter, resolving future"
+        # Packets queued before the save belong in it
+        for _ in range(self.queue.qsize()):
+            item = self.queue.get_nowait()
+            if item is not None:
+                self.write(item)
+        self.rotate()
+        logs, self.unsaved = self.unsaved, []
+
+        def done(export: Future):
+            if export.exception() is not None:
+                future.set_exception(export.exception())
+            else:
+                future.set_result(export.result())
+        self.exporter.submit(self.export, logs).add_done_callback(done)
+
+    def close(self):
+        """Write everything queued, close the logs and export every log
+        not saved yet, never waiting on a full queue"""
+        self.stopped.set()
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass # The writer is busy and sees the stop after this item
+        self.writer.join()
+        self.closeLogs()
+        logs, self.unsaved = self.unsaved, []
+        if logs:
+            export = self.exporter.submit(self.export, logs)
+            try:
+                export.result()
+            except (OSError, ValueError) as e:
+                print(f"Export failed: {e}")
+        self.exporter.shutdown(wait=True)
@@ -0,0 +1,68 @@
+import numpy as np
+from libs.RingBuffer import RingBuffer
+
+# Records kept by default, about 7 minutes of 10 Hz telemetry
+DIAGNOSTICS_CAPACITY: int = 4096
+
+# Innovation columns, nan when not measured that update
+INNOVATIONS: tuple[str, ...] = ('gpsX', 'gpsY', 'course', 'rz')
+
+NO_GPS = (np.nan, np.nan, np.nan)
+
+
+class FilterDiagnostics:
+    def __init__(self, capacity: int | None = DIAGNOSTICS_CAPACITY):
+        """Per update diagnostics of a KalmanFilter in fixed size buffers
+        so memory stays flat however long the filter runs
+        -------
+        Parameters
+        capacity : int | None
+            Updates kept, None keeps the full history for offline runs
+            (default DIAGNOSTICS_CAPACITY)
+        """
+        self.capacity = capacity
+        self.gpsUpdated = RingBuffer(capacity, dtype=bool)
+        self.innovations = RingBuffer(capacity, (len(INNOVATIONS),))
+        self.nis = RingBuffer(capacity) # Normalised innovation squared
+        self.seconds = RingBuffer(capacity) # Time spent in the update
+
+    def __len__(self) -> int:
+        return len(self.gpsUpdated)
+
+    def record(self, gps: bool, innovation: tuple[float, ...], nis: float, seconds: float):
+        """Record one update
+        -------
+        Parameters
+        gps : bool
+            Whether it was a gps update
+        innovation : tuple[float, ...]
+            Innovations in INNOVATIONS order, before the update
+        nis : float
+            y'S^-1y of the update
+        seconds : float
+            Time spent in the update
+        """
+        self.gpsUpdated.append(gps)
+        self.innovations.append(innovation)
+        self.nis.append(nis)
+        self.seconds.append(seconds)
+
+    def extendGps(self, updated):
+        """Record updates where only the gps flag is known, eg(Replay)
+        -------
+        Parameters
+        updated : array like
+            (N,) gps update flags
+        """
+        n = len(updated)
+        self.gpsUpdated.extend(updated)
+        self.innovations.extend(np.full((n, len(INNOVATIONS)), np.nan))
+        self.nis.extend(np.full(n, np.nan))
+        self.seconds.extend(np.full(n, np.nan))
+
+    def clear(self):
+        "Drop all records, keeps the capacity"
+        self.gpsUpdated.clear()
+        self.innovations.clear()
+        self.nis.clear()
+        self.seconds.clear()
@@ -0,0 +1,260 @@
+import numpy as np
+from libs.KalmanFilter import KalmanFilter, PARAMS, MAX_DT
+from libs.Replay import gpsColumns
+
+# KalmanFilter attributes that can differ between ensemble members
+ENSEMBLE_PARAMS: tuple[str, ...] = PARAMS
+
+# States seen by the gps update (x, y, theta, theta_dot)
+GPS_STATES = [0, 1, 4, 5]
+
+LOG_2PI: float = np.log(2 * np.pi)
+
+
+class EnsembleFilter:
+    def __init__(self, params: dict[str, float | list[float] | np.ndarray], base: KalmanFilter | None = None):
+        """K kalman filters with different parameters stepped together
+        -------
+        Parameters
+        params : dict[str, float | list[float] | np.ndarray]
+            Values for any of ENSEMBLE_PARAMS, one per member or a single value
+        base : KalmanFilter | None
+            Filter to take the other parameters, x, P and Q from
+            (default None, a new KalmanFilter)
+        """
+        unknown = set(params) - set(ENSEMBLE_PARAMS)
+        if unknown:
+            raise ValueError(f"Not ensemble parameters: {sorted(unknown)}")
+        if base is None:
+            base = KalmanFilter()
+
+        values = {name: np.atleast_1d(np.asarray(params.get(name, getattr(base, name)), dtype=np.float64))
+                  for name in ENSEMBLE_PARAMS}
+        self.k = max(len(v) for v in values.values())
+        for name, v in values.items():
+            setattr(self, name, np.broadcast_to(v, (self.k,)).copy())
+
+        self.x0 = base.x.copy()
+        self.P0 = base.P.copy()
+        self.Q = base.Q.copy()
+        self.reset()
+
+    @classmethod
+    def sweep(cls, param: str, values: list[float] | np.ndarray, base: KalmanFilter | None = None):
+        """Ensemble over the values of one parameter
+        -------
+        Parameters
+        param : str
+            Parameter to sweep eg(b1)
+        values : list[float] | np.ndarray
+            One value per member
+        base : KalmanFilter | None
+            Filter to take the other parameters from
+        -------
+        Return ensemble : EnsembleFilter
+        """
+        return cls({param: values}, base)
+
+    def reset(self):
+        """Set every member back to the base state and clear statistics"""
+        self.x = np.repeat(self.x0[np.newaxis], self.k, axis=0)
+        self.P = np.repeat(self.P0[np.newaxis], self.k, axis=0)
+
+        self.count = {'gps': 0, 'gyro': 0}
+        self.innovationSum = {'gps': np.zeros((self.k, 4)), 'gyro': np.zeros((self.k, 1))}
+        self.innovationSqSum = {'gps': np.zeros((self.k, 4)), 'gyro': np.zeros((self.k, 1))}
+        self.nisSum = {'gps': np.zeros(self.k), 'gyro': np.zeros(self.k)}
+        self.logLikelihood = np.zeros(self.k)
+
+    def member(self, i: int) -> dict[str, float]:
+        """Parameters of one member
+        -------
+        Parameters
+        i : int
+            Member index
+        -------
+        Return parameter values : dict[str, float]
+        """
+        return {name: float(getattr(self, name)[i]) for name in ENSEMBLE_PARAMS}
+
+    def transition(self, dt: float) -> np.ndarray:
+        """Build F for every member
+        -------
+        Parameters
+        dt : float
+            Delta time
+        -------
+        Return F : np.ndarray (K, 6, 6)
+        """
+        F = np.repeat(np.eye(6)[np.newaxis], self.k, axis=0)
+        F[:, 0, 2] = dt
+        F[:, 1, 3] = dt
+        F[:, 2, 2] = 1.-dt*self.b1
+        F[:, 3, 3] = 1.-dt*self.b1
+        F[:, 4, 5] = dt
+        F[:, 5, 5] = 1-dt*self.b2
+        return F
+
+    def wrapTheta(self):
+        """Wrap every heading to [0, 360)"""
+        theta = self.x[:, 4, 0]
+        theta[theta < 0] += 360
+        theta[theta >= 360] -= 360
+
+    def predict(self, uL: float, uR: float, F: np.ndarray, Ft: np.ndarray, dt: float):
+        """Predict cycle for all members
+        -------
+        Parameters
+        uL, uR : float
+            Left and right motor inputs
+        F, Ft : np.ndarray
+            Transition matrices from transition(dt) and their contiguous transpose
+        dt : float
+            Delta time
+        """
+        x = self.x[:, :, 0]
+        theta_r = np.deg2rad(x[:, 4])
+        bs = self.motorForce*dt*np.sin(theta_r)
+        bc = self.motorForce*dt*np.cos(theta_r)
+        mt = self.motorTorque*dt
+
+        # x = Fx + Bu written out, a batched matmul on (K, 6, 1) is mostly overhead
+        x[:, 0] += dt*x[:, 2]
+        x[:, 1] += dt*x[:, 3]
+        x[:, 4] += dt*x[:, 5]
+        x[:, 2] = F[:, 2, 2]*x[:, 2] + (bs*uL + bs*uR)
+        x[:, 3] = F[:, 3, 3]*x[:, 3] + (bc*uL + bc*uR)
+        x[:, 5] = F[:, 5, 5]*x[:, 5] + (mt*uL + -mt*uR)
+        self.P = F@self.P@Ft + self.Q
+        self.wrapTheta()
+
+    def update_gps(self, gpsX: float, gpsY: float, course: float, dist: float, rz: float):
+        """Update all members with gps and gyro, see KalmanFilter.update_gps
+        -------
+        Parameters
+        gpsX, gpsY : float
+            Gps position
+        course : float
+            Course from last gps fix (deg)
+        dist : float
+            Distance from last gps fix (m)
+        rz : float
+            Gyro rotation rate
+        """
+        y = np.array([gpsX, gpsY, course, rz]) - self.x[:, GPS_STATES, 0]
+        y[y[:, 2] > 180, 2] -= 360
+
+        PHt = self.P[:, :, GPS_STATES]
+        S = PHt[:, GPS_STATES, :].copy()
+        S[:, 0, 0] += self.gpsNoise
+        S[:, 1, 1] += self.gpsNoise
+        S[:, 2, 2] += np.maximum(0., self.gpsAngleNoise*(0.5 - dist))
+        S[:, 3, 3] += self.gyroNoise
+
+        # One solve gives S^-1 H P for the gain and S^-1 y for the NIS
+        rhs = np.concatenate((PHt.transpose(0, 2, 1), y[:, :, np.newaxis]), axis=2)
+        sol = np.linalg.solve(S, rhs)
+        K = sol[:, :, :6].transpose(0, 2, 1)
+        self.x += K@y[:, :, np.newaxis]
+        self.P -= K@PHt.transpose(0, 2, 1)
+        self.wrapTheta()
+
+        nis = np.einsum('ki,ki->k', y, sol[:, :, 6])
+        self.accumulate('gps', y, nis, np.linalg.slogdet(S)[1])
+
+    def update_nogps(self, rz: float):
+        """Update all members with gyro only, see KalmanFilter.update_nogps
+        -------
+        Parameters
+        rz : float
+            Gyro rotation rate
+        """
+        y = -rz - self.x[:, 5, 0]
+        S = self.P[:, 5, 5] + self.gyroNoise
+        K = self.P[:, :, 5] / S[:, np.newaxis]
+        self.x[:, :, 0] += K*y[:, np.newaxis]
+        self.P -= K[:, :, np.newaxis]*self.P[:, np.newaxis, 5, :]
+        self.wrapTheta()
+
+        self.accumulate('gyro', y[:, np.newaxis], y*y/S, np.log(S))
+
+    def accumulate(self, kind: str, y: np.ndarray, nis: np.ndarray, logdet: np.ndarray):
+        """Add one update to the running innovation statistics"""
+        self.count[kind] += 1
+        self.innovationSum[kind] += y
+        self.innovationSqSum[kind] += y*y
+        self.nisSum[kind] += nis
+        self.logLikelihood -= 0.5*(nis + logdet + y.shape[1]*LOG_2PI)
+
+    def run(self, gpsX, gpsY, rz, powerLeft, powerRight, dt: float = 0.1, keepStates: bool = True, dts=None):
+        """Replay the whole log through every member
+        States are left in self.states (K, N, 6) when keepStates is set
+        -------
+        Parameters
+        gpsX, gpsY, rz, powerLeft, powerRight : array like
+            Telemetry columns of equal length
+        dt : float
+            Fixed delta time between records, when there are no dts (default 0.1)
+        keepStates : bool
+            Store the state history of every member (default True)
+        dts : array like | None
+            Time since the previous record (s), eg. from TimeIndex.recordDts,
+            predicts longer than MAX_DT are split into equal steps like
+            Replay.run (default None, records are dt apart)
+        """
+        gpsX = np.asarray(gpsX, dtype=np.float64)
+        gpsY = np.asarray(gpsY, dtype=np.float64)
+        n = len(gpsX)
+        if dts is None:
+            steps = [1]*n
+            stepDts = [float(dt)]*n
+        else:
+            dts = np.asarray(dts, dtype=np.float64)
+            if len(dts) != n:
+                raise ValueError(f"EnsembleFilter has {len(dts)} delta times for {n} records")
+            counts = np.maximum(np.ceil(dts / MAX_DT), 1).astype(np.int64)
+            steps = counts.tolist()
+            stepDts = (dts / counts).tolist()
+        self.reset()
+        self.states = np.zeros((self.k, n, 6)) if keepStates else None
+        if n == 0:
+            return
+        self.gpsUpdated, dist, course = gpsColumns(gpsX, gpsY)
+
+        rz = np.asarray(rz, dtype=np.float64).tolist()
+        powerLeft = np.asarray(powerLeft, dtype=np.float64).tolist()
+        powerRight = np.asarray(powerRight, dtype=np.float64).tolist()
+        updated = self.gpsUpdated.tolist()
+        lastDt = None
+        for i in range(n):
+            # F is only rebuilt when the delta time changes
+            if stepDts[i] != lastDt:
+                lastDt = stepDts[i]
+                F = self.transition(lastDt)
+                Ft = np.ascontiguousarray(F.transpose(0, 2, 1))
+            for _ in range(steps[i]):
+                self.predict(powerLeft[i], powerRight[i], F, Ft, lastDt)
+            if updated[i]:
+                self.update_gps(gpsX[i], gpsY[i], course[i], dist[i], rz[i])
+            else:
+                self.update_nogps(rz[i])
+            if keepStates:
+                self.states[:, i] = self.x[:, :, 0]
+
+    def innovationStats(self) -> dict[str, dict[str, np.ndarray | int]]:
+        """Per member innovation statistics of the last run
+        gps innovations are (x, y, course, rz), gyro innovations are (-rz)
+        -------
+        Return {'gps' | 'gyro': {count, mean, var, nis}} : dict
+        """
+        stats = {}
+        for kind, count in self.count.items():
+            n = max(count, 1)
+            mean = self.innovationSum[kind] / n
+            stats[kind] = {
+                'count': count,
+                'mean': mean,
+                'var': self.innovationSqSum[kind] / n - mean**2,
+                'nis': self.nisSum[kind] / n,
+            }
+        return stats
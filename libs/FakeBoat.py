@@ -0,0 +1,178 @@
+import asyncio
+import struct
+import time
+import numpy as np
+from libs.Gatt import DEBUG_UUID, STATUS_UUID, CMD_UUID, COORDS_UUID, TELEMETRY_UUID, KALMAN_UUID
+from libs.RingBuffer import RingBuffer
+from libs.TelemetryLog import SCHEMAS
+from libs.TelemetryStore import TelemetryStore
+
+# Packets per second of each stream
+FAKE_RATE: float = 10.
+
+# Time between status packets (s)
+STATUS_PERIOD: float = 1.
+
+# Status bits sent, gps available and initialised (see BT.g_GPS_AVAIL)
+FAKE_STATUS: int = 0b101
+
+# Round trip of a write with response, about two connection intervals (s)
+WRITE_DELAY: float = 0.015
+
+# Longest sleep of the emitter, packets due meanwhile are sent together (s)
+EMIT_PERIOD: float = 0.001
+
+# Synthetic packets before they repeat, a 1 m/s circle
+SYNTHETIC_PACKETS: int = 1000
+
+# Delivery and callback times kept
+TIMING_CAPACITY: int = 1 << 16
+
+
+def syntheticTelemetry(n: int = SYNTHETIC_PACKETS) -> TelemetryStore:
+    "Boat driving a circle, like the real telemetry at 10 Hz"
+    t = 0.1 * np.arange(n)
+    angle = 2 * np.pi * np.arange(n) / n
+    radius = n * 0.1 / (2 * np.pi)
+    return TelemetryStore({
+        'timestamp': t,
+        'gpsX': radius * np.cos(angle), 'gpsY': radius * np.sin(angle),
+        'lat': -37.8 + np.zeros(n), 'lng': 144.9 + np.zeros(n),
+        'powerLeft': np.full(n, 0.6), 'powerRight': np.full(n, 0.4),
+        'rz': np.full(n, np.rad2deg(2 * np.pi / (n * 0.1))),
+        'wpHeading': np.rad2deg(angle) % 360., 'wpDist': np.full(n, 10.),
+    })
+
+
+def packStreams(telem: TelemetryStore) -> dict[str, list[bytes]]:
+    """Telemetry and onboard kalman packets with the boat's byte layouts,
+    the kalman state is taken from the telemetry
+    -------
+    Parameters
+    telem : TelemetryStore
+        Records to send, missing fields are sent as 0
+    -------
+    Return packets per stream : dict[str, list[bytes]]
+    """
+    n = len(telem)
+    column = lambda field: telem[field] if field in telem.fields else np.zeros(n)
+    x, y = column('gpsX'), column('gpsY')
+    dx, dy = np.zeros(n), np.zeros(n)
+    if n > 1:
+        # Over the recording's own time steps, 10 Hz without timestamps
+        t = telem['timestamp'] if 'timestamp' in telem.fields else 0.1 * np.arange(n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dx, dy = np.gradient(x, t), np.gradient(y, t)
+        # Repeated timestamps have no velocity
+        dx[~np.isfinite(dx)] = 0.
+        dy[~np.isfinite(dy)] = 0.
+    heading = np.rad2deg(np.arctan2(dx, dy)) % 360.
+    kalman = {'x': x, 'y': y, 'dx': dx, 'dy': dy, 'heading': heading, 'd_heading': column('rz')}
+    packets = {}
+    for stream, values in (('telem', {f: column(f) for f in SCHEMAS['telem'][1]}), ('kalman', kalman)):
+        fmt, fields = SCHEMAS[stream]
+        rows = np.column_stack([np.nan_to_num(values[f]) for f in fields]).tolist()
+        packets[stream] = [struct.pack(fmt, *row) for row in rows]
+    return packets
+
+
+class FakeBoat:
+    def __init__(self, address: str, rate: float = FAKE_RATE, source: TelemetryStore | None = None,
+                 statusPeriod: float = STATUS_PERIOD):
+        """Stand in for the BleakClient of a boat, so the host pipeline runs
+        without one. Telemetry and kalman packets are notified at rate from
+        the asyncio loop, like bleak does, with the real byte layouts
+        -------
+        Parameters
+        address : str
+            Ignored, as Peripheral passes it
+        rate : float
+            Packets per second of each stream (default FAKE_RATE)
+        source : TelemetryStore | None
+            Telemetry replayed in a loop, None for syntheticTelemetry
+        statusPeriod : float
+            Time between status packets (default STATUS_PERIOD)
+        """
+        self.address = address
+        self.rate = rate
+        self.statusPeriod = statusPeriod
+        self.packets = packStreams(source if source is not None else syntheticTelemetry())
+        if len(self.packets['telem']) == 0:
+            raise ValueError("FakeBoat source has no records")
+        self.callbacks = {}
+        self.emitter: asyncio.Task | None = None
+        self.sent = {'telem': 0, 'kalman': 0}
+        self.writes: list[tuple[str, bytes]] = []
+        # Due time to the callback returning, and the time in the callback
+        self.delays = RingBuffer(TIMING_CAPACITY)
+        self.callbackSeconds = RingBuffer(TIMING_CAPACITY)
+
+    @property
+    def is_connected(self) -> bool:
+        return self.emitter is not None and not self.emitter.done()
+
+    async def connect(self):
+        self.emitter = asyncio.get_running_loop().create_task(self.emit())
+
+    async def start_notify(self, uuid: str, callback):
+        self.callbacks[uuid] = callback
+
+    async def stop_notify(self, uuid: str):
+        self.callbacks.pop(uuid, None)
+
+    async def read_gatt_char(self, uuid: str) -> bytearray:
+        if uuid != STATUS_UUID:
+            raise ValueError(f"FakeBoat can't read {uuid}")
+        return bytearray(struct.pack('<I', FAKE_STATUS))
+
+    async def write_gatt_char(self, uuid: str, data: bytes, response: bool = False):
+        if uuid not in (CMD_UUID, COORDS_UUID):
+            raise ValueError(f"FakeBoat can't write {uuid}")
+        self.writes.append((uuid, bytes(data)))
+        if response:
+            await asyncio.sleep(WRITE_DELAY)
+
+    async def disconnect(self):
+        if self.emitter is not None:
+            self.emitter.cancel()
+
+    def notify(self, uuid: str, payload: bytes, due: float):
+        "Deliver a packet, timing it"
+        callback = self.callbacks.get(uuid)
+        if callback is None:
+            return
+        start = time.perf_counter()
+        callback(None, bytearray(payload))
+        end = time.perf_counter()
+        self.delays.append(end - due)
+        self.callbackSeconds.append(end - start)
+
+    async def emit(self):
+        "Send the packets due since connecting, then sleep until the next"
+        self.notify(DEBUG_UUID, b"Fake boat connected", time.perf_counter())
+        start = time.perf_counter()
+        lastStatus = start
+        n = len(self.packets['telem'])
+        while True:
+            now = time.perf_counter()
+            due = int((now - start) * self.rate) + 1 # Packet 0 is due at start
+            for i in range(self.sent['telem'], due):
+                packetTime = start + i / self.rate
+                self.notify(TELEMETRY_UUID, self.packets['telem'][i % n], packetTime)
+                self.notify(KALMAN_UUID, self.packets['kalman'][i % n], packetTime)
+            self.sent['telem'] = self.sent['kalman'] = max(due, self.sent['telem'])
+            if now - lastStatus >= self.statusPeriod:
+                lastStatus = now
+                self.notify(STATUS_UUID, struct.pack('<I', FAKE_STATUS), now)
+            await asyncio.sleep(min(EMIT_PERIOD, 1. / self.rate))
+
+    def report(self) -> str:
+        "Packets sent and notification timing"
+        delays = self.delays.toArray() * 1000.
+        seconds = self.callbackSeconds.toArray() * 1e6
+        lines = [f"Sent {self.sent['telem']} telem, {self.sent['kalman']} kalman packets"]
+        if len(delays):
+            lines.append(f"Delivery delay ms  median {np.median(delays):.2f}  p99 {np.percentile(delays, 99):.2f}"
+                         f"  max {delays.max():.2f}")
+            lines.append(f"Callback us  median {np.median(seconds):.2f}  p99 {np.percentile(seconds, 99):.2f}")
+        return "\n".join(lines)
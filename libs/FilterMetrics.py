@@ -0,0 +1,133 @@
+import csv
+import math
+from libs.Diagnostics import INNOVATIONS
+
+# Innovation channels of each update type
+CHANNELS: dict[str, tuple[str, ...]] = {'gps': INNOVATIONS, 'gyro': ('rz',)}
+
+# 95% point of chi squared with the measurement count as degrees of freedom,
+# a consistent filter has about 5% of NIS above it
+CHI2_95: dict[int, float] = {1: 3.841, 4: 9.488}
+
+
+class FilterMetrics:
+    def __init__(self):
+        """Running aggregates of KalmanFilter consistency and timing
+        Set as KalmanFilter.metrics to collect, None costs nothing
+        """
+        self.reset()
+
+    def reset(self):
+        "Zero all aggregates"
+        self.predicts = 0
+        self.predictSeconds = 0.
+        self.predictMax = 0.
+        self.elapsed = 0. # Sum of predict dt
+        self.updates = {kind: 0 for kind in CHANNELS}
+        self.updateSeconds = {kind: 0. for kind in CHANNELS}
+        self.updateMax = {kind: 0. for kind in CHANNELS}
+        self.nisSum = {kind: 0. for kind in CHANNELS}
+        self.nisOver = {kind: 0 for kind in CHANNELS} # NIS above CHI2_95
+        self.innovationSum = {kind: [0.]*len(channels) for kind, channels in CHANNELS.items()}
+        self.innovationSq = {kind: [0.]*len(channels) for kind, channels in CHANNELS.items()}
+
+    def recordPredict(self, seconds: float, dt: float):
+        """Add a predict call
+        -------
+        Parameters
+        seconds : float
+            Time spent in predict
+        dt : float
+            Delta time predicted over
+        """
+        self.predicts += 1
+        self.predictSeconds += seconds
+        if seconds > self.predictMax:
+            self.predictMax = seconds
+        self.elapsed += dt
+
+    def recordUpdate(self, kind: str, innovation, nis: float, seconds: float):
+        """Add an update call
+        -------
+        Parameters
+        kind : str
+            'gps' or 'gyro'
+        innovation : sequence[float]
+            Innovations of the CHANNELS of kind
+        nis : float
+            y'S^-1y of the update
+        seconds : float
+            Time spent in the update
+        """
+        self.updates[kind] += 1
+        self.updateSeconds[kind] += seconds
+        if seconds > self.updateMax[kind]:
+            self.updateMax[kind] = seconds
+        self.nisSum[kind] += nis
+        if nis > CHI2_95[len(CHANNELS[kind])]:
+            self.nisOver[kind] += 1
+        sums = self.innovationSum[kind]
+        sqs = self.innovationSq[kind]
+        for i, y in enumerate(innovation):
+            sums[i] += y
+            sqs[i] += y*y
+
+    def summary(self) -> dict[str, float]:
+        """Flat summary of the aggregates
+        -------
+        Return {metric: value} : dict[str, float]
+        """
+        nan = math.nan
+        total = sum(self.updates.values())
+        out = {
+            'predict.count': self.predicts,
+            'predict.us_mean': self.predictSeconds / self.predicts * 1e6 if self.predicts else nan,
+            'predict.us_max': self.predictMax * 1e6,
+            'elapsed_s': self.elapsed,
+        }
+        for kind, channels in CHANNELS.items():
+            n = self.updates[kind]
+            out[f'{kind}.count'] = n
+            out[f'{kind}.fraction'] = n / total if total else nan
+            out[f'{kind}.rate_hz'] = n / self.elapsed if self.elapsed else nan
+            out[f'{kind}.us_mean'] = self.updateSeconds[kind] / n * 1e6 if n else nan
+            out[f'{kind}.us_max'] = self.updateMax[kind] * 1e6
+            out[f'{kind}.nis_mean'] = self.nisSum[kind] / n if n else nan
+            out[f'{kind}.nis_expected'] = len(channels)
+            out[f'{kind}.nis_over95'] = self.nisOver[kind] / n if n else nan
+            for i, channel in enumerate(channels):
+                s = self.innovationSum[kind][i]
+                sq = self.innovationSq[kind][i]
+                out[f'{kind}.{channel}.mean'] = s / n if n else nan
+                out[f'{kind}.{channel}.var'] = (sq - s*s/n) / (n - 1) if n > 1 else nan
+        return out
+
+    def report(self) -> str:
+        """Compact text summary
+        -------
+        Return summary : str
+        """
+        s = self.summary()
+        lines = [f"predict {s['predict.count']:d} calls, {s['predict.us_mean']:.1f} us"
+                 f" (max {s['predict.us_max']:.1f}), {s['elapsed_s']:.1f} s"]
+        for kind, channels in CHANNELS.items():
+            lines.append(f"{kind:>7} {s[f'{kind}.count']:d} updates ({s[f'{kind}.rate_hz']:.2f} Hz),"
+                         f" {s[f'{kind}.us_mean']:.1f} us (max {s[f'{kind}.us_max']:.1f}),"
+                         f" NIS {s[f'{kind}.nis_mean']:.2f} (expect {len(channels)},"
+                         f" {100*s[f'{kind}.nis_over95']:.1f}% over 95%)")
+            for channel in channels:
+                lines.append(f"{channel:>15} mean {s[f'{kind}.{channel}.mean']:>10.4g}"
+                             f" var {s[f'{kind}.{channel}.var']:>10.4g}")
+        return '\n'.join(lines)
+
+    def toCsv(self, filename: str):
+        """Write the summary as metric,value rows
+        -------
+        Parameters
+        filename : str
+            Csv file to write
+        """
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('metric', 'value'))
+            writer.writerows(self.summary().items())
@@ -0,0 +1,278 @@
+import hashlib
+import json
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from libs.DataObject import DataObject
+from libs.Ensemble import EnsembleFilter, ENSEMBLE_PARAMS
+from libs.KalmanFilter import KalmanFilter, paramsKey
+from libs.Replay import REPLAY_COLUMNS
+from libs.TimeIndex import recordDts, DEFAULT_DT
+
+# Parameters are searched as log values snapped to this grid (~1% steps)
+# so evaluations can be reused between generations and between fits
+LOG_GRID: float = 0.01
+
+CACHE_FILE: str = "BoatData/fit_cache.json"
+
+# Sessions for the pool workers, set once by initWorker
+_sessions: list[dict[str, np.ndarray]] = []
+
+
+def loadSession(filename: str) -> dict[str, np.ndarray]:
+    """Load DataRecorder telemetry as replay columns
+    -------
+    Parameters
+    filename : str
+        Telemetry json file
+    -------
+    Return columns with 'hash' of the file contents and the time since
+    each previous record 'dts', or a fixed 'dt' without timestamps, so the
+    fit replays the sessions the way Simulation.run does : dict[str, np.ndarray]
+    """
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    data = DataObject(json.loads(raw))
+    session = {col: np.array(data[col], dtype=np.float64) for col in REPLAY_COLUMNS}
+    session['hash'] = hashlib.sha1(raw).hexdigest()
+    if 'timestamp' in data:
+        session['dts'] = recordDts(data['timestamp'])
+    else:
+        session['dt'] = DEFAULT_DT
+    return session
+
+
+def initWorker(sessions: list[dict[str, np.ndarray]]):
+    "Pool initialiser, keeps the sessions in the worker"
+    global _sessions
+    _sessions = sessions
+
+
+def evaluateChunk(session: int, params: tuple[str, ...], values: np.ndarray,
+                  base: dict[str, float] | None = None) -> np.ndarray:
+    """Innovation log-likelihood of candidates on one session
+    -------
+    Parameters
+    session : int
+        Index into the worker sessions
+    params : tuple[str, ...]
+        Names of the columns of values
+    values : np.ndarray
+        (M, len(params)) candidate parameter values
+    base : dict[str, float] | None
+        Values of the parameters not being fitted (default None, KalmanFilter's)
+    -------
+    Return log-likelihood per candidate : np.ndarray
+    """
+    columns = _sessions[session]
+    ensemble = EnsembleFilter({**(base or {}), **dict(zip(params, values.T))})
+    ensemble.run(*(columns[col] for col in REPLAY_COLUMNS), dt=columns.get('dt', DEFAULT_DT),
+                 keepStates=False, dts=columns.get('dts'))
+    return ensemble.logLikelihood
+
+
+class EvaluationCache:
+    def __init__(self, filename: str | None = CACHE_FILE):
+        """Log-likelihoods already evaluated, by session hash and grid point
+        -------
+        Parameters
+        filename : str | None
+            Json file to keep the cache in, None keeps it in memory
+        """
+        self.filename = filename
+        self.values: dict[str, dict[str, float]] = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.values = json.load(f)
+
+    def key(self, params: tuple[str, ...], grid: tuple[int, ...], base: str, dt: float | None) -> str:
+        """Key of one evaluation
+        -------
+        Parameters
+        params : tuple[str, ...]
+            Names of the fitted parameters
+        grid : tuple[int, ...]
+            Grid point of each
+        base : str
+            paramsKey of the parameters not being fitted
+        dt : float | None
+            Fixed delta time the session is replayed with, None for the
+            real record times
+        """
+        steps = 'real' if dt is None else repr(dt)
+        return f'{base},dt={steps},' + ','.join(f'{p}={g}' for p, g in sorted(zip(params, grid)))
+
+    def get(self, session: str, key: str) -> float | None:
+        return self.values.get(session, {}).get(key)
+
+    def set(self, session: str, key: str, value: float):
+        self.values.setdefault(session, {})[key] = value
+
+    def save(self):
+        "Write cache to file"
+        if self.filename is None:
+            return
+        folder = os.path.dirname(self.filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(self.filename, 'w') as f:
+            json.dump(self.values, f)
+
+
+class ParameterFit:
+    def __init__(self, sessions: list[dict[str, np.ndarray]], params: tuple[str, ...] = ENSEMBLE_PARAMS,
+                 cache: EvaluationCache | None = None, workers: int | None = None,
+                 base: KalmanFilter | None = None):
+        """Maximum likelihood fit of KalmanFilter parameters
+        Uses a cross entropy search over the log of the parameters
+        -------
+        Parameters
+        sessions : list[dict[str, np.ndarray]]
+            Sessions from loadSession
+        params : tuple[str, ...]
+            Parameters to fit (default ENSEMBLE_PARAMS)
+        cache : EvaluationCache | None
+            Evaluation cache (default None, in memory only)
+        workers : int | None
+            Worker processes, 1 evaluates in this process (default cpu count)
+        base : KalmanFilter | None
+            Filter to take the parameters not being fitted from
+            (default None, a new KalmanFilter)
+        """
+        self.sessions = sessions
+        self.params = tuple(params)
+        self.baseFilter = base if base is not None else KalmanFilter()
+        self.base = {param: float(getattr(self.baseFilter, param)) for param in ENSEMBLE_PARAMS if param not in self.params}
+        self.baseKey = paramsKey(self.base)
+        self.cache = cache if cache is not None else EvaluationCache(None)
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.evaluations = 0
+        self.cacheHits = 0
+        self.history: list[float] = []
+
+    def toGrid(self, logValues: np.ndarray) -> np.ndarray:
+        "Snap log parameter values to the integer grid"
+        return np.round(np.asarray(logValues) / LOG_GRID).astype(np.int64)
+
+    def fromGrid(self, grid: np.ndarray) -> np.ndarray:
+        "Parameter values of grid points"
+        return np.exp(np.asarray(grid) * LOG_GRID)
+
+    def evaluate(self, grid: np.ndarray, pool: ProcessPoolExecutor | None = None) -> np.ndarray:
+        """Total log-likelihood over all sessions for each grid point
+        -------
+        Parameters
+        grid : np.ndarray
+            (M, len(params)) grid points
+        pool : ProcessPoolExecutor | None
+            Pool to spread evaluations over (default None, this process)
+        -------
+        Return log-likelihood per grid point : np.ndarray
+        """
+        points = [tuple(g.tolist()) for g in grid]
+        keys = []
+        total = np.zeros(len(grid))
+        jobs = []
+        for s, session in enumerate(self.sessions):
+            dt = None if 'dts' in session else session.get('dt', DEFAULT_DT)
+            keys.append([self.cache.key(self.params, point, self.baseKey, dt) for point in points])
+            missing = []
+            for i, key in enumerate(keys[s]):
+                value = self.cache.get(session['hash'], key)
+                if value is None:
+                    missing.append(i)
+                else:
+                    total[i] += value
+                    self.cacheHits += 1
+            chunks = max(1, min(self.workers, len(missing)))
+            for chunk in np.array_split(np.array(missing, dtype=np.int64), chunks):
+                if len(chunk):
+                    jobs.append((s, chunk))
+
+        values = [self.fromGrid(grid[chunk]) for _, chunk in jobs]
+        if pool is None:
+            results = [evaluateChunk(s, self.params, v, self.base) for (s, _), v in zip(jobs, values)]
+        else:
+            futures = [pool.submit(evaluateChunk, s, self.params, v, self.base) for (s, _), v in zip(jobs, values)]
+            results = [future.result() for future in futures]
+
+        for (s, chunk), result in zip(jobs, results):
+            total[chunk] += result
+            self.evaluations += len(chunk)
+            for i, value in zip(chunk, result):
+                self.cache.set(self.sessions[s]['hash'], keys[s][i], float(value))
+        return total
+
+    def fit(self, start: dict[str, float] | None = None, spread: float = 0.5, population: int = 24,
+            elite: int = 6, generations: int = 40, patience: int = 4, tol: float = 1., seed: int = 0) -> dict[str, float]:
+        """Search for the parameters with the highest log-likelihood
+        Stops after generations, or patience generations without an
+        improvement of tol, or once the search has shrunk below the grid
+        -------
+        Parameters
+        start : dict[str, float] | None
+            Starting parameters (default None, the base filter's)
+        spread : float
+            Initial standard deviation of the log parameters (default 0.5)
+        population : int
+            Candidates per generation (default 24)
+        elite : int
+            Best candidates kept to update the search (default 6)
+        generations : int
+            Maximum generations (default 40)
+        patience : int
+            Generations without improvement before stopping (default 4)
+        tol : float
+            Log-likelihood improvement that counts (default 1.)
+        seed : int
+            Random seed (default 0)
+        -------
+        Return best parameters : dict[str, float]
+        """
+        if start is None:
+            start = {}
+        mean = np.log([float(start.get(p, getattr(self.baseFilter, p))) for p in self.params])
+        std = np.full(len(self.params), spread)
+        rng = np.random.default_rng(seed)
+
+        pool = None
+        if self.workers > 1:
+            pool = ProcessPoolExecutor(self.workers, initializer=initWorker, initargs=(self.sessions,))
+        else:
+            initWorker(self.sessions)
+
+        try:
+            best = self.toGrid(mean)
+            bestValue = self.evaluate(best[np.newaxis], pool)[0]
+            stale = 0
+            for generation in range(generations):
+                samples = mean + std*rng.standard_normal((population, len(self.params)))
+                grid = np.unique(np.vstack((self.toGrid(samples), best)), axis=0)
+                values = self.evaluate(grid, pool)
+
+                order = np.argsort(-values)
+                top = grid[order[:elite]]
+                if values[order[0]] > bestValue + tol:
+                    stale = 0
+                else:
+                    stale += 1
+                if values[order[0]] > bestValue:
+                    best = grid[order[0]]
+                    bestValue = values[order[0]]
+                self.history.append(float(bestValue))
+                print(f"Generation {generation}: log likelihood {bestValue:.1f}"
+                      f" ({self.evaluations} evaluated, {self.cacheHits} cached)")
+
+                logTop = top * LOG_GRID
+                mean = 0.7*logTop.mean(axis=0) + 0.3*mean
+                std = 0.7*logTop.std(axis=0) + 0.3*std
+                if stale >= patience or np.all(std < LOG_GRID):
+                    break
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            self.cache.save()
+
+        self.bestLogLikelihood = float(bestValue)
+        return dict(zip(self.params, self.fromGrid(best).tolist()))
@@ -0,0 +1,8 @@
+# BLE characteristics of the boat
+
+DEBUG_UUID     = "45c1eda2-4473-42a3-8143-dc79c30a64bf"
+STATUS_UUID    = "6f04c0a3-f201-4091-a13d-5ecafc3dc54b"
+CMD_UUID       = "05c6cc87-7888-4588-b794-92bdf9a29330"
+COORDS_UUID    = "3794c841-1b53-4029-aebb-12319386fd28"
+TELEMETRY_UUID = "ccc03716-4f66-4cb8-b6fd-9b2278587add"
+KALMAN_UUID    = "933963ae-cc8e-4704-bd3c-dc53721ba956"
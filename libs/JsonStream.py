@@ -0,0 +1,106 @@
+import json
+import re
+from typing import Iterator
+from libs.TelemetryStore import TelemetryStore, columnsFromRecords
+
+# Characters read from the file at a time
+READ_SIZE: int = 1 << 16
+
+# Records per TelemetryStore chunk
+CHUNK_RECORDS: int = 1024
+
+WHITESPACE = re.compile(r'\s*')
+
+
+def iterRecords(filename: str, readSize: int = READ_SIZE) -> Iterator[dict[str, float]]:
+    """Yield the records of a DataRecorder json array as they are parsed,
+    only one read of the file is held at a time
+    -------
+    Parameters
+    filename : str
+        Telemetry json file
+    readSize : int
+        Characters read at a time (default READ_SIZE)
+    """
+    decoder = json.JSONDecoder()
+    with open(filename, 'r') as f:
+        buffer = ''
+        pos = 0
+        eof = False
+        state = 'start' # start -> first -> (sep -> value)*
+        while True:
+            pos = WHITESPACE.match(buffer, pos).end()
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f"{filename} ends before the telemetry array is closed")
+                buffer = f.read(readSize)
+                eof = not buffer
+                pos = 0
+                continue
+
+            c = buffer[pos]
+            if state == 'start':
+                if c != '[':
+                    raise ValueError(f"{filename} is not a telemetry array")
+                pos += 1
+                state = 'first'
+            elif state == 'sep':
+                if c == ']':
+                    return
+                if c != ',':
+                    raise ValueError(f"{filename} has {c!r} between records")
+                pos += 1
+                state = 'value'
+            elif state == 'first' and c == ']':
+                return
+            else:
+                if c != '{':
+                    raise ValueError(f"{filename} has a record that isn't an object")
+                try:
+                    record, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    # Record runs past the buffer
+                    more = f.read(readSize)
+                    eof = not more
+                    buffer = buffer[pos:] + more
+                    pos = 0
+                    continue
+                yield record
+                state = 'sep'
+
+
+def iterChunks(filename: str, chunk: int = CHUNK_RECORDS, readSize: int = READ_SIZE) -> Iterator[TelemetryStore]:
+    """Yield a DataRecorder json file as TelemetryStores of up to chunk
+    records, memory is bounded by the chunk size
+    -------
+    Parameters
+    filename : str
+        Telemetry json file
+    chunk : int
+        Records per store (default CHUNK_RECORDS)
+    readSize : int
+        Characters read at a time (default READ_SIZE)
+    """
+    records = []
+    for record in iterRecords(filename, readSize):
+        records.append(record)
+        if len(records) == chunk:
+            yield TelemetryStore(columnsFromRecords(records))
+            records = []
+    if records:
+        yield TelemetryStore(columnsFromRecords(records))
+
+
+def readStore(filename: str, chunk: int = CHUNK_RECORDS) -> TelemetryStore:
+    """Load a DataRecorder json file without holding every record as a
+    dict, only the columns and one chunk of records
+    -------
+    Parameters
+    filename : str
+        Telemetry json file
+    chunk : int
+        Records parsed before packing into columns (default CHUNK_RECORDS)
+    """
+    return TelemetryStore.concat(iterChunks(filename, chunk))
@@ -1,9 +1,33 @@
+import hashlib
+import json
+import math
+import os
+import time
 import numpy as np
+from libs.Diagnostics import NO_GPS
 from libs.PID import PID
 from libs.Point import Point
 
 NEW_BOAT: bool = True
 
+# How measurement updates are applied
+# 'inverse'    : joint update with np.linalg.inv(S) (original)
+# 'sequential' : one scalar update per measurement, R is diagonal
+# 'cholesky'   : joint update solved through the Cholesky factor of S
+UPDATE_METHODS: tuple[str, ...] = ('inverse', 'sequential', 'cholesky')
+UPDATE_METHOD: str = 'sequential'
+
+# Tunable model parameters
+PARAMS: tuple[str, ...] = ('b1', 'b2', 'gpsNoise', 'gpsAngleNoise',
+                           'gyroNoise', 'motorForce', 'motorTorque')
+
+# Fitted parameters (from fit_params.py), loaded by the host and simulated
+# filters when the file exists
+PARAMS_FILE: str = "BoatData/params.json"
+
+# Longest single predict, the euler model is unstable past 1/b2
+MAX_DT: float = 0.2
+
 
 # Notes
 # m states
@@ -22,6 +46,12 @@ NEW_BOAT: bool = True
 # Q : m x m
 
 
+def paramsKey(params: dict[str, float]) -> str:
+    "Short key of filter parameters, results depend on them"
+    text = ','.join(f'{param}={params[param]!r}' for param in sorted(params))
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+
 class KalmanFilter():
     def __init__(self):
         """6 parameter kalman filter for boat with drift"""
@@ -44,6 +74,9 @@ class KalmanFilter():
             self.motorForce = 0.4
             self.motorTorque = 50.
 
+        self.updateMethod = UPDATE_METHOD
+        self.josephForm = False # Symmetric, positive covariance update (not for 'inverse')
+
     def reset(self):
         """Set all states to initial defaults"""
 
@@ -81,7 +114,31 @@ class KalmanFilter():
                            [1., -1.]])
 
         self.turnPid = PID(1, 0, 0.5)
-        self.gpsUpdated = [] # for visual
+        # Last gps fix seen, the next different one is a gps update
+        self.lastGPS: Point | None = None
+        # Per update diagnostics, off unless a FilterDiagnostics is set
+        # (eg. by Simulation), kept across resets
+        if getattr(self, 'diagnostics', None) is not None:
+            self.diagnostics.clear()
+        else:
+            self.diagnostics = None
+        # Running aggregates, off unless a FilterMetrics is set
+        if getattr(self, 'metrics', None) is not None:
+            self.metrics.reset()
+        else:
+            self.metrics = None
+
+    @property
+    def gpsUpdated(self):
+        "Gps update flag of each update (for visual), indexed from reset, needs diagnostics"
+        if self.diagnostics is None:
+            raise ValueError("gpsUpdated needs kf.diagnostics set")
+        return self.diagnostics.gpsUpdated
+
+    @property
+    def recording(self) -> bool:
+        "Whether updates are timed and recorded, for diagnostics or metrics"
+        return self.diagnostics is not None or self.metrics is not None
 
 
     def showVars(self):
@@ -97,6 +154,54 @@ class KalmanFilter():
         """)
 
 
+    def loadParams(self, filename: str):
+        """Load model parameters eg(from fit_params.py), keys other than
+        PARAMS are skipped so the file can't replace filter state
+        -------
+        Parameters
+        filename : str
+            Json file of {param: value}
+        """
+        with open(filename, 'r') as f:
+            params: dict[str, float] = json.load(f)
+        for param, value in params.items():
+            if param not in PARAMS:
+                print(f"Invalid param: {param}")
+                continue
+            setattr(self, param, float(value))
+
+    def saveParams(self, filename: str, params: tuple[str, ...] = PARAMS):
+        """Save model parameters to json
+        -------
+        Parameters
+        filename : str
+            Json file to write
+        params : tuple[str, ...]
+            Parameters to save (default PARAMS)
+        """
+        folder = os.path.dirname(filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(filename, 'w') as f:
+            json.dump({param: getattr(self, param) for param in params}, f, indent=4)
+
+
+    def transition(self, dt: float) -> np.ndarray:
+        """State transition matrix
+        --------
+        Parameters
+        dt : float
+            Delta time
+        -------
+        Return F : np.ndarray
+        """
+        return np.array([[1., 0., dt, 0., 0., 0.],
+                         [0., 1., 0., dt, 0., 0.],
+                         [0., 0., 1.-dt*self.b1, 0., 0., 0.],
+                         [0., 0., 0., 1.-dt*self.b1, 0., 0.],
+                         [0., 0., 0., 0., 1., dt],
+                         [0., 0., 0., 0., 0., 1-dt*self.b2]], dtype=np.float64)
+
     def predict(self, u: np.ndarray, dt: float):
         """ Kalman filter predit cycle
         Parameters
@@ -106,12 +211,9 @@ class KalmanFilter():
         dt : float
             Delta time
         """
-        F = np.array([[1., 0., dt, 0., 0., 0.],
-                      [0., 1., 0., dt, 0., 0.],
-                      [0., 0., 1.-dt*self.b1, 0., 0., 0.],
-                      [0., 0., 0., 1.-dt*self.b1, 0., 0.],
-                      [0., 0., 0., 0., 1., dt],
-                      [0., 0., 0., 0., 0., 1-dt*self.b2]], dtype=np.float64)
+        if self.metrics is not None:
+            start = time.perf_counter()
+        F = self.transition(dt)
         #F = np.eye(6)
 
         theta_r  = np.deg2rad(self.x[4,0]) # Heading
@@ -125,6 +227,8 @@ class KalmanFilter():
         self.x = F@self.x + self.B@u
         self.P = F@self.P@F.T + self.Q
         self.wrapTheta()
+        if self.metrics is not None:
+            self.metrics.recordPredict(time.perf_counter() - start, dt)
 
     def wrap180(self, angle: float) -> float:
         """Wrap angle to 180
@@ -169,7 +273,7 @@ class KalmanFilter():
             Dict containing gpsX, gpsY
         """
         gpsLoc = Point(data['gpsX'], data['gpsY'])
-        if not hasattr(self, 'lastGPS') or self.lastGPS == gpsLoc:
+        if self.lastGPS is None or self.lastGPS == gpsLoc:
             self.update_nogps(data)
         else:
             data['dist_gps']   = self.lastGPS.distanceTo(gpsLoc)
@@ -179,6 +283,24 @@ class KalmanFilter():
         self.lastGPS = gpsLoc
 
 
+    def step(self, data: dict, dt: float | None):
+        """Predict over dt with the record's motor powers, long gaps in
+        MAX_DT steps, then update with the record
+        --------
+        Parameters
+        data : dict
+            Telemetry record with powerLeft, powerRight, gpsX, gpsY and rz
+        dt : float | None
+            Time since the last record, None to only update (first record)
+        """
+        if dt is not None:
+            u = np.array([[data['powerLeft']], [data['powerRight']]])
+            steps = max(1, math.ceil(dt / MAX_DT))
+            for _ in range(steps):
+                self.predict(u, dt / steps)
+        self.update(data)
+
+
     def update_gps(self, data: dict):
         """Kalman filter update with gps data (and gyro)
         --------
@@ -186,6 +308,65 @@ class KalmanFilter():
         data : dict
             Dict containing updated gps data
         """
+        recording = self.recording
+        if recording:
+            start = time.perf_counter()
+        if self.updateMethod == 'inverse':
+            innovation, nis = self.update_gps_inverse(data)
+            if recording:
+                self.recordUpdate(True, innovation, nis, time.perf_counter() - start)
+            return
+
+        # Measured states, measurements and their (diagonal) noise
+        states = (0, 1, 4, 5)
+        z = (data['gpsX'], data['gpsY'], data['course_gps'], data['rz'])
+        r = (self.gpsNoise, self.gpsNoise,
+             max([0., self.gpsAngleNoise*(0.5 - data['dist_gps'])]), self.gyroNoise)
+        innovation = [z[i] - self.x.item(states[i]) for i in range(4)]
+        innovation[2] = self.wrap180(innovation[2])
+
+        if self.updateMethod == 'sequential':
+            # Sequential innovations are independent, their NIS add up to the joint NIS
+            nis = 0.
+            for i in range(4):
+                y = z[i] - self.x[states[i], 0]
+                if i == 2:
+                    y = self.wrap180(y)
+                s = self.scalarUpdate(states[i], y, r[i])
+                nis += y*y/s
+        else:
+            y = np.array(z) - self.x[states, 0]
+            y[2] = self.wrap180(y[2])
+            nis = self.jointUpdate(states, y, np.diag(r))
+        if recording:
+            self.recordUpdate(True, innovation, nis, time.perf_counter() - start)
+
+    def recordUpdate(self, gps: bool, innovation, nis: float, seconds: float):
+        """Record an update in the diagnostics and metrics
+        --------
+        Parameters
+        gps : bool
+            Whether it was a gps update
+        innovation : sequence[float]
+            The 4 gps innovations, or the gyro innovation alone
+        nis : float
+            y'S^-1y of the update
+        seconds : float
+            Time spent in the update
+        """
+        if self.diagnostics is not None:
+            if gps:
+                self.diagnostics.record(True, innovation, nis, seconds)
+            else:
+                self.diagnostics.record(False, NO_GPS + tuple(innovation), nis, seconds)
+        if self.metrics is not None:
+            self.metrics.recordUpdate('gps' if gps else 'gyro', innovation, nis, seconds)
+
+    def update_gps_inverse(self, data: dict) -> tuple[list[float], float]:
+        """Original update_gps with a full inverse of S
+        -------
+        Return innovation, NIS : tuple[list[float], float]
+        """
         z = np.array([[data['gpsX']],
                       [data['gpsY']],
                       [data['course_gps']],
@@ -205,10 +386,11 @@ class KalmanFilter():
         y      = z - H@self.x
         y[2,0] = self.wrap180(y[2,0])
         S      = H@self.P@H.T + R
-        K      = self.P@H.T@np.linalg.inv(S)
+        Si     = np.linalg.inv(S)
+        K      = self.P@H.T@Si
         self.x = self.x + K@y
         self.P = (np.eye(6) - K@H)@self.P
-        self.gpsUpdated.append(True)
+        return y[:, 0].tolist(), float((y.T@Si@y)[0, 0])
 
 
     def update_nogps(self, data: dict):
@@ -218,6 +400,24 @@ class KalmanFilter():
         data : dict
             Dict containing gyro data
         """
+        recording = self.recording
+        if recording:
+            start = time.perf_counter()
+        if self.updateMethod == 'inverse':
+            y, nis = self.update_nogps_inverse(data)
+        else:
+            # Single measurement so every method is a scalar update
+            y = -data['rz'] - self.x[5, 0]
+            s = self.scalarUpdate(5, y, self.gyroNoise)
+            nis = y*y/s
+        if recording:
+            self.recordUpdate(False, (y,), nis, time.perf_counter() - start)
+
+    def update_nogps_inverse(self, data: dict) -> tuple[float, float]:
+        """Original update_nogps with a full inverse of S
+        -------
+        Return innovation, NIS : tuple[float, float]
+        """
         rz = -data['rz']
         H  = np.array([[0., 0., 0., 0., 0., 1.]])
         R  = np.array([[self.gyroNoise]]) # Tune for no gps
@@ -225,7 +425,65 @@ class KalmanFilter():
         z  = np.array([[rz]])
         y  = z - H@self.x
         S  = H@self.P@H.T + R
-        K  = self.P@H.T@np.linalg.inv(S)
+        Si = np.linalg.inv(S)
+        K  = self.P@H.T@Si
         self.x = self.x + K@y
         self.P = (np.eye(6) - K@H)@self.P
-        self.gpsUpdated.append(False)
+        return float(y[0, 0]), float(y[0, 0]**2*Si[0, 0])
+
+    def scalarUpdate(self, state: int, y: float, r: float) -> float:
+        """Update with one direct measurement of a state, no inverse needed
+        --------
+        Parameters
+        state : int
+            Index of the measured state (H is a unit row)
+        y : float
+            Innovation
+        r : float
+            Measurement noise variance
+        -------
+        Return innovation variance s : float
+        """
+        P = self.P
+        col = P[:, state].copy()
+        s = col[state] + r
+        k = col / s
+        self.x = self.x + (k*y)[:, np.newaxis]
+        if self.josephForm:
+            # (I - kh)P(I - kh)' + krk'
+            self.P = P - np.outer(k, col) - np.outer(col, k) + s*np.outer(k, k)
+        else:
+            # (I - kh)P
+            self.P = P - np.outer(k, P[state])
+        return s
+
+    def jointUpdate(self, states: tuple[int, ...], y: np.ndarray, R: np.ndarray):
+        """Update with several direct state measurements at once, solving
+        through the Cholesky factor of S instead of inverting it
+        --------
+        Parameters
+        states : tuple[int, ...]
+            Indices of the measured states (rows of H are unit rows)
+        y : np.ndarray
+            Innovations
+        R : np.ndarray
+            Measurement noise covariance
+        -------
+        Return NIS y'S^-1y : float
+        """
+        P = self.P
+        PHt = P[:, states]
+        S = PHt[states, :] + R
+        L = np.linalg.cholesky(S)
+        # K' = S^-1 H P = L'^-1 L^-1 H P
+        Kt = np.linalg.solve(L.T, np.linalg.solve(L, PHt.T))
+        K = Kt.T
+        self.x = self.x + (K@y)[:, np.newaxis]
+        if self.josephForm:
+            I_KH = np.eye(6)
+            I_KH[:, states] -= K
+            self.P = I_KH@P@I_KH.T + K@R@Kt
+        else:
+            self.P = P - K@PHt.T
+        w = np.linalg.solve(L, y)
+        return float(w@w)
@@ -0,0 +1,116 @@
+import os
+import pickle
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from libs.TelemetryStore import TelemetryStore
+
+# Sessions recorded before the json DataRecorder (old_telemetry/) are pickled
+# lists of [timestamp, bytearray] with the packet layout '<ddddiiffff'
+LEGACY_FOLDER: str = "old_telemetry"
+IMPORT_FOLDER: str = "BoatData/legacy"
+
+LEGACY_DTYPE = np.dtype([('gpsX', '<f8'), ('gpsY', '<f8'), ('lat', '<f8'), ('lng', '<f8'),
+                         ('pwmLeft', '<i4'), ('pwmRight', '<i4'), ('rz', '<f4'),
+                         ('ax', '<f4'), ('ay', '<f4'), ('az', '<f4')])
+
+# Motors were sent as servo pulse widths (us), now as power -1 to 1
+PWM_CENTRE: int = 1500
+PWM_RANGE: int = 400
+
+# Fields of the current telemetry the old boat didn't send
+LEGACY_DEFAULTS: dict[str, float] = {'wpHeading': 0., 'wpDist': 0.}
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    "Only rebuilds the bytearrays the old recorder pickled"
+    def find_class(self, module, name):
+        if (module, name) == ('builtins', 'bytearray'):
+            return bytearray
+        raise pickle.UnpicklingError(f"{module}.{name} is not in a legacy session")
+
+
+def decodeLegacy(packets: list) -> TelemetryStore:
+    """Decode [timestamp, packet] pairs to current telemetry columns, the
+    accelerometer is kept as ax, ay, az
+    -------
+    Parameters
+    packets : list
+        Timestamped raw '<ddddiiffff' packets
+    """
+    sizes = {len(packet) for _, packet in packets}
+    if sizes - {LEGACY_DTYPE.itemsize}:
+        raise ValueError(f"Packets are {sorted(sizes)} bytes, expected {LEGACY_DTYPE.itemsize}")
+    raw = np.frombuffer(b''.join(packet for _, packet in packets), LEGACY_DTYPE)
+    n = len(raw)
+    columns = {'timestamp': np.fromiter((timestamp for timestamp, _ in packets), np.float64, n)}
+    for field in ('gpsX', 'gpsY', 'lat', 'lng'):
+        columns[field] = raw[field].astype(np.float64)
+    columns['powerLeft'] = (raw['pwmLeft'] - PWM_CENTRE) / PWM_RANGE
+    columns['powerRight'] = (raw['pwmRight'] - PWM_CENTRE) / PWM_RANGE
+    columns['rz'] = raw['rz'].astype(np.float64)
+    for field, value in LEGACY_DEFAULTS.items():
+        columns[field] = np.full(n, value)
+    for field in ('ax', 'ay', 'az'):
+        columns[field] = raw[field].astype(np.float64)
+    return TelemetryStore(columns)
+
+
+def loadLegacy(filename: str) -> TelemetryStore:
+    """Load a legacy pickled session
+    -------
+    Parameters
+    filename : str
+        Pickle from old_telemetry/
+    """
+    with open(filename, 'rb') as f:
+        return decodeLegacy(LegacyUnpickler(f).load())
+
+
+def importLegacy(filename: str, folder: str = IMPORT_FOLDER) -> tuple[str, int]:
+    """Convert a legacy session to DataRecorder json
+    -------
+    Parameters
+    filename : str
+        Pickle from old_telemetry/
+    folder : str
+        Folder for the json (default IMPORT_FOLDER)
+    -------
+    Return json file, records : tuple[str, int]
+    """
+    store = loadLegacy(filename)
+    jsonFile = os.path.join(folder, os.path.basename(filename) + ".json")
+    store.toJson(jsonFile)
+    return jsonFile, len(store)
+
+
+def importDirectory(source: str = LEGACY_FOLDER, folder: str = IMPORT_FOLDER,
+                    workers: int | None = None) -> list[str]:
+    """Convert every legacy session in a folder, in parallel
+    Files that fail to import are reported and skipped
+    -------
+    Parameters
+    source : str
+        Folder of pickles (default LEGACY_FOLDER)
+    folder : str
+        Folder for the json (default IMPORT_FOLDER)
+    workers : int | None
+        Processes to use (default cpu count)
+    -------
+    Return json files written : list[str]
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    filenames = sorted(os.path.join(source, name) for name in os.listdir(source)
+                       if os.path.isfile(os.path.join(source, name)))
+    saved = []
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [(filename, pool.submit(importLegacy, filename, folder)) for filename in filenames]
+        for filename, future in futures:
+            try:
+                jsonFile, records = future.result()
+            except (pickle.UnpicklingError, ValueError, EOFError) as e:
+                print(f"Skipped {filename}: {e}")
+                continue
+            print(f"Imported {filename} -> {jsonFile} ({records} records)")
+            saved.append(jsonFile)
+    return saved
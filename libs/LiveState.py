@@ -0,0 +1,69 @@
+import threading
+import time
+
+# Debug text lines kept in the state
+DEBUG_LINES: int = 20
+
+
+class StateSnapshot:
+    def __init__(self, version: int, values: dict):
+        """Read only view of the live state at one version, values are
+        read as attributes, eg. snapshot.connected
+        -------
+        Parameters
+        version : int
+            Publish count, changes whenever any value does
+        values : dict
+            State values, not copied, never modified after publishing
+        """
+        self.version = version
+        self.published = time.monotonic()
+        self.values = values
+
+    def __getattr__(self, name: str):
+        try:
+            return self.values[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class LiveState:
+    def __init__(self, debugLines: int = DEBUG_LINES, **values):
+        """Live state shared between the BLE side and the display, which
+        may run in different threads
+        Publishing swaps in a new snapshot, so a reader holding one sees a
+        consistent state however long it takes over a frame
+        -------
+        Parameters
+        debugLines : int
+            Lines of debug text kept (default DEBUG_LINES)
+        values
+            Initial state values
+        """
+        self.debugLines = debugLines
+        self.lock = threading.Lock() # Between publishers, readers don't lock
+        self.current = StateSnapshot(0, {'debug': ""} | values)
+
+    def snapshot(self) -> StateSnapshot:
+        "Newest published state"
+        return self.current
+
+    def publish(self, **changes) -> StateSnapshot:
+        """Publish new values, the others are kept
+        -------
+        Return the new snapshot : StateSnapshot
+        """
+        with self.lock:
+            self.current = StateSnapshot(self.current.version + 1, self.current.values | changes)
+            return self.current
+
+    def log(self, text: str) -> StateSnapshot:
+        """Add a line to the debug text
+        -------
+        Return the new snapshot : StateSnapshot
+        """
+        with self.lock:
+            lines = (self.current.values['debug'] + "\n" + text).split("\n")[-self.debugLines:]
+            self.current = StateSnapshot(self.current.version + 1,
+                                         self.current.values | {'debug': "\n".join(lines)})
+            return self.current
@@ -0,0 +1,70 @@
+import struct
+import numpy as np
+from libs.TelemetryLog import SCHEMAS, TIMESTAMP, recordDtype
+
+# Packets kept between drains, older ones are overwritten
+PACKET_CAPACITY: int = 4096
+
+
+class PacketBuffer:
+    def __init__(self, schema: str, capacity: int = PACKET_CAPACITY):
+        """Preallocated ring of raw BLE packets, laid out like log records
+        (host timestamp then payload) so batches decode with numpy
+        Not locked, append and drain from the same thread (the asyncio loop)
+        -------
+        Parameters
+        schema : str
+            Key of TelemetryLog.SCHEMAS
+        capacity : int
+            Packets kept between drains (default PACKET_CAPACITY)
+        """
+        self.schema = schema
+        self.struct = struct.Struct(SCHEMAS[schema][0])
+        self.dtype = recordDtype(schema)
+        self.recordSize = self.dtype.itemsize
+        self.capacity = capacity
+        self.raw = bytearray(capacity * self.recordSize)
+        self.view = memoryview(self.raw)
+        self.records = np.frombuffer(self.raw, self.dtype)
+        self.count = 0 # Packets appended
+        self.drained = 0 # Packets handed out by drain
+        self.lost = 0 # Overwritten before a drain
+
+    def append(self, timestamp: float, payload: bytes):
+        """Copy a packet in, no decoding
+        -------
+        Parameters
+        timestamp : float
+            Host receive time
+        payload : bytes
+            Raw packet, packed with the schema format
+        """
+        offset = (self.count % self.capacity) * self.recordSize
+        # memoryview slices don't resize, a wrong sized payload raises ValueError
+        self.view[offset+TIMESTAMP.size:offset+self.recordSize] = payload
+        TIMESTAMP.pack_into(self.raw, offset, timestamp)
+        self.count += 1
+
+    def latest(self) -> tuple | None:
+        "Newest payload decoded with the schema struct, None before any"
+        if self.count == 0:
+            return None
+        offset = ((self.count - 1) % self.capacity) * self.recordSize
+        return self.struct.unpack_from(self.raw, offset + TIMESTAMP.size)
+
+    def __len__(self) -> int:
+        "Packets waiting to be drained"
+        return min(self.count - self.drained, self.capacity)
+
+    def drain(self) -> np.ndarray:
+        """Copy out the packets appended since the last drain, oldest first
+        -------
+        Return (N,) records with timestamp and the schema fields : np.ndarray
+        """
+        n = len(self)
+        self.lost += self.count - self.drained - n
+        start = (self.count - n) % self.capacity
+        self.drained = self.count
+        if start + n <= self.capacity:
+            return self.records[start:start+n].copy()
+        return np.concatenate((self.records[start:], self.records[:start + n - self.capacity]))
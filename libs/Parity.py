@@ -0,0 +1,210 @@
+import csv
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from libs.BatchAnalysis import loadTelemetry
+from libs.KalmanFilter import KalmanFilter
+from libs.Replay import Replay, REPLAY_COLUMNS
+from libs.StreamJoin import asofJoin
+from libs.TelemetryLog import LOG_EXT
+from libs.TelemetryStore import TelemetryStore
+from libs.TimeIndex import recordDts
+
+# Onboard kalman packet fields, in host state order
+STATE_FIELDS: tuple[str, ...] = ('x', 'y', 'dx', 'dy', 'heading', 'd_heading')
+
+# Host and onboard differing by more than this is divergence
+PARITY_LIMITS: dict[str, float] = {'x': 1., 'y': 1., 'dx': 0.5, 'dy': 0.5,
+                                   'heading': 10., 'd_heading': 20.}
+
+# Kalman packets further than this from a telemetry packet aren't compared (s)
+PARITY_TOLERANCE: float = 0.2
+
+# Divergent records closer than this are one window (s)
+WINDOW_MERGE: float = 1.
+
+# Columns of the summary table, with <field>_rms, <field>_max per STATE_FIELDS
+PARITY_FIELDS: tuple[str, ...] = (
+    'session', 'records', 'matched', 'diverged_frac', 'windows',
+    *(f'{field}_{stat}' for field in STATE_FIELDS for stat in ('rms', 'max')),
+    'worst_windows', 'error')
+
+# Windows listed in the summary
+WORST_WINDOWS: int = 3
+
+
+def findPairs(telemFiles: list[str]) -> list[tuple[str, str]]:
+    """Pair DataRecorder telem files with the kalman file saved beside them
+    A session saved as both a binary log and json is paired once, from the
+    log when it has a kalman log
+    -------
+    Parameters
+    telemFiles : list[str]
+        Files or folders, only names starting telem are used
+    -------
+    Return (telem, kalman) files : list[tuple[str, str]]
+    """
+    files = []
+    for path in telemFiles:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+    # Telem files of each session, by path without the extension
+    sessions: dict[str, list[str]] = {}
+    for filename in files:
+        if os.path.basename(filename).startswith('telem'):
+            sessions.setdefault(os.path.splitext(filename)[0], []).append(filename)
+    pairs = []
+    for stem, candidates in sessions.items():
+        candidates.sort(key=lambda filename: os.path.splitext(filename)[1] != LOG_EXT)
+        for filename in candidates:
+            folder, name = os.path.split(filename)
+            kalman = os.path.join(folder, 'kalman' + name[len('telem'):])
+            if os.path.exists(kalman):
+                pairs.append((filename, kalman))
+                break
+        else:
+            print(f"No kalman file for {stem}")
+    return pairs
+
+
+def divergenceWindows(times: np.ndarray, diverged: np.ndarray, merge: float = WINDOW_MERGE) -> np.ndarray:
+    """Time windows of divergent records
+    -------
+    Parameters
+    times : np.ndarray
+        Record times
+    diverged : np.ndarray
+        Records where host and onboard disagree
+    merge : float
+        Divergent records closer than this are one window (default WINDOW_MERGE)
+    -------
+    Return (N, 2) start and end times : np.ndarray
+    """
+    t = times[diverged]
+    if len(t) == 0:
+        return np.zeros((0, 2))
+    breaks = np.flatnonzero(np.diff(t) > merge)
+    starts = np.r_[t[0], t[breaks + 1]]
+    ends = np.r_[t[breaks], t[-1]]
+    return np.column_stack((starts, ends))
+
+
+def hostStates(telem: TelemetryStore, kf: KalmanFilter) -> TelemetryStore:
+    """Replay the host filter over telemetry, stepping the real time
+    between records like the onboard filter
+    -------
+    Parameters
+    telem : TelemetryStore
+        Raw telemetry with timestamps
+    kf : KalmanFilter
+        Filter to replay, continues from its state
+    -------
+    Return timestamp and STATE_FIELDS : TelemetryStore
+    """
+    replay = Replay(kf)
+    replay.run(*(telem[col] for col in REPLAY_COLUMNS), dts=recordDts(telem['timestamp']))
+    columns = {'timestamp': np.asarray(telem['timestamp'], dtype=np.float64)}
+    for i, field in enumerate(STATE_FIELDS):
+        columns[field] = replay.states[:, i]
+    return TelemetryStore(columns)
+
+
+def checkParity(telemFile: str, kalmanFile: str, params: dict[str, float],
+                tolerance: float = PARITY_TOLERANCE) -> dict:
+    """Compare the host filter with the onboard filter over a session
+    The host filter starts from the onboard state received just before
+    the first telemetry, if any, so only the filters themselves are compared
+    -------
+    Parameters
+    telemFile : str
+        Raw telemetry recording
+    kalmanFile : str
+        Onboard kalman recording of the same session
+    params : dict[str, float]
+        Host KalmanFilter parameters
+    tolerance : float
+        Largest time between compared packets (default PARITY_TOLERANCE)
+    -------
+    Return row of PARITY_FIELDS : dict
+    """
+    telem = loadTelemetry(telemFile)
+    kalman = loadTelemetry(kalmanFile)
+    if len(telem) == 0 or len(kalman) == 0:
+        raise ValueError("no records")
+    kf = KalmanFilter()
+    for param, value in params.items():
+        setattr(kf, param, value)
+    first = asofJoin(telem[0:1], kalman, prefix='onboard_', direction='backward', tolerance=tolerance)
+    start = np.array([first[f'onboard_{field}'][0] for field in STATE_FIELDS])
+    if np.all(np.isfinite(start)):
+        kf.x = start.reshape(6, 1)
+
+    joined = asofJoin(hostStates(telem, kf), kalman, prefix='onboard_',
+                      direction='nearest', tolerance=tolerance)
+    matched = ~np.isnan(joined['onboard_timestamp'])
+    row = {'records': len(telem), 'matched': int(matched.sum()), 'error': ''}
+    diverged = np.zeros(len(joined), dtype=bool)
+    for field in STATE_FIELDS:
+        diff = joined[field] - joined[f'onboard_{field}']
+        if field == 'heading':
+            diff = (diff + 180.) % 360. - 180.
+        diff = np.abs(diff[matched])
+        row[f'{field}_rms'] = float(np.sqrt(np.mean(diff**2))) if len(diff) else float('nan')
+        row[f'{field}_max'] = float(diff.max()) if len(diff) else float('nan')
+        diverged[matched] |= diff > PARITY_LIMITS[field]
+
+    times = joined['timestamp'] - joined['timestamp'][0]
+    windows = divergenceWindows(times, diverged)
+    row['diverged_frac'] = float(diverged.sum() / matched.sum()) if matched.any() else float('nan')
+    row['windows'] = len(windows)
+    longest = windows[np.argsort(windows[:, 0] - windows[:, 1])[:WORST_WINDOWS]]
+    row['worst_windows'] = ' '.join(f'{t0:.1f}-{t1:.1f}s' for t0, t1 in longest)
+    return row
+
+
+def parityWorker(telemFile: str, kalmanFile: str, params: dict[str, float]) -> dict:
+    "Pool task, failures become the row's error"
+    try:
+        return checkParity(telemFile, kalmanFile, params)
+    except (ValueError, KeyError, OSError, EOFError) as e:
+        return {'error': str(e)}
+
+
+def runParity(pairs: list[tuple[str, str]], params: dict[str, float], summaryFile: str,
+              workers: int | None = None) -> list[dict]:
+    """Check sessions in parallel, each row is written to the summary csv
+    as it finishes
+    -------
+    Parameters
+    pairs : list[tuple[str, str]]
+        (telem, kalman) files from findPairs
+    params : dict[str, float]
+        Host KalmanFilter parameters
+    summaryFile : str
+        Csv of PARITY_FIELDS, overwritten
+    workers : int | None
+        Worker processes (default cpu count)
+    -------
+    Return rows in finishing order : list[dict]
+    """
+    rows = []
+    with open(summaryFile, 'w', newline='') as f, ProcessPoolExecutor(workers) as pool:
+        writer = csv.DictWriter(f, PARITY_FIELDS)
+        writer.writeheader()
+        futures = {pool.submit(parityWorker, telem, kalman, params): telem for telem, kalman in pairs}
+        for future in as_completed(futures):
+            row = dict.fromkeys(PARITY_FIELDS, '') | future.result() | {'session': futures[future]}
+            writer.writerow(row)
+            f.flush()
+            rows.append(row)
+            if row['error']:
+                print(f"{row['session']}: {row['error']}")
+            else:
+                print(f"{row['session']}: {row['windows']} divergent windows,"
+                      f" heading rms {row['heading_rms']:.2f} deg, position rms"
+                      f" {row['x_rms']:.2f} {row['y_rms']:.2f} m")
+    return rows
@@ -0,0 +1,393 @@
+import math
+import os
+import numpy as np
+from libs.KalmanFilter import KalmanFilter, MAX_DT
+from libs.Point import Point
+from libs.Smoother import rtsSmooth, SMOOTH_CHUNK
+
+# Columns needed from telemetry to replay the filter
+REPLAY_COLUMNS: tuple[str, ...] = ('gpsX', 'gpsY', 'rz', 'powerLeft', 'powerRight')
+
+# (position, velocity) state pairs. F, B, H and R never couple one pair to
+# another, so while P and Q start block diagonal they stay block diagonal.
+BLOCKS: tuple[tuple[int, int], ...] = ((0, 2), (1, 3), (4, 5))
+
+
+def gpsColumns(gpsX: np.ndarray, gpsY: np.ndarray, lastGPS: Point | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find new gps fixes with their distance and course from the last fix
+    Same test as KalmanFilter.update
+    -------
+    Parameters
+    gpsX : np.ndarray
+        Gps x column
+    gpsY : np.ndarray
+        Gps y column
+    lastGPS : Point | None
+        Fix seen before the first record (default None)
+    -------
+    Return updated mask, distance (m), course (deg [0, 360)) : tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+    lastX = np.empty_like(gpsX)
+    lastY = np.empty_like(gpsY)
+    lastX[1:] = gpsX[:-1]
+    lastY[1:] = gpsY[:-1]
+    updated = np.empty(len(gpsX), dtype=bool)
+    updated[1:] = (gpsX[1:] != lastX[1:]) | (gpsY[1:] != lastY[1:])
+    if lastGPS is not None:
+        lastX[0] = lastGPS.x
+        lastY[0] = lastGPS.y
+        updated[0] = not lastGPS == Point(gpsX[0], gpsY[0])
+    else:
+        lastX[0] = gpsX[0]
+        lastY[0] = gpsY[0]
+        updated[0] = False
+
+    dx = gpsX - lastX
+    dy = gpsY - lastY
+    dist = np.sqrt(dx**2 + dy**2)
+    course = np.arctan2(dx, dy) * (180 / np.pi)
+    course[course < 0] += 360
+    return updated, dist, course
+
+
+class Replay:
+    def __init__(self, kf: KalmanFilter, dt: float = 0.1, keepPredicted: bool = False, spillDir: str | None = None):
+        """Whole-log replay of a kalman filter
+        -------
+        Parameters
+        kf : KalmanFilter
+            Filter to replay, continues from its current state
+        dt : float
+            Fixed delta time between records (default 0.1)
+        keepPredicted : bool
+            Also keep predicted states and covariances, needed by smooth()
+            (default False)
+        spillDir : str | None
+            Folder to memory map the covariance histories into for very
+            long sessions, files are overwritten each run (default None, in memory)
+        """
+        self.filter = kf
+        self.dt = dt
+        self.keepPredicted = keepPredicted
+        self.spillDir = spillDir
+        self.predictedStates = None
+        self.predictedCovariances = None
+
+    def covarianceArray(self, name: str, n: int) -> np.ndarray:
+        """Zeroed (n, 6, 6) history, memory mapped if spilling
+        -------
+        Parameters
+        name : str
+            File name in spillDir
+        n : int
+            Number of records
+        -------
+        Return covariance history : np.ndarray
+        """
+        if self.spillDir is None:
+            return np.zeros((n, 6, 6))
+        if not os.path.exists(self.spillDir):
+            os.makedirs(self.spillDir)
+        # memmap can't map an empty file
+        history = np.memmap(os.path.join(self.spillDir, name), dtype=np.float64, mode='w+', shape=(max(n, 1), 6, 6))
+        history[:] = 0.
+        return history[:n]
+
+    def isBlockDiagonal(self) -> bool:
+        """Check P and Q have no terms coupling the state blocks
+        -------
+        Return whether the fast path is valid : bool
+        """
+        mask = np.ones((6, 6), dtype=bool)
+        for block in BLOCKS:
+            mask[np.ix_(block, block)] = False
+        return not (np.any(self.filter.P[mask]) or np.any(self.filter.Q[mask]))
+
+    def run(self, gpsX, gpsY, rz, powerLeft, powerRight, dts=None):
+        """Replay the whole log, same as predict and update on every record
+        Results are left in self.states (N, 6), self.covariances (N, 6, 6)
+        and self.gpsUpdated (N,), with keepPredicted also in
+        self.predictedStates and self.predictedCovariances
+        Filters collecting metrics take the per step path so every call is
+        recorded and timed
+        -------
+        Parameters
+        gpsX, gpsY, rz, powerLeft, powerRight : array like
+            Telemetry columns of equal length
+        dts : array like | None
+            Time since the previous record (s), eg. from TimeIndex.recordDts,
+            predicts longer than MAX_DT are split into equal steps
+            (default None, records are self.dt apart)
+        """
+        gpsX = np.asarray(gpsX, dtype=np.float64)
+        gpsY = np.asarray(gpsY, dtype=np.float64)
+        rz = np.asarray(rz, dtype=np.float64)
+        powerLeft = np.asarray(powerLeft, dtype=np.float64)
+        powerRight = np.asarray(powerRight, dtype=np.float64)
+
+        n = len(gpsX)
+        self.states = np.zeros((n, 6))
+        self.covariances = self.covarianceArray('covariances.dat', n)
+        if self.keepPredicted:
+            self.predictedStates = np.zeros((n, 6))
+            self.predictedCovariances = self.covarianceArray('predictedCovariances.dat', n)
+        self.gpsUpdated = np.zeros(n, dtype=bool)
+        if dts is None:
+            self.steps = np.ones(n, dtype=np.int64)
+            self.stepDts = np.full(n, float(self.dt))
+        else:
+            dts = np.asarray(dts, dtype=np.float64)
+            if len(dts) != n:
+                raise ValueError(f"Replay has {len(dts)} delta times for {n} records")
+            self.steps = np.maximum(np.ceil(dts / MAX_DT), 1).astype(np.int64)
+            self.stepDts = dts / self.steps
+        if n == 0:
+            return
+
+        kf = self.filter
+        self.gpsUpdated[:], dist, course = gpsColumns(gpsX, gpsY, kf.lastGPS)
+        if self.isBlockDiagonal() and kf.metrics is None:
+            self.runBlocks(gpsX, gpsY, rz, powerLeft, powerRight, dist, course)
+            kf.x = self.states[-1].reshape(6, 1).copy()
+            kf.P = self.covariances[-1].copy()
+            if kf.diagnostics is not None:
+                kf.diagnostics.extendGps(self.gpsUpdated)
+        else:
+            self.runFull(gpsX, gpsY, rz, powerLeft, powerRight, dist, course)
+        kf.lastGPS = Point(float(gpsX[-1]), float(gpsY[-1]))
+
+    def smooth(self, chunk: int = SMOOTH_CHUNK):
+        """Replace states and covariances with RTS smoothed values
+        Needs a run with keepPredicted
+        -------
+        Parameters
+        chunk : int
+            Records per batch of smoother gains (default SMOOTH_CHUNK)
+        """
+        if self.predictedCovariances is None:
+            raise ValueError("Replay needs keepPredicted to smooth")
+        rtsSmooth(self.states, self.covariances, self.predictedStates,
+                  self.predictedCovariances, self.transitions(), chunk)
+
+    def transitions(self) -> np.ndarray:
+        """Transition matrix into each record of the last run, over all of
+        its predict steps
+        -------
+        Return F : np.ndarray (6, 6) when every record is one step of the same
+            delta time, else (N, 6, 6)
+        """
+        kf = self.filter
+        if np.all(self.steps == 1) and np.all(self.stepDts == self.stepDts[:1]):
+            return kf.transition(float(self.stepDts[0]) if len(self.stepDts) else self.dt)
+        F = self.covarianceArray('transitions.dat', len(self.steps))
+        dt = self.stepDts
+        F[:, 0, 0] = F[:, 1, 1] = F[:, 4, 4] = 1.
+        F[:, 0, 2] = F[:, 1, 3] = F[:, 4, 5] = dt
+        F[:, 2, 2] = F[:, 3, 3] = 1. - dt*kf.b1
+        F[:, 5, 5] = 1. - dt*kf.b2
+        for steps in np.unique(self.steps[self.steps > 1]):
+            records = np.flatnonzero(self.steps == steps)
+            F[records] = np.linalg.matrix_power(F[records], int(steps))
+        return F
+
+    def runFull(self, gpsX, gpsY, rz, powerLeft, powerRight, dist, course):
+        """Reference path through KalmanFilter.predict and update_* for
+        filters whose P or Q couple the state blocks"""
+        kf = self.filter
+        u = np.zeros((2, 1))
+        steps = self.steps.tolist()
+        stepDts = self.stepDts.tolist()
+        for i in range(len(gpsX)):
+            u[0, 0] = powerLeft[i]
+            u[1, 0] = powerRight[i]
+            for _ in range(steps[i]):
+                kf.predict(u, stepDts[i])
+            if self.keepPredicted:
+                self.predictedStates[i] = kf.x[:, 0]
+                self.predictedCovariances[i] = kf.P
+            data = {'gpsX': gpsX[i], 'gpsY': gpsY[i], 'rz': rz[i],
+                    'dist_gps': dist[i], 'course_gps': course[i]}
+            if self.gpsUpdated[i]:
+                kf.update_gps(data)
+            else:
+                kf.update_nogps(data)
+            kf.wrapTheta()
+            self.states[i] = kf.x[:, 0]
+            self.covariances[i] = kf.P
+
+    def runBlocks(self, gpsX, gpsY, rz, powerLeft, powerRight, dist, course):
+        """Fast path, runs the filter as three independent 2 state blocks
+        with python floats written straight into the preallocated arrays"""
+        kf = self.filter
+        b1 = kf.b1
+        b2 = kf.b2
+        motorForce = kf.motorForce
+        motorTorque = kf.motorTorque
+        dt = None
+        gpsNoise = float(kf.gpsNoise)
+        gyroNoise = float(kf.gyroNoise)
+        gpsAngleNoise = float(kf.gpsAngleNoise)
+        sin = math.sin
+        cos = math.cos
+        radians = math.radians
+
+        Q = kf.Q
+        qxpp, qxpv, qxvp, qxvv = float(Q[0, 0]), float(Q[0, 2]), float(Q[2, 0]), float(Q[2, 2])
+        qypp, qypv, qyvp, qyvv = float(Q[1, 1]), float(Q[1, 3]), float(Q[3, 1]), float(Q[3, 3])
+        qhpp, qhpv, qhvp, qhvv = float(Q[4, 4]), float(Q[4, 5]), float(Q[5, 4]), float(Q[5, 5])
+
+        x0, x1, x2, x3, x4, x5 = (float(v) for v in kf.x[:, 0])
+        P = kf.P
+        # Each block is pp, pv, vp, vv
+        xpp, xpv, xvp, xvv = float(P[0, 0]), float(P[0, 2]), float(P[2, 0]), float(P[2, 2])
+        ypp, ypv, yvp, yvv = float(P[1, 1]), float(P[1, 3]), float(P[3, 1]), float(P[3, 3])
+        hpp, hpv, hvp, hvv = float(P[4, 4]), float(P[4, 5]), float(P[5, 4]), float(P[5, 5])
+
+        states = memoryview(self.states.reshape(-1))
+        covs = memoryview(np.asarray(self.covariances).reshape(-1))
+        keepPredicted = self.keepPredicted
+        if keepPredicted:
+            predStates = memoryview(self.predictedStates.reshape(-1))
+            predCovs = memoryview(np.asarray(self.predictedCovariances).reshape(-1))
+        updated = self.gpsUpdated.tolist()
+        gpsX = gpsX.tolist()
+        gpsY = gpsY.tolist()
+        rz = rz.tolist()
+        powerLeft = powerLeft.tolist()
+        powerRight = powerRight.tolist()
+        dist = dist.tolist()
+        course = course.tolist()
+        steps = self.steps.tolist()
+        stepDts = self.stepDts.tolist()
+
+        for i in range(len(gpsX)):
+            if stepDts[i] != dt:
+                dt = stepDts[i]
+                a1 = 1.-dt*b1
+                a2 = 1.-dt*b2
+                mfdt = motorForce*dt
+                mtdt = motorTorque*dt
+            uL = powerLeft[i]
+            uR = powerRight[i]
+            for _ in range(steps[i]):
+                # Predict x = Fx + Bu
+                theta_r = radians(x4)
+                bs = mfdt*sin(theta_r)
+                bc = mfdt*cos(theta_r)
+                x0, x2 = x0 + dt*x2, a1*x2 + (bs*uL + bs*uR)
+                x1, x3 = x1 + dt*x3, a1*x3 + (bc*uL + bc*uR)
+                x4, x5 = x4 + dt*x5, a2*x5 + (mtdt*uL + -mtdt*uR)
+                # Inlined KalmanFilter.wrap360
+                if x4 < 0:
+                    x4 += 360
+                elif x4 >= 360:
+                    x4 -= 360
+
+                # Predict P = FPF' + Q
+                fpp = xpp + dt*xvp
+                fpv = xpv + dt*xvv
+                xpp, xpv, xvp, xvv = (fpp + dt*fpv + qxpp, a1*fpv + qxpv,
+                                      a1*xvp + dt*(a1*xvv) + qxvp, a1*(a1*xvv) + qxvv)
+                fpp = ypp + dt*yvp
+                fpv = ypv + dt*yvv
+                ypp, ypv, yvp, yvv = (fpp + dt*fpv + qypp, a1*fpv + qypv,
+                                      a1*yvp + dt*(a1*yvv) + qyvp, a1*(a1*yvv) + qyvv)
+                fpp = hpp + dt*hvp
+                fpv = hpv + dt*hvv
+                hpp, hpv, hvp, hvv = (fpp + dt*fpv + qhpp, a2*fpv + qhpv,
+                                      a2*hvp + dt*(a2*hvv) + qhvp, a2*(a2*hvv) + qhvv)
+
+            if keepPredicted:
+                s = 6*i
+                predStates[s] = x0
+                predStates[s+1] = x1
+                predStates[s+2] = x2
+                predStates[s+3] = x3
+                predStates[s+4] = x4
+                predStates[s+5] = x5
+                c = 36*i
+                predCovs[c] = xpp
+                predCovs[c+2] = xpv
+                predCovs[c+12] = xvp
+                predCovs[c+14] = xvv
+                predCovs[c+7] = ypp
+                predCovs[c+9] = ypv
+                predCovs[c+19] = yvp
+                predCovs[c+21] = yvv
+                predCovs[c+28] = hpp
+                predCovs[c+29] = hpv
+                predCovs[c+34] = hvp
+                predCovs[c+35] = hvv
+
+            if updated[i]:
+                # Position blocks observe position with gpsNoise
+                y = gpsX[i] - x0
+                iS = 1./(xpp + gpsNoise)
+                k0 = xpp*iS
+                k1 = xvp*iS
+                x0 += k0*y
+                x2 += k1*y
+                xpp, xpv, xvp, xvv = (1.-k0)*xpp, (1.-k0)*xpv, xvp - k1*xpp, xvv - k1*xpv
+
+                y = gpsY[i] - x1
+                iS = 1./(ypp + gpsNoise)
+                k0 = ypp*iS
+                k1 = yvp*iS
+                x1 += k0*y
+                x3 += k1*y
+                ypp, ypv, yvp, yvv = (1.-k0)*ypp, (1.-k0)*ypv, yvp - k1*ypp, yvv - k1*ypv
+
+                # Heading block observes gps course and gyro together
+                y0 = course[i] - x4
+                if y0 > 180:
+                    y0 -= 360
+                y1 = rz[i] - x5
+                s00 = hpp + max(0., gpsAngleNoise*(0.5 - dist[i]))
+                s11 = hvv + gyroNoise
+                det = s00*s11 - hpv*hvp
+                i00 = s11/det
+                i01 = -hpv/det
+                i10 = -hvp/det
+                i11 = s00/det
+                k00 = hpp*i00 + hpv*i10
+                k01 = hpp*i01 + hpv*i11
+                k10 = hvp*i00 + hvv*i10
+                k11 = hvp*i01 + hvv*i11
+                x4 += k00*y0 + k01*y1
+                x5 += k10*y0 + k11*y1
+                hpp, hpv, hvp, hvv = ((1.-k00)*hpp - k01*hvp, (1.-k00)*hpv - k01*hvv,
+                                      (1.-k11)*hvp - k10*hpp, (1.-k11)*hvv - k10*hpv)
+            else:
+                # Gyro only observes rotation rate
+                y = -rz[i] - x5
+                iS = 1./(hvv + gyroNoise)
+                k0 = hpv*iS
+                k1 = hvv*iS
+                x4 += k0*y
+                x5 += k1*y
+                hpp, hpv, hvp, hvv = hpp - k0*hvp, hpv - k0*hvv, (1.-k1)*hvp, (1.-k1)*hvv
+            if x4 < 0:
+                x4 += 360
+            elif x4 >= 360:
+                x4 -= 360
+
+            s = 6*i
+            states[s] = x0
+            states[s+1] = x1
+            states[s+2] = x2
+            states[s+3] = x3
+            states[s+4] = x4
+            states[s+5] = x5
+            c = 36*i
+            covs[c] = xpp
+            covs[c+2] = xpv
+            covs[c+12] = xvp
+            covs[c+14] = xvv
+            covs[c+7] = ypp
+            covs[c+9] = ypv
+            covs[c+19] = yvp
+            covs[c+21] = yvv
+            covs[c+28] = hpp
+            covs[c+29] = hpv
+            covs[c+34] = hvp
+            covs[c+35] = hvv
@@ -0,0 +1,100 @@
+import numpy as np
+
+# Starting size of a full history buffer, doubled when full
+GROW_SIZE: int = 1024
+
+
+class RingBuffer:
+    def __init__(self, capacity: int | None, shape: tuple[int, ...] = (), dtype: type = np.float64):
+        """Numpy backed buffer keeping the newest capacity records
+        Records are indexed by their position since the buffer was
+        started (or cleared), older records than capacity are dropped
+        -------
+        Parameters
+        capacity : int | None
+            Records kept, None keeps the full history
+        shape : tuple[int, ...]
+            Shape of each record (default (), scalar)
+        dtype : type
+            Record dtype (default np.float64)
+        """
+        if capacity is not None and capacity < 1:
+            raise ValueError("RingBuffer capacity must be at least 1")
+        self.capacity = capacity
+        self.data = np.zeros((capacity if capacity is not None else GROW_SIZE,) + tuple(shape), dtype=dtype)
+        self.count = 0 # Records appended since clear
+
+    def __len__(self) -> int:
+        return min(self.count, len(self.data))
+
+    @property
+    def start(self) -> int:
+        "Index of the oldest kept record"
+        return self.count - len(self)
+
+    def grow(self, size: int):
+        "Make room for size records in full history mode"
+        if size <= len(self.data):
+            return
+        data = np.zeros((max(size, 2*len(self.data)),) + self.data.shape[1:], dtype=self.data.dtype)
+        data[:self.count] = self.data[:self.count]
+        self.data = data
+
+    def append(self, value):
+        """Add a record, dropping the oldest when full
+        -------
+        Parameters
+        value : array like
+            Record of the buffer shape
+        """
+        if self.capacity is None:
+            self.grow(self.count + 1)
+        self.data[self.count % len(self.data)] = value
+        self.count += 1
+
+    def extend(self, values):
+        """Add several records at once
+        -------
+        Parameters
+        values : array like
+            (N, *shape) records
+        """
+        values = np.asarray(values, dtype=self.data.dtype)
+        n = len(values)
+        if self.capacity is None:
+            self.grow(self.count + n)
+        elif n > self.capacity:
+            self.count += n - self.capacity
+            values = values[-self.capacity:]
+            n = self.capacity
+        size = len(self.data)
+        i = self.count % size
+        first = min(n, size - i)
+        self.data[i:i+first] = values[:first]
+        self.data[:n-first] = values[first:]
+        self.count += n
+
+    def index(self, i: int) -> int:
+        "Slot of record i, negative counts back from the newest"
+        if i < 0:
+            i += self.count
+        if not self.start <= i < self.count:
+            raise IndexError(f"Record {i} not in buffer [{self.start}, {self.count})")
+        return i % len(self.data)
+
+    def __getitem__(self, i: int):
+        return self.data[self.index(i)]
+
+    def toArray(self) -> np.ndarray:
+        """Copy of the kept records, oldest first
+        -------
+        Return (len, *shape) records : np.ndarray
+        """
+        if self.count <= len(self.data):
+            return self.data[:self.count].copy()
+        i = self.count % len(self.data)
+        return np.concatenate((self.data[i:], self.data[:i]))
+
+    def clear(self):
+        "Drop all records, keeps the memory"
+        self.count = 0
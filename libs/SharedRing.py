@@ -0,0 +1,182 @@
+import sys
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+from libs.TelemetryLog import SCHEMAS, TIMESTAMP, recordDtype
+
+# Records kept per stream, about 27 minutes of 10 Hz telemetry
+SHARED_CAPACITY: int = 1 << 14
+
+# Segment names the BLE process publishes each stream under
+RING_NAMES: dict[str, str] = {stream: 'boat_' + stream for stream in SCHEMAS}
+
+# Header words: records written, capacity, record size, schema index and
+# the count the writer is writing up to (ahead of records written while a
+# write is in progress), padded to a cache line so it isn't shared with records
+HEADER_WORDS: int = 5
+HEADER_SIZE: int = 64
+WRITING_WORD: int = 4
+
+_SCHEMA_NAMES: list[str] = list(SCHEMAS)
+
+
+class SharedRing:
+    def __init__(self, schema: str, name: str | None = None, capacity: int = SHARED_CAPACITY):
+        """Writer of a ring of log records (host timestamp then payload) in
+        shared memory, for RingReaders in any process
+        There is one writer. It never waits for readers, a reader that falls
+        a lap behind loses records and counts them
+        -------
+        Parameters
+        schema : str
+            Key of TelemetryLog.SCHEMAS
+        name : str | None
+            Segment name, replaced if left over from a crash
+            (default RING_NAMES[schema])
+        capacity : int
+            Records kept (default SHARED_CAPACITY)
+        """
+        if capacity < 1:
+            raise ValueError("SharedRing capacity must be at least 1")
+        self.schema = schema
+        self.name = name if name is not None else RING_NAMES[schema]
+        self.dtype = recordDtype(schema)
+        self.recordSize = self.dtype.itemsize
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * self.recordSize
+        try:
+            self.shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(self.name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        self.header = np.ndarray((HEADER_WORDS,), np.int64, self.shm.buf)
+        self.header[:] = (0, capacity, self.recordSize, _SCHEMA_NAMES.index(schema), 0)
+        self.records = np.ndarray((capacity,), self.dtype, self.shm.buf, HEADER_SIZE)
+        self.raw = self.shm.buf[HEADER_SIZE:]
+
+    @property
+    def count(self) -> int:
+        "Records written"
+        return int(self.header[0])
+
+    def append(self, timestamp: float, payload: bytes):
+        """Write a raw packet
+        -------
+        Parameters
+        timestamp : float
+            Host receive time
+        payload : bytes
+            Raw packet, packed with the schema format
+        """
+        count = int(self.header[0])
+        self.header[WRITING_WORD] = count + 1
+        offset = (count % self.capacity) * self.recordSize
+        self.raw[offset+TIMESTAMP.size:offset+self.recordSize] = payload
+        TIMESTAMP.pack_into(self.raw, offset, timestamp)
+        # Published once the record is complete
+        self.header[0] = count + 1
+
+    def extend(self, records: np.ndarray):
+        """Write a batch of records, eg. from PacketBuffer.drain
+        -------
+        Parameters
+        records : np.ndarray
+            (N,) records of the schema's log dtype
+        """
+        if records.dtype != self.dtype:
+            raise ValueError(f"Records are {records.dtype} not {self.schema} records")
+        count = int(self.header[0])
+        n = len(records)
+        # Readers treat everything this can overwrite as torn until it's done
+        self.header[WRITING_WORD] = count + n
+        if n > self.capacity:
+            records = records[-self.capacity:]
+        i = (count + n - len(records)) % self.capacity
+        first = min(len(records), self.capacity - i)
+        self.records[i:i+first] = records[:first]
+        self.records[:len(records)-first] = records[first:]
+        self.header[0] = count + n
+
+    def close(self):
+        "Remove the segment, readers keep what they have mapped"
+        del self.header, self.records
+        self.raw.release()
+        self.shm.close()
+        if sys.platform != "win32":
+            # A reader in this process tree shares the resource tracker and
+            # unregisters the name too, unlink expects it registered
+            resource_tracker.register(self.shm._name, "shared_memory")
+        self.shm.unlink()
+
+
+class RingReader:
+    def __init__(self, name: str, fromStart: bool = False):
+        """One consumer of a SharedRing, with its own cursor
+        Reading never writes to the segment, so readers don't slow the
+        writer or each other
+        -------
+        Parameters
+        name : str
+            Segment name, eg. RING_NAMES['telem']
+        fromStart : bool
+            Start from the oldest kept record instead of the newest
+            (default False)
+        """
+        self.shm = shared_memory.SharedMemory(name)
+        if sys.platform != "win32":
+            # The writer owns the segment, don't remove it when this process exits
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.name = name
+        self.header = np.ndarray((HEADER_WORDS,), np.int64, self.shm.buf)
+        self.capacity, recordSize, schema = (int(word) for word in self.header[1:4])
+        self.schema = _SCHEMA_NAMES[schema]
+        self.dtype = recordDtype(self.schema)
+        if self.dtype.itemsize != recordSize:
+            raise ValueError(f"Ring {name} has {recordSize} byte records, {self.schema} has {self.dtype.itemsize}")
+        self.records = np.ndarray((self.capacity,), self.dtype, self.shm.buf, HEADER_SIZE)
+        count = int(self.header[0])
+        self.cursor = max(count - self.capacity, 0) if fromStart else count
+        self.overrun = 0 # Records lost to the writer lapping this reader
+
+    def __len__(self) -> int:
+        "Records written but not read yet"
+        return int(self.header[0]) - self.cursor
+
+    def read(self, limit: int | None = None) -> np.ndarray:
+        """Copy out records since the last read, oldest first
+        Records the writer may have overwritten while they were copied are
+        dropped and counted in overrun
+        -------
+        Parameters
+        limit : int | None
+            Most records to return, None for all
+        -------
+        Return (N,) log records : np.ndarray
+        """
+        end = int(self.header[0])
+        start = self.cursor
+        if end - start > self.capacity:
+            self.overrun += end - start - self.capacity
+            start = end - self.capacity
+        if limit is not None:
+            end = min(end, start + limit)
+        i = start % self.capacity
+        n = end - start
+        if i + n <= self.capacity:
+            records = self.records[i:i+n].copy()
+        else:
+            records = np.concatenate((self.records[i:], self.records[:i + n - self.capacity]))
+        # Anything the writer reached while copying can be torn, including
+        # every slot of a write still in progress
+        torn = int(self.header[WRITING_WORD]) - self.capacity - start
+        if torn > 0:
+            torn = min(torn, n)
+            self.overrun += torn
+            records = records[torn:]
+        self.cursor = end
+        return records
+
+    def close(self):
+        del self.header, self.records
+        self.shm.close()
@@ -1,6 +1,13 @@
-from libs.KalmanFilter import KalmanFilter
+from libs.KalmanFilter import KalmanFilter, PARAMS_FILE
 from libs.DataObject import DataObject
-
+from libs.Replay import Replay, REPLAY_COLUMNS
+from libs.Ensemble import EnsembleFilter, ENSEMBLE_PARAMS
+from libs.Diagnostics import FilterDiagnostics
+from libs.TelemetryStore import TelemetryStore
+from libs.TimeIndex import recordPeriod, recordDts, DEFAULT_DT
+from typing import Iterable
+
+import os
 import numpy as np
 import time
 import pygame
@@ -9,15 +16,24 @@ import matplotlib.pyplot as plt
 # Spacing for window
 DISPLAY_SPACING: int = 50
 
+# Smallest gps range (m) a display scale is made for
+MIN_GPS_RANGE: float = 1.
+
 class Simulation:
-    def __init__(self, data: DataObject):
+    def __init__(self, data: DataObject, params: str = PARAMS_FILE):
         """Simulation window object
         -------
         Parameters
         data : DataObject
             The deserialised telemetry of the boat journey
+        params : str
+            Filter parameters, if the file exists (default PARAMS_FILE)
         """
         self.filter = KalmanFilter()
+        if os.path.exists(params):
+            self.filter.loadParams(params)
+            print(f"Using parameters from {params}")
+        self.filter.diagnostics = FilterDiagnostics(None) # Full history for drawGPS
         self.lastPos = [0., 0.]
         self.data: DataObject = data
         self.reset()
@@ -41,6 +57,7 @@ class Simulation:
             The parameter to start tuning
 
         NOTE: Returns after "exit" command
+        Several values separated by spaces are swept together
         """
         while True:
             plt.ion()
@@ -50,11 +67,19 @@ class Simulation:
                 if 'exit' in str_value:
                     return
                 else:
-                    value = float(str_value)
+                    values = [float(v) for v in str_value.split()]
+                    value = values[0]
             except Exception:
                 print("Not a string value")
                 return
 
+            if len(values) > 1:
+                if param in ENSEMBLE_PARAMS:
+                    self.sweepParam(param, values)
+                else:
+                    print(f"Can only sweep {ENSEMBLE_PARAMS}")
+                continue
+
             self.filter.reset()
             setattr(self.filter, param, value)
             plt.figure(0)
@@ -85,6 +110,45 @@ class Simulation:
             plt.legend()
             plt.pause(0.1)
 
+    def sweepParam(self, param: str, values: list[float]):
+        """Replay every value of a parameter in one pass and plot them together,
+        over the same delta times as a fresh run
+        ----------
+        Parameters
+        param : str
+            The parameter to sweep, one of ENSEMBLE_PARAMS
+        values : list[float]
+            Values to try
+        """
+        self.filter.reset()
+        ensemble = EnsembleFilter.sweep(param, values, self.filter)
+        dts = recordDts(self.data['timestamp']) if 'timestamp' in self.data else None
+        ensemble.run(*(self.data[col] for col in REPLAY_COLUMNS), dt=DEFAULT_DT, dts=dts)
+        stats = ensemble.innovationStats()
+
+        print(f"{param:>12} {'log lik':>14} {'gps NIS':>10} {'gyro NIS':>10}")
+        for i in np.argsort(-ensemble.logLikelihood):
+            print(f"{values[i]:>12g} {ensemble.logLikelihood[i]:>14.1f}"
+                  f" {stats['gps']['nis'][i]:>10.2f} {stats['gyro']['nis'][i]:>10.2f}")
+
+        plt.figure(0)
+        plt.clf();
+        for i, value in enumerate(values):
+            plt.subplot(3, 1, 1)
+            plt.plot(ensemble.states[i, :, 4], label=f"{param}={value:g}")
+            plt.subplot(3, 1, 2)
+            plt.plot(ensemble.states[i, :, 0], ensemble.states[i, :, 1])
+            plt.subplot(3, 1, 3)
+            plt.plot(ensemble.states[i, :, 2])
+        plt.subplot(3, 1, 1)
+        plt.title("Angle")
+        plt.legend()
+        plt.subplot(3, 1, 2)
+        plt.title("Displacement")
+        plt.subplot(3, 1, 3)
+        plt.title("Velocity x")
+        plt.pause(0.1)
+
     def tune(self):
         """Enter tuning mode
         Allows selection of parameter to tune
@@ -102,33 +166,169 @@ class Simulation:
                 print(f"Invalid param: {param}")
 
     
-    def run(self):
+    def run(self, batch: bool = True, smooth: bool = False, metricsFile: str | None = None):
         """Run the simulation with the passed data object
+        -------
+        Parameters
+        batch : bool
+            Replay the whole log at once, False steps record by record
+            (default True)
+        smooth : bool
+            Follow the batch replay with an RTS smoothing pass (default False)
+        metricsFile : str | None
+            Csv file for the filter metrics, when collected (default None)
+        """
+        self.reset()
+        metrics = self.filter.metrics
+        if metrics is not None:
+            metrics.reset()
+        if batch:
+            self.replay(smooth)
+        else:
+            for i in range(len(self.data)):
+                self.step(self.data.at(i))
+            self.stateHistory = np.array(self.tempStateHistory)
+            self.motorHistory = np.array(self.tempMotorHistory)
+            self.gpsHistory = self.filter.gpsUpdated.toArray()
+        self.scaleStateHistory()
+        if metrics is not None:
+            print(metrics.report())
+            if metricsFile is not None:
+                metrics.toCsv(metricsFile)
+
+    def period(self) -> float:
+        "Median time between records, DEFAULT_DT without usable timestamps"
+        if 'timestamp' in self.data:
+            return recordPeriod(self.data['timestamp'], DEFAULT_DT)
+        return DEFAULT_DT
+
+    def recordDts(self) -> np.ndarray:
+        """Delta time of each record of self.data as step takes them,
+        continuing from the last record stepped or replayed
+        -------
+        Return delta times (s) : np.ndarray
+        """
+        if 'timestamp' not in self.data:
+            return np.full(len(self.data), DEFAULT_DT)
+        timestamps = self.data['timestamp']
+        dts = recordDts(timestamps, self.lastTime if self.lastTime > 0 else None)
+        if len(timestamps):
+            self.lastTime = timestamps.item(-1)
+        return dts
+
+    def replay(self, smooth: bool = False, spillDir: str | None = None):
+        """Run the kalman filter over the whole log with Replay, over the
+        same delta times as step
+        -------
+        Parameters
+        smooth : bool
+            Replace the filtered histories with RTS smoothed ones (default False)
+        spillDir : str | None
+            Folder to memory map covariance histories into (default None)
+        """
+        dts = self.recordDts()
+        columns = [self.data[col] for col in REPLAY_COLUMNS]
+        replay = Replay(self.filter, keepPredicted=smooth, spillDir=spillDir)
+        replay.run(*columns, dts=dts)
+        if smooth:
+            replay.smooth()
+        self.stateHistory = replay.states[:, :, np.newaxis]
+        self.covarianceHistory = replay.covariances
+        self.motorHistory = np.array(columns[3:]).T[:, :, np.newaxis]
+        self.gpsHistory = replay.gpsUpdated
+        self.dtHistory = dts.tolist()
+
+    def stream(self, chunks: Iterable[TelemetryStore], show: bool = True):
+        """Replay telemetry chunk by chunk as it is read (eg. from
+        JsonStream.iterChunks), animating each chunk once it is filtered
+        Only the filtered histories are kept, self.data is the last chunk
+        The display scale comes from the first chunk unless already made
+        -------
+        Parameters
+        chunks : Iterable[TelemetryStore]
+            Telemetry in record order
+        show : bool
+            Animate while streaming (default True)
         """
         self.reset()
-        for i in range(len(self.data)):
-            self.step(self.data.at(i))
-        self.stateHistory = np.array(self.tempStateHistory)
-        self.motorHistory = np.array(self.tempMotorHistory)
+        replay = None
+        states, motors, gps, points, dts = [], [], [], [], []
+        lastPoint = None
+        background = pygame.Surface(self.screen.get_size())
+        background.fill("lightblue")
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            self.data = chunk
+            if replay is None:
+                replay = Replay(self.filter)
+                if not hasattr(self, 'scale_m'):
+                    self.createScaleFromGPS(1000, 600)
+            # Continues from the last record of the chunk before
+            chunkDts = self.recordDts()
+            columns = [chunk[col] for col in REPLAY_COLUMNS]
+            replay.run(*columns, dts=chunkDts)
+            self.stateHistory = replay.states[:, :, np.newaxis].copy()
+            self.motorHistory = np.array(columns[3:]).T[:, :, np.newaxis]
+            self.gpsHistory = replay.gpsUpdated.copy()
+            states.append(replay.states.copy())
+            motors.append(self.motorHistory)
+            gps.append(self.gpsHistory)
+            dts.append(chunkDts)
+            gpsXY = np.vstack((chunk['gpsX'], chunk['gpsY']))[:, self.gpsHistory]
+            centres = (self.scale_m@(gpsXY - self.gps_min) + self.scale_c).T.tolist()
+            points.extend(centres)
+            if not show:
+                continue
+
+            self.scaleStateHistory()
+            for centre in centres:
+                pygame.draw.circle(background, 'red', centre, 3)
+            path = self.stateHistory[:, :2, 0].tolist()
+            if lastPoint is not None:
+                path.insert(0, lastPoint)
+            if len(path) > 1:
+                pygame.draw.lines(background, "blue", False, path)
+            lastPoint = path[-1]
+            for self.i in range(len(self.stateHistory)):
+                if any(event.type == pygame.QUIT for event in pygame.event.get()):
+                    show = False
+                    break
+                self.screen.blit(background, (0, 0))
+                self.drawBoat(self.screen)
+                self.drawMotors(self.screen)
+                self.drawVel(self.screen)
+                self.drawGPS(self.screen)
+                pygame.display.flip()
+                time.sleep(chunkDts[self.i])
+
+        if replay is None:
+            return
+        self.stateHistory = np.concatenate(states)[:, :, np.newaxis]
+        self.motorHistory = np.concatenate(motors)
+        self.gpsHistory = np.concatenate(gps)
+        self.gpsPoints = points
+        self.dtHistory = np.concatenate(dts).tolist()
         self.scaleStateHistory()
 
     def step(self, data: dict[str, float | int]):
-        """Run the kalman filter predict and update cycles"""
+        """Run the kalman filter predict and update cycles
+        Predicts over the real time since the last record, long gaps in
+        MAX_DT steps"""
         dt = 0
-        if self.lastTime > 0: # Check initialised
-            dt = data['timestamp'] - self.lastTime
-        self.lastTime = data['timestamp']
-        dt = 0.1
+        if 'timestamp' not in data:
+            dt = DEFAULT_DT
+        elif self.lastTime > 0: # Check initialised
+            dt = max(data['timestamp'] - self.lastTime, 0.) # Clock may jump back
+        self.lastTime = data.get('timestamp', self.lastTime)
 
         # Make sure arrays are same sizes
         assert(len(self.dtHistory) == len(self.tempStateHistory))
         assert(len(self.tempMotorHistory) == len(self.tempStateHistory))
 
-        u = np.array([[data['powerLeft'], data['powerRight']]]).T
-        self.filter.predict(u, dt)
-        self.filter.update(data)
-        self.tempStateHistory.append(self.filter.x)
-        self.tempMotorHistory.append(u)
+        self.filter.step(data, dt)
+        self.tempStateHistory.append(self.filter.x.copy())
+        self.tempMotorHistory.append(np.array([[data['powerLeft'], data['powerRight']]]).T)
         self.dtHistory.append(dt)
 
 
@@ -143,13 +343,15 @@ class Simulation:
         height : int
             Expected showing height of path display
         """
-        x_min = min(self.data["gpsX"])
-        x_max = max(self.data["gpsX"])
-        y_min = min(self.data["gpsY"])
-        y_max = max(self.data["gpsY"])
+        gpsX = self.data["gpsX"]
+        gpsY = self.data["gpsY"]
+        x_min = gpsX.min()
+        x_max = gpsX.max()
+        y_min = gpsY.min()
+        y_max = gpsY.max()
 
-        x_old_range = x_max - x_min
-        y_old_range = y_max - y_min
+        x_old_range = max(x_max - x_min, MIN_GPS_RANGE)
+        y_old_range = max(y_max - y_min, MIN_GPS_RANGE)
 
         print(f"gps X range : {x_old_range}")
         print(f"gps Y range : {y_old_range}")
@@ -164,12 +366,13 @@ class Simulation:
                                  [height + DISPLAY_SPACING]])
         self.gps_min = np.array([[x_min],
                                  [y_min]])
+        # Screen position of every gps point, drawn each frame
+        self.gpsPoints = (self.scale_m@(np.vstack((gpsX, gpsY)) - self.gps_min) + self.scale_c).T.tolist()
 
     def scaleStateHistory(self):
         """Apply scaling to states
         """
-        for i in range(len(self.stateHistory)):
-            self.stateHistory[i, :2] = self.scale_m@(self.stateHistory[i, :2] - self.gps_min) + self.scale_c
+        self.stateHistory[:, :2] = self.scale_m@(self.stateHistory[:, :2] - self.gps_min) + self.scale_c
 
     def scalePoint(self, point: np.ndarray):
         point = self.scale_m@(point - self.gps_min) + self.scale_c
@@ -212,15 +415,13 @@ class Simulation:
 
     def drawGPSPoints(self, screen):
         "Draw GPS points"
-        for i in range(len(self.data)):
-            centre = np.array([[self.data.at(i)["gpsX"]], [self.data.at(i)["gpsY"]]])
-            centre = self.scale_m @ (centre - self.gps_min) + self.scale_c
-            pygame.draw.circle(screen, 'red', (centre[0,0], centre[1,0]), 3)
+        for centre in self.gpsPoints:
+            pygame.draw.circle(screen, 'red', centre, 3)
 
     def drawGPS(self, screen):
         "Draw GPS dot, shows on GPS update"
         centre = (1100, 500)
-        if self.filter.gpsUpdated[self.i]:
+        if self.gpsHistory[self.i]:
             pygame.draw.circle(screen, 'red', centre, 50)
 
     def clip(self, start: int, end:int):
@@ -0,0 +1,48 @@
+import numpy as np
+
+# Records per batch of smoother gains, bounds memory in spill mode
+SMOOTH_CHUNK: int = 4096
+
+
+def rtsSmooth(states: np.ndarray, covariances: np.ndarray, predictedStates: np.ndarray,
+              predictedCovariances: np.ndarray, F: np.ndarray, chunk: int = SMOOTH_CHUNK):
+    """Rauch-Tung-Striebel backward pass over a finished filter run
+    Overwrites states and covariances with the smoothed values, works on
+    memory mapped histories one chunk at a time
+    -------
+    Parameters
+    states : np.ndarray
+        (N, 6) updated states
+    covariances : np.ndarray
+        (N, 6, 6) updated covariances
+    predictedStates : np.ndarray
+        (N, 6) predicted states
+    predictedCovariances : np.ndarray
+        (N, 6, 6) predicted covariances
+    F : np.ndarray
+        (6, 6) state transition matrix used by the filter, or (N, 6, 6)
+        the transition into each record
+    chunk : int
+        Records per batch of smoother gains (default SMOOTH_CHUNK)
+    """
+    n = len(states)
+    for hi in range(n - 1, 0, -chunk):
+        lo = max(0, hi - chunk)
+        Pf = covariances[lo:hi+1]
+        Pp = predictedCovariances[lo+1:hi+1]
+        xf = states[lo:hi+1]
+        xp = predictedStates[lo+1:hi+1]
+
+        # Gains don't depend on the smoothed values so are solved together
+        # C_k = Pf_k F' Pp_k+1^-1, Pp is symmetric so C_k' = Pp_k+1^-1 F Pf_k
+        Fk = F if F.ndim == 2 else F[lo+1:hi+1]
+        C = np.linalg.solve(Pp, Fk@Pf[:-1])
+        Ct = C.transpose(0, 2, 1)
+
+        for j in range(hi - lo - 1, -1, -1):
+            d = xf[j+1] - xp[j]
+            d[4] = (d[4] + 180) % 360 - 180
+            xf[j] += Ct[j]@d
+            Pf[j] += Ct[j]@(Pf[j+1] - Pp[j])@C[j]
+
+    states[:, 4] %= 360
@@ -0,0 +1,261 @@
+import math
+import numpy as np
+import time
+from libs.KalmanFilter import KalmanFilter
+from libs.Replay import BLOCKS
+
+# Telemetry records per gps fix (10 Hz telemetry, 1 Hz gps)
+GPS_PERIOD: int = 10
+
+# Records without a gps fix covered by the gain tables
+MAX_OUTAGE: int = 50
+
+# Gps fixes run through the full filter before using constant gains
+WARMUP_FIXES: int = 20
+
+RICCATI_TOL: float = 1e-12
+RICCATI_ITERATIONS: int = 10000
+
+
+class SteadyStateKalmanFilter(KalmanFilter):
+    def __init__(self, gpsPeriod: int = GPS_PERIOD, maxOutage: int = MAX_OUTAGE, warmupFixes: int = WARMUP_FIXES):
+        """KalmanFilter with constant position gains once P has converged
+        The x and y blocks have fixed gps noise, their gains for each record
+        since the last fix come from the periodic solution of the discrete
+        Riccati equation so their covariance is not propagated. The course
+        noise changes every fix so the heading block is still updated
+        exactly, as plain floats, and written back to P with the tabulated
+        position blocks after every update. Falls back to the full filter
+        for warm up, gps outages longer than maxOutage and whenever dt or the
+        parameters change
+        -------
+        Parameters
+        gpsPeriod : int
+            Records per gps fix the gains are solved for (default GPS_PERIOD)
+        maxOutage : int
+            Records without gps before falling back (default MAX_OUTAGE)
+        warmupFixes : int
+            Full filter gps fixes before using constant gains (default WARMUP_FIXES)
+        """
+        self.gpsPeriod = gpsPeriod
+        self.maxOutage = maxOutage
+        self.warmupFixes = warmupFixes
+        self.gainKey = None
+        super().__init__()
+
+    def reset(self):
+        """Set all states to initial defaults, back to the full filter"""
+        super().reset()
+        self.steady = False
+        self.phase = 0 # Records since the last gps fix
+        self.fixes = 0 # Full filter gps fixes since warm up started
+        self.lastDt = None
+
+    def key(self, dt: float) -> tuple[float, ...]:
+        "Everything the gains depend on, except Q"
+        return (dt, self.b1, self.b2, self.gpsNoise, self.gyroNoise)
+
+    def isBlockDiagonal(self) -> bool:
+        """Check P and Q have no terms coupling the state blocks
+        -------
+        Return whether constant gains can be used : bool
+        """
+        mask = np.ones((6, 6), dtype=bool)
+        for block in BLOCKS:
+            mask[np.ix_(block, block)] = False
+        return not (np.any(self.P[mask]) or np.any(self.Q[mask]))
+
+    def solveGains(self, dt: float):
+        """Solve the periodic Riccati equation for a gps fix every gpsPeriod
+        records, then tabulate gps gains for each record since the last fix.
+        Call again after changing Q
+        -------
+        Parameters
+        dt : float
+            Fixed delta time the gains are for
+        """
+        F = self.transition(dt)
+        Q = self.Q
+        # Course noise doesn't reach the position blocks
+        R = np.diag([self.gpsNoise, self.gpsNoise, self.gpsAngleNoise, self.gyroNoise])
+        H = [0, 1, 4, 5]
+
+        def predictP(P):
+            return F@P@F.T + Q
+
+        def gyroUpdate(P):
+            k = P[:, 5] / (P[5, 5] + self.gyroNoise)
+            return P - np.outer(k, P[5])
+
+        def gpsUpdate(P):
+            PHt = P[:, H]
+            K = np.linalg.solve(PHt[H] + R, PHt.T).T
+            return P - K@PHt.T
+
+        # Fixed point of one gps period, P just after a fix
+        P = np.diag(np.diag(self.P)) + Q
+        for _ in range(RICCATI_ITERATIONS):
+            Pn = P
+            for _ in range(self.gpsPeriod - 1):
+                Pn = gyroUpdate(predictP(Pn))
+            Pn = gpsUpdate(predictP(Pn))
+            converged = np.max(np.abs(Pn - P)) <= RICCATI_TOL*np.max(np.abs(Pn))
+            P = Pn
+            if converged:
+                break
+        else:
+            print("Riccati iteration did not converge")
+
+        # Index is records since the last fix
+        self.posteriors = [P]
+        self.gpsGains = [None]
+        for _ in range(self.maxOutage):
+            P = predictP(P)
+            sx = P[0, 0] + self.gpsNoise
+            sy = P[1, 1] + self.gpsNoise
+            self.gpsGains.append((float(P[0, 0] / sx), float(P[2, 0] / sx),
+                                  float(P[1, 1] / sy), float(P[3, 1] / sy), float(sx), float(sy)))
+            P = gyroUpdate(P)
+            self.posteriors.append(P)
+        self.gainKey = self.key(dt)
+
+    def enterSteady(self):
+        "Switch to constant gains straight after a gps fix"
+        if self.gainKey != self.key(self.lastDt):
+            self.solveGains(self.lastDt)
+        self.p44 = self.P.item(4, 4)
+        self.p45 = self.P.item(4, 5)
+        self.p55 = self.P.item(5, 5)
+        self.steady = True
+
+    def steadyCovariance(self):
+        "Set P from the tabulated covariance and the heading block floats"
+        self.P = P = self.posteriors[min(self.phase, self.maxOutage)].copy()
+        P[4, 4] = self.p44
+        P[4, 5] = P[5, 4] = self.p45
+        P[5, 5] = self.p55
+
+    def fallBack(self):
+        "Continue with the full filter from the tabulated covariance"
+        self.steadyCovariance()
+        self.steady = False
+        self.fixes = 0
+
+    def predict(self, u: np.ndarray, dt: float):
+        """ Kalman filter predit cycle, x and heading block only when steady
+        Parameters
+        --------
+        u : np.ndarry
+            Input (motor) matrix
+        dt : float
+            Delta time
+        """
+        self.lastDt = dt
+        if self.steady and (self.phase >= self.maxOutage or self.key(dt) != self.gainKey):
+            self.fallBack()
+        self.phase += 1
+        if not self.steady:
+            super().predict(u, dt)
+            return
+
+        if self.metrics is not None:
+            start = time.perf_counter()
+
+        # x = Fx + Bu, on floats
+        x0, x1, vx, vy, theta, w = self.x[:, 0].tolist()
+        theta_r = math.radians(theta)
+        uL, uR = u[:, 0].tolist()
+        bs = self.motorForce*dt*math.sin(theta_r)
+        bc = self.motorForce*dt*math.cos(theta_r)
+        bt = self.motorTorque*dt
+        a1 = 1.-dt*self.b1
+        a2 = 1-dt*self.b2
+        self.x[:, 0] = (x0 + dt*vx, x1 + dt*vy, a1*vx + (bs*uL + bs*uR), a1*vy + (bc*uL + bc*uR),
+                        self.wrap360(theta + dt*w), a2*w + (bt*uL + -bt*uR))
+
+        # Heading block P = FPF' + Q
+        p45 = self.p45
+        p55 = self.p55
+        self.p44 += dt*(2*p45 + dt*p55) + self.Q.item(4, 4)
+        self.p45 = a2*(p45 + dt*p55) + self.Q.item(4, 5)
+        self.p55 = a2*a2*p55 + self.Q.item(5, 5)
+        if self.metrics is not None:
+            self.metrics.recordPredict(time.perf_counter() - start, dt)
+
+    def headingUpdate(self, state: int, y: float, r: float) -> float:
+        """Scalar update of the heading block floats
+        --------
+        Parameters
+        state : int
+            4 (heading) or 5 (heading rate)
+        y : float
+            Innovation
+        r : float
+            Measurement noise variance
+        -------
+        Return innovation variance s : float
+        """
+        p44, p45, p55 = self.p44, self.p45, self.p55
+        if state == 4:
+            c4, c5, s = p44, p45, p44 + r
+        else:
+            c4, c5, s = p45, p55, p55 + r
+        k4 = c4 / s
+        k5 = c5 / s
+        self.x[4:, 0] = (self.x.item(4) + k4*y, self.x.item(5) + k5*y)
+        self.p44 = p44 - k4*c4
+        self.p45 = p45 - k4*c5
+        self.p55 = p55 - k5*c5
+        return s
+
+    def update_gps(self, data: dict):
+        """Kalman filter update with gps data (and gyro)
+        --------
+        Parameters
+        data : dict
+            Dict containing updated gps data
+        """
+        if not self.steady:
+            super().update_gps(data)
+            self.phase = 0
+            self.fixes += 1
+            if self.fixes >= self.warmupFixes and self.lastDt is not None and self.isBlockDiagonal():
+                self.enterSteady()
+            return
+
+        recording = self.recording
+        if recording:
+            start = time.perf_counter()
+        x0, x1, vx, vy, theta, w = self.x[:, 0].tolist()
+        kx, kvx, ky, kvy, sx, sy = self.gpsGains[self.phase]
+        yx = data['gpsX'] - x0
+        yy = data['gpsY'] - x1
+        self.x[:4, 0] = (x0 + kx*yx, x1 + ky*yy, vx + kvx*yx, vy + kvy*yy)
+        yc = self.wrap180(data['course_gps'] - theta)
+        sc = self.headingUpdate(4, yc, max([0., self.gpsAngleNoise*(0.5 - data['dist_gps'])]))
+        yr = data['rz'] - self.x.item(5)
+        sr = self.headingUpdate(5, yr, self.gyroNoise)
+        self.phase = 0
+        self.steadyCovariance()
+        if recording:
+            self.recordUpdate(True, (yx, yy, yc, data['rz'] - w), yx*yx/sx + yy*yy/sy + yc*yc/sc + yr*yr/sr,
+                              time.perf_counter() - start)
+
+    def update_nogps(self, data: dict):
+        """Kalman filter update without gps data (just gyro)
+        --------
+        Parameters
+        data : dict
+            Dict containing gyro data
+        """
+        if not self.steady:
+            super().update_nogps(data)
+            return
+        recording = self.recording
+        if recording:
+            start = time.perf_counter()
+        y = -data['rz'] - self.x.item(5)
+        s = self.headingUpdate(5, y, self.gyroNoise)
+        self.steadyCovariance()
+        if recording:
+            self.recordUpdate(False, (y,), y*y/s, time.perf_counter() - start)
@@ -0,0 +1,79 @@
+import numpy as np
+from libs.TelemetryStore import TelemetryStore
+from libs.TimeIndex import TimeIndex
+
+JOIN_DIRECTIONS: tuple[str, ...] = ('backward', 'forward', 'nearest')
+
+
+def asofIndex(times: np.ndarray, other: TimeIndex, direction: str = 'backward',
+              tolerance: float | None = None) -> np.ndarray:
+    """Record of other matching each time, -1 where nothing matches
+    -------
+    Parameters
+    times : np.ndarray
+        Times to match, any order
+    other : TimeIndex
+        Records to match against
+    direction : str
+        'backward' last record at or before, 'forward' first record at or
+        after, 'nearest' closest either way, ties go backward (default 'backward')
+    tolerance : float | None
+        Furthest a match can be (s) (default None, any distance)
+    -------
+    Return indexes into other : np.ndarray
+    """
+    if direction not in JOIN_DIRECTIONS:
+        raise ValueError(f"Unknown join direction {direction}, expected one of {JOIN_DIRECTIONS}")
+    times = np.asarray(times, dtype=np.float64)
+    t = other.timestamps
+    n = len(t)
+    if n == 0:
+        return np.full(len(times), -1)
+    before = np.searchsorted(t, times, side='right') - 1
+    after = np.searchsorted(t, times, side='left')
+    if direction == 'backward':
+        index = before
+    elif direction == 'forward':
+        index = np.where(after < n, after, -1)
+    else:
+        gapBefore = np.where(before >= 0, times - t[np.maximum(before, 0)], np.inf)
+        gapAfter = np.where(after < n, t[np.minimum(after, n - 1)] - times, np.inf)
+        index = np.where(gapBefore <= gapAfter, before, np.where(after < n, after, -1))
+    if tolerance is not None:
+        far = np.abs(t[np.maximum(index, 0)] - times) > tolerance
+        index = np.where(far, -1, index)
+    if other.order is not None:
+        index = np.where(index >= 0, other.order[np.maximum(index, 0)], -1)
+    return index
+
+
+def asofJoin(left: TelemetryStore, right: TelemetryStore, prefix: str = 'right_',
+             direction: str = 'backward', tolerance: float | None = None) -> TelemetryStore:
+    """Attach to each left record the matching right record by timestamp,
+    eg. the kalman packet received with each telemetry packet
+    Right columns are prefixed and are nan where nothing matches, the
+    matched right timestamp is kept as prefix + 'timestamp'
+    -------
+    Parameters
+    left : TelemetryStore
+        Records to keep, one row each
+    right : TelemetryStore
+        Records to match
+    prefix : str
+        Added to right field names (default 'right_')
+    direction : str
+        See asofIndex (default 'backward')
+    tolerance : float | None
+        Furthest a match can be (s) (default None, any distance)
+    """
+    index = asofIndex(left['timestamp'], right.index, direction, tolerance)
+    missing = index < 0
+    columns = dict(left.columns)
+    for field, column in right.columns.items():
+        name = prefix + field
+        if name in columns:
+            raise ValueError(f"Joined field {name} is in both stores, use another prefix")
+        values = np.asarray(column, dtype=np.float64)[np.maximum(index, 0)] if len(column) else np.zeros(len(index))
+        values[missing] = np.nan
+        columns[name] = values
+    return TelemetryStore(columns)
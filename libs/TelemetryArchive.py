@@ -0,0 +1,285 @@
+import bz2
+import json
+import lzma
+import os
+import struct
+import zlib
+import numpy as np
+from typing import Iterator
+from libs.TelemetryStore import TelemetryStore
+
+# Long term telemetry storage
+# header : magic, version (HEADER_SIZE bytes)
+# chunks : each column of each chunk compressed on its own
+# index  : json list of chunks with their time range and column blocks
+# footer : index offset, index size, magic
+# Columns are byte shuffled, DELTA_FIELDS are delta coded on their integer
+# bit patterns first so decoding is lossless
+
+ARCHIVE_MAGIC: bytes = b'BOATARC\0'
+ARCHIVE_VERSION: int = 1
+ARCHIVE_EXT: str = ".arc"
+HEADER = struct.Struct('<8sH')
+HEADER_SIZE: int = 16
+FOOTER = struct.Struct('<QQ8s')
+
+# Records per chunk
+ARCHIVE_CHUNK: int = 4096
+
+# Slowly changing columns, mostly small steps
+DELTA_FIELDS: tuple[str, ...] = ('timestamp', 'gpsX', 'gpsY', 'lat', 'lng', 'x', 'y')
+
+# Stdlib codecs, (compress, decompress)
+CODECS: dict[str, tuple] = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+}
+
+# Same size integers for delta coding bit patterns
+INT_TYPES: dict[int, str] = {1: '<i1', 2: '<i2', 4: '<i4', 8: '<i8'}
+
+
+def encodeColumn(column: np.ndarray, delta: bool) -> tuple[str, bytes]:
+    """Byte shuffle (and delta code) a column ready to compress
+    -------
+    Parameters
+    column : np.ndarray
+        Numeric column
+    delta : bool
+        Delta code the integer bit patterns
+    -------
+    Return little endian dtype, encoded bytes : tuple[str, bytes]
+    """
+    dtype = column.dtype.newbyteorder('<')
+    if dtype.itemsize not in INT_TYPES:
+        raise ValueError(f"Can't archive {column.dtype} columns")
+    bits = np.ascontiguousarray(column, dtype=dtype).view(INT_TYPES[dtype.itemsize])
+    if delta:
+        bits = np.diff(bits, prepend=bits.dtype.type(0))
+    return dtype.str, bits.view(np.uint8).reshape(-1, dtype.itemsize).T.tobytes()
+
+
+def decodeColumn(data: bytes, dtype: str, delta: bool) -> np.ndarray:
+    """Undo encodeColumn
+    -------
+    Parameters
+    data : bytes
+        Decompressed column block
+    dtype : str
+        Column dtype
+    delta : bool
+        Block is delta coded
+    -------
+    Return column : np.ndarray
+    """
+    dtype = np.dtype(dtype)
+    planes = np.frombuffer(data, np.uint8).reshape(dtype.itemsize, -1)
+    bits = np.ascontiguousarray(planes.T).view(INT_TYPES[dtype.itemsize]).ravel()
+    if delta:
+        bits = np.cumsum(bits, dtype=bits.dtype)
+    return bits.view(dtype)
+
+
+class ArchiveWriter:
+    def __init__(self, filename: str, chunkRecords: int = ARCHIVE_CHUNK, codec: str = 'zlib'):
+        """Writes telemetry to a chunked compressed archive, the index is
+        written on close
+        -------
+        Parameters
+        filename : str
+            Archive file, overwritten
+        chunkRecords : int
+            Records per chunk (default ARCHIVE_CHUNK)
+        codec : str
+            Key of CODECS (default 'zlib')
+        """
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec}, expected one of {tuple(CODECS)}")
+        self.filename = filename
+        self.chunkRecords = chunkRecords
+        self.codec = codec
+        self.compress = CODECS[codec][0]
+        self.chunks: list[dict] = []
+        self.pending: list[TelemetryStore] = []
+        self.pendingRecords = 0
+        self.file = open(filename, 'wb')
+        self.file.write(HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION).ljust(HEADER_SIZE, b'\0'))
+
+    def write(self, store: TelemetryStore):
+        """Add records, full chunks are compressed straight away
+        -------
+        Parameters
+        store : TelemetryStore
+            Records to add, after those already written
+        """
+        self.pending.append(store)
+        self.pendingRecords += len(store)
+        if self.pendingRecords < self.chunkRecords:
+            return
+        joined = TelemetryStore.concat(self.pending)
+        end = len(joined) - len(joined) % self.chunkRecords
+        for i in range(0, end, self.chunkRecords):
+            self.writeChunk(joined[i:i+self.chunkRecords])
+        self.pendingRecords = len(joined) - end
+        self.pending = [joined[end:]] if self.pendingRecords else []
+
+    def writeChunk(self, chunk: TelemetryStore):
+        "Compress and write one chunk"
+        columns = []
+        for field, column in chunk.columns.items():
+            delta = field in DELTA_FIELDS
+            dtype, data = encodeColumn(column, delta)
+            block = self.compress(data)
+            columns.append([field, dtype, delta, self.file.tell(), len(block)])
+            self.file.write(block)
+        tmin = tmax = float('nan')
+        if 'timestamp' in chunk and len(chunk):
+            tmin = float(np.min(chunk['timestamp']))
+            tmax = float(np.max(chunk['timestamp']))
+        self.chunks.append({'records': len(chunk), 'tmin': tmin, 'tmax': tmax, 'columns': columns})
+
+    def close(self):
+        "Write the last partial chunk and the index"
+        if self.pendingRecords:
+            self.writeChunk(TelemetryStore.concat(self.pending))
+        self.pending = []
+        self.pendingRecords = 0
+        index = json.dumps({'codec': self.codec, 'chunks': self.chunks}).encode()
+        offset = self.file.tell()
+        self.file.write(index)
+        self.file.write(FOOTER.pack(offset, len(index), ARCHIVE_MAGIC))
+        self.file.close()
+
+
+class Archive:
+    def __init__(self, filename: str):
+        """Reads a chunked archive, only the index is read here, chunks
+        are decompressed when asked for
+        -------
+        Parameters
+        filename : str
+            Archive file
+        """
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        magic, version = HEADER.unpack_from(self.file.read(HEADER_SIZE))
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError(f"{filename} is not a telemetry archive")
+        if version != ARCHIVE_VERSION:
+            raise ValueError(f"{filename} is archive version {version}, can read {ARCHIVE_VERSION}")
+        if os.path.getsize(filename) < HEADER_SIZE + FOOTER.size:
+            raise ValueError(f"{filename} has no index, it wasn't closed")
+        self.file.seek(-FOOTER.size, 2)
+        offset, size, magic = FOOTER.unpack(self.file.read(FOOTER.size))
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError(f"{filename} has no index, it wasn't closed")
+        self.file.seek(offset)
+        index = json.loads(self.file.read(size))
+        self.decompress = CODECS[index['codec']][1]
+        self.chunks: list[dict] = index['chunks']
+        self.tmin = np.array([chunk['tmin'] for chunk in self.chunks])
+        self.tmax = np.array([chunk['tmax'] for chunk in self.chunks])
+
+    def chunk(self, i: int, fields: list[str] | None = None) -> TelemetryStore:
+        """Decompress one chunk
+        -------
+        Parameters
+        i : int
+            Chunk number
+        fields : list[str] | None
+            Columns to decompress (default all)
+        """
+        columns = {}
+        for field, dtype, delta, offset, size in self.chunks[i]['columns']:
+            if fields is not None and field not in fields:
+                continue
+            self.file.seek(offset)
+            columns[field] = decodeColumn(self.decompress(self.file.read(size)), dtype, delta)
+        return TelemetryStore(columns)
+
+    def iterChunks(self, fields: list[str] | None = None) -> Iterator[TelemetryStore]:
+        """Yield every chunk in order, eg. for Simulation.stream
+        -------
+        Parameters
+        fields : list[str] | None
+            Columns to decompress (default all)
+        """
+        for i in range(len(self.chunks)):
+            yield self.chunk(i, fields)
+
+    def window(self, t0: float, t1: float, fields: list[str] | None = None) -> TelemetryStore:
+        """Records with timestamps in [t0, t1), only decompressing the
+        chunks whose time range overlaps
+        -------
+        Parameters
+        t0 : float
+            Start time
+        t1 : float
+            End time
+        fields : list[str] | None
+            Columns besides timestamp (default all)
+        """
+        if fields is not None and 'timestamp' not in fields:
+            fields = ['timestamp', *fields]
+        overlap = np.flatnonzero((self.tmax >= t0) & (self.tmin < t1))
+        if len(overlap) == 0:
+            return TelemetryStore({field: np.zeros(0) for field in fields or self.fields})
+        return TelemetryStore.concat(self.chunk(i, fields) for i in overlap).window(t0, t1)
+
+    @property
+    def fields(self) -> list[str]:
+        "Columns of the first chunk"
+        return [column[0] for column in self.chunks[0]['columns']] if self.chunks else []
+
+    def toStore(self, fields: list[str] | None = None) -> TelemetryStore:
+        "Decompress everything"
+        return TelemetryStore.concat(self.iterChunks(fields))
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        "Records in the archive"
+        return sum(chunk['records'] for chunk in self.chunks)
+
+
+def archiveStores(stores, filename: str, chunkRecords: int = ARCHIVE_CHUNK, codec: str = 'zlib') -> int:
+    """Write stores (eg. JsonStream.iterChunks) to a new archive
+    -------
+    Parameters
+    stores : Iterable[TelemetryStore]
+        Telemetry in record order
+    filename : str
+        Archive file
+    chunkRecords : int
+        Records per chunk (default ARCHIVE_CHUNK)
+    codec : str
+        Key of CODECS (default 'zlib')
+    -------
+    Return records written : int
+    """
+    writer = ArchiveWriter(filename, chunkRecords, codec)
+    records = 0
+    for store in stores:
+        writer.write(store)
+        records += len(store)
+    writer.close()
+    return records
+
+
+def iterArchive(filename: str, fields: list[str] | None = None) -> Iterator[TelemetryStore]:
+    """Yield every chunk of an archive file, eg. for Simulation.stream, the
+    file is only open while iterating
+    -------
+    Parameters
+    filename : str
+        Archive file
+    fields : list[str] | None
+        Columns to decompress (default all)
+    """
+    archive = Archive(filename)
+    try:
+        yield from archive.iterChunks(fields)
+    finally:
+        archive.close()
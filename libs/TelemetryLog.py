@@ -0,0 +1,187 @@
+import os
+import struct
+import numpy as np
+from libs.TelemetryStore import TelemetryStore
+
+# Binary log of BLE packets
+# header  : magic, version, record size, schema name (HEADER_SIZE bytes)
+# records : <d host timestamp followed by the raw packet payload
+
+LOG_MAGIC: bytes = b'BOATLOG\0'
+LOG_VERSION: int = 1
+HEADER = struct.Struct('<8sHH16s')
+HEADER_SIZE: int = 32
+LOG_EXT: str = ".bin"
+
+# Payload struct format and field names of each packet type
+SCHEMAS: dict[str, tuple[str, tuple[str, ...]]] = {
+    'telem': ('<ddddfffff', ('gpsX', 'gpsY', 'lat', 'lng', 'powerLeft', 'powerRight',
+                             'rz', 'wpHeading', 'wpDist')),
+    'kalman': ('<ffffff', ('x', 'y', 'dx', 'dy', 'heading', 'd_heading')),
+}
+
+# struct format characters to numpy types
+FORMAT_TYPES: dict[str, str] = {'d': '<f8', 'f': '<f4', 'i': '<i4', 'I': '<u4'}
+
+TIMESTAMP = struct.Struct('<d')
+
+
+def recordDtype(schema: str) -> np.dtype:
+    """Numpy structured dtype of a log record
+    -------
+    Parameters
+    schema : str
+        Key of SCHEMAS
+    -------
+    Return dtype : np.dtype
+    """
+    fmt, fields = SCHEMAS[schema]
+    types = [FORMAT_TYPES[c] for c in fmt.lstrip('<')]
+    return np.dtype([('timestamp', '<f8')] + list(zip(fields, types)))
+
+
+def readHeader(filename: str) -> tuple[str, int]:
+    """Read and check a log header
+    -------
+    Parameters
+    filename : str
+        Log file
+    -------
+    Return schema, record size : tuple[str, int]
+    """
+    with open(filename, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    if len(raw) < HEADER_SIZE:
+        raise ValueError(f"{filename} is too short for a log header")
+    magic, version, size, schema = HEADER.unpack_from(raw)
+    if magic != LOG_MAGIC:
+        raise ValueError(f"{filename} is not a telemetry log")
+    if version != LOG_VERSION:
+        raise ValueError(f"{filename} is log version {version}, can read {LOG_VERSION}")
+    schema = schema.rstrip(b'\0').decode('ascii')
+    if schema not in SCHEMAS or recordDtype(schema).itemsize != size:
+        raise ValueError(f"{filename} has unknown schema {schema} ({size} byte records)")
+    return schema, size
+
+
+def readLog(filename: str) -> np.ndarray:
+    """Memory map a log as a structured array, no copy is made
+    A partly written last record (eg. from a crash) is left out
+    -------
+    Parameters
+    filename : str
+        Log file
+    -------
+    Return (N,) records with timestamp and the schema fields : np.ndarray
+    """
+    schema, size = readHeader(filename)
+    n = (os.path.getsize(filename) - HEADER_SIZE) // size
+    if n == 0:
+        return np.zeros(0, dtype=recordDtype(schema))
+    return np.memmap(filename, dtype=recordDtype(schema), mode='r', offset=HEADER_SIZE, shape=(n,))
+
+
+def logToStore(filename: str) -> TelemetryStore:
+    """Load a log as a TelemetryStore of views onto the memory map
+    -------
+    Parameters
+    filename : str
+        Log file
+    """
+    records = readLog(filename)
+    return TelemetryStore({field: records[field] for field in records.dtype.names})
+
+
+def logToJson(filename: str, jsonFile: str, chunk: int = 4096) -> int:
+    """Export a log as DataRecorder json, a chunk of records at a time so
+    memory doesn't grow with the log
+    -------
+    Parameters
+    filename : str
+        Log file
+    jsonFile : str
+        Json file to write
+    chunk : int
+        Records converted at once (default 4096)
+    -------
+    Return records written : int
+    """
+    store = logToStore(filename)
+    store.toJson(jsonFile, chunk)
+    return len(store)
+
+
+class LogWriter:
+    def __init__(self, filename: str, schema: str):
+        """Append only writer of one packet type, records are flushed as
+        they are written unless appended with flush=False
+        -------
+        Parameters
+        filename : str
+            Log file, appended to if it exists with the same schema
+        schema : str
+            Key of SCHEMAS
+        """
+        self.filename = filename
+        self.schema = schema
+        self.payloadSize = struct.calcsize(SCHEMAS[schema][0])
+        self.recordSize = TIMESTAMP.size + self.payloadSize
+        self.records = 0
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            existing, size = readHeader(filename)
+            if existing != schema:
+                raise ValueError(f"{filename} is a {existing} log, not {schema}")
+            self.records = (os.path.getsize(filename) - HEADER_SIZE) // size
+            # Drop a partly written last record
+            os.truncate(filename, HEADER_SIZE + self.records*size)
+            self.file = open(filename, 'ab')
+        else:
+            self.file = open(filename, 'wb')
+            header = HEADER.pack(LOG_MAGIC, LOG_VERSION, self.recordSize, schema.encode('ascii'))
+            self.file.write(header.ljust(HEADER_SIZE, b'\0'))
+            self.file.flush()
+
+    @property
+    def size(self) -> int:
+        "Bytes in the log"
+        return HEADER_SIZE + self.records*self.recordSize
+
+    def append(self, timestamp: float, payload: bytes, flush: bool = True):
+        """Write a record
+        -------
+        Parameters
+        timestamp : float
+            Host receive time
+        payload : bytes
+            Raw packet, packed with the schema format
+        flush : bool
+            Flush to the file straight away (default True)
+        """
+        if len(payload) != self.payloadSize:
+            raise ValueError(f"{self.schema} payload is {len(payload)} bytes, expected {self.payloadSize}")
+        self.file.write(TIMESTAMP.pack(timestamp) + payload)
+        self.records += 1
+        if flush:
+            self.file.flush()
+
+    def appendRecords(self, records: np.ndarray, flush: bool = True):
+        """Write a batch of records in one go
+        -------
+        Parameters
+        records : np.ndarray
+            (N,) records of recordDtype(schema), eg. from PacketBuffer.drain
+        flush : bool
+            Flush to the file straight away (default True)
+        """
+        if records.dtype != recordDtype(self.schema):
+            raise ValueError(f"Records are {records.dtype}, expected {self.schema} records")
+        self.file.write(records.tobytes())
+        self.records += len(records)
+        if flush:
+            self.file.flush()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
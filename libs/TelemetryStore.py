@@ -0,0 +1,183 @@
+import json
+import numpy as np
+from libs.TimeIndex import TimeIndex
+
+
+def columnsFromRecords(records: list[dict[str, float]]) -> dict[str, np.ndarray]:
+    """Convert DataRecorder records to one array per field
+    Fields missing from some records are nan there
+    -------
+    Parameters
+    records : list[dict[str, float]]
+        List of timestamped dict telemetry
+    -------
+    Return {field: column} : dict[str, np.ndarray]
+    """
+    fields: dict[str, None] = {}
+    for record in records:
+        for field in record:
+            fields.setdefault(field)
+    n = len(records)
+    return {field: np.fromiter((record.get(field, np.nan) for record in records), np.float64, n)
+            for field in fields}
+
+
+class TelemetryStore:
+    def __init__(self, columns: dict[str, np.ndarray]):
+        """Columnar telemetry, one numpy array per field
+        Columns are returned without copying, slices share memory
+        -------
+        Parameters
+        columns : dict[str, np.ndarray]
+            Equal length columns by field name
+        """
+        lengths = {len(column) for column in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"Columns have different lengths {sorted(lengths)}")
+        self.columns = {field: np.asarray(column) for field, column in columns.items()}
+        self.length = lengths.pop() if lengths else 0
+        self.timeIndex: TimeIndex | None = None
+
+    @classmethod
+    def fromRecords(cls, records: list[dict[str, float]]) -> 'TelemetryStore':
+        """Create from DataRecorder records
+        -------
+        Parameters
+        records : list[dict[str, float]]
+            List of timestamped dict telemetry
+        """
+        return cls(columnsFromRecords(records))
+
+    @classmethod
+    def load(cls, filename: str) -> 'TelemetryStore':
+        """Load a DataRecorder json file
+        -------
+        Parameters
+        filename : str
+            Telemetry json file
+        """
+        with open(filename, 'r') as f:
+            return cls.fromRecords(json.load(f))
+
+    @classmethod
+    def concat(cls, stores) -> 'TelemetryStore':
+        """Join stores end to end, fields missing from a store are nan there
+        -------
+        Parameters
+        stores : Iterable[TelemetryStore]
+            Stores in record order
+        """
+        stores = list(stores)
+        fields: dict[str, None] = {}
+        for store in stores:
+            for field in store.fields:
+                fields.setdefault(field)
+        return cls({field: np.concatenate([store.columns[field] if field in store
+                                           else np.full(len(store), np.nan) for store in stores])
+                    for field in fields})
+
+    @property
+    def fields(self) -> list[str]:
+        return list(self.columns)
+
+    def __getitem__(self, item):
+        """Column by field name, or a store of the same class of a slice or
+        index array of records
+        ------
+        Return column : np.ndarray"""
+        if isinstance(item, (slice, np.ndarray)):
+            return type(self)({field: column[item] for field, column in self.columns.items()})
+        return self.columns[item]
+
+    def __contains__(self, field: str) -> bool:
+        return field in self.columns
+
+    @property
+    def index(self) -> TimeIndex:
+        "Time index of the timestamp column, built on first use"
+        if self.timeIndex is None:
+            if 'timestamp' not in self.columns:
+                raise ValueError("Telemetry has no timestamp column to index")
+            self.timeIndex = TimeIndex(self.columns['timestamp'])
+        return self.timeIndex
+
+    def window(self, t0: float | None = None, t1: float | None = None) -> 'TelemetryStore':
+        """Records with timestamps in [t0, t1) in time order, columns are
+        views unless the timestamps go backwards
+        -------
+        Parameters
+        t0 : float | None
+            Start time (default first record)
+        t1 : float | None
+            End time (default past the last record)
+        """
+        index = self.index
+        return self[index.records(index.slice(t0, t1))]
+
+    def resample(self, dt: float, fields: list[str] | None = None, method: str = 'linear',
+                 maxGap: float | None = None, t0: float | None = None, t1: float | None = None) -> 'TelemetryStore':
+        """Columns on a uniform clock, see TimeIndex.resample
+        -------
+        Parameters
+        dt : float
+            Sample period (s)
+        fields : list[str] | None
+            Columns to resample (default all)
+        method : str
+            'linear', 'previous' or 'nearest' (default 'linear')
+        maxGap : float | None
+            Samples in longer gaps between records are nan (default None)
+        t0 : float | None
+            First sample (default first record)
+        t1 : float | None
+            Last possible sample (default last record)
+        """
+        index = self.index
+        clock = index.clock(dt, t0, t1)
+        fields = [field for field in (self.fields if fields is None else fields) if field != 'timestamp']
+        columns = {'timestamp': clock}
+        for field in fields:
+            columns[field] = index.resample(self.columns[field], clock, method, maxGap)
+        return type(self)(columns)
+
+    def at(self, idx: int) -> dict[str, float]:
+        """Get all data as dictionary at index
+        -------
+        Parameters
+        idx : int
+            Index to view raw telemetry
+        """
+        return {field: column.item(idx) for field, column in self.columns.items()}
+
+    def toRecords(self) -> list[dict[str, float]]:
+        """Back to DataRecorder records, eg(to save as json)
+        -------
+        Return list of timestamped dict telemetry : list[dict[str, float]]
+        """
+        fields = self.fields
+        return [dict(zip(fields, values)) for values in zip(*(column.tolist() for column in self.columns.values()))]
+
+    def toJson(self, filename: str, chunk: int = 4096):
+        """Save as DataRecorder json, a chunk of records at a time so memory
+        doesn't grow with the store
+        -------
+        Parameters
+        filename : str
+            Json file to write
+        chunk : int
+            Records converted at once (default 4096)
+        """
+        with open(filename, 'w') as f:
+            f.write('[')
+            for i in range(0, len(self), chunk):
+                if i:
+                    f.write(', ')
+                f.write(json.dumps(self[i:i+chunk].toRecords())[1:-1])
+            f.write(']')
+
+    def __len__(self):
+        """Allows for length checking len(TelemetryStore)
+        ------
+        Return length of telemetry : int
+        """
+        return self.length
@@ -0,0 +1,209 @@
+import numpy as np
+
+RESAMPLE_METHODS: tuple[str, ...] = ('linear', 'previous', 'nearest')
+
+# Record period for telemetry without timestamps
+DEFAULT_DT: float = 0.1
+
+
+def recordPeriod(timestamps: np.ndarray, default: float) -> float:
+    """Median time between records in record order, unlike TimeIndex.period
+    the timestamps may jump back
+    -------
+    Parameters
+    timestamps : np.ndarray
+        Record times (s)
+    default : float
+        Period when there aren't two records or the median isn't positive
+    -------
+    Return period (s) : float
+    """
+    if len(timestamps) > 1:
+        period = float(np.median(np.diff(timestamps)))
+        if period > 0:
+            return period
+    return default
+
+
+def recordDts(timestamps: np.ndarray, lastTime: float | None = None) -> np.ndarray:
+    """Time since the previous record in record order, 0 where the clock
+    jumps back, same as Simulation.step takes them
+    -------
+    Parameters
+    timestamps : np.ndarray
+        Record times (s)
+    lastTime : float | None
+        Time of the record before the first (default None, first is 0)
+    -------
+    Return delta times (s) : np.ndarray
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    dts = np.zeros(len(timestamps))
+    if len(timestamps) == 0:
+        return dts
+    dts[1:] = np.diff(timestamps)
+    if lastTime is not None:
+        dts[0] = timestamps[0] - lastTime
+    return np.maximum(dts, 0.)
+
+
+class TimeIndex:
+    def __init__(self, timestamps: np.ndarray):
+        """Binary searchable index of record times
+        Timestamps that go backwards (eg. the host clock being set) are
+        sorted, positions are then in time order and records() maps them
+        back to records
+        -------
+        Parameters
+        timestamps : np.ndarray
+            Record times (s)
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        # Record at each position, None when the records are in time order
+        self.order: np.ndarray | None = None
+        if np.any(np.diff(timestamps) < 0):
+            self.order = np.argsort(timestamps, kind='stable')
+            timestamps = timestamps[self.order]
+        self.timestamps = timestamps
+
+    @property
+    def start(self) -> float:
+        return self.timestamps.item(0)
+
+    @property
+    def end(self) -> float:
+        return self.timestamps.item(-1)
+
+    def records(self, positions: slice) -> slice | np.ndarray:
+        """Records at positions, eg. from slice or segments
+        -------
+        Parameters
+        positions : slice
+            Positions in time order
+        -------
+        Return the same slice when in order, else record indexes : slice | np.ndarray
+        """
+        if self.order is None:
+            return positions
+        return self.order[positions]
+
+    def inOrder(self, column: np.ndarray) -> np.ndarray:
+        "Column values in time order"
+        column = np.asarray(column)
+        return column if self.order is None else column[self.order]
+
+    def find(self, t: float) -> int:
+        "Position of the first record at or after t"
+        return int(np.searchsorted(self.timestamps, t, side='left'))
+
+    def slice(self, t0: float | None = None, t1: float | None = None) -> slice:
+        """Positions of records in [t0, t1)
+        -------
+        Parameters
+        t0 : float | None
+            Start time, inclusive (default first record)
+        t1 : float | None
+            End time, exclusive (default past the last record)
+        -------
+        Return position slice : slice
+        """
+        start = 0 if t0 is None else self.find(t0)
+        end = len(self) if t1 is None else self.find(t1)
+        return slice(start, max(start, end))
+
+    def dts(self) -> np.ndarray:
+        "Time since the previous position, 0 for the first : np.ndarray"
+        dts = np.zeros(len(self))
+        dts[1:] = np.diff(self.timestamps)
+        return dts
+
+    def period(self) -> float:
+        "Median time between records, nan with less than two records"
+        if len(self) < 2:
+            return np.nan
+        return float(np.median(np.diff(self.timestamps)))
+
+    def gaps(self, maxGap: float) -> np.ndarray:
+        """Positions that come more than maxGap after the one before
+        -------
+        Parameters
+        maxGap : float
+            Longest expected time between records (s)
+        -------
+        Return positions : np.ndarray
+        """
+        return np.flatnonzero(np.diff(self.timestamps) > maxGap) + 1
+
+    def segments(self, maxGap: float) -> list[slice]:
+        """Split into runs of records without gaps
+        -------
+        Parameters
+        maxGap : float
+            Longest expected time between records (s)
+        -------
+        Return position slices : list[slice]
+        """
+        bounds = [0, *self.gaps(maxGap).tolist(), len(self)]
+        return [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    def clock(self, dt: float, t0: float | None = None, t1: float | None = None) -> np.ndarray:
+        """Uniform times from t0 up to t1 inclusive
+        -------
+        Parameters
+        dt : float
+            Sample period (s)
+        t0 : float | None
+            First sample (default first record)
+        t1 : float | None
+            Last possible sample (default last record)
+        -------
+        Return sample times : np.ndarray
+        """
+        t0 = self.start if t0 is None else t0
+        t1 = self.end if t1 is None else t1
+        n = int(np.floor((t1 - t0)/dt + 1e-9)) + 1
+        return t0 + dt*np.arange(max(n, 0))
+
+    def resample(self, column: np.ndarray, clock: np.ndarray, method: str = 'linear',
+                 maxGap: float | None = None) -> np.ndarray:
+        """Values of a column at other times, nan outside the records
+        -------
+        Parameters
+        column : np.ndarray
+            Values of each record
+        clock : np.ndarray
+            Times to sample at, increasing
+        method : str
+            'linear' interpolation, 'previous' record (zero order hold) or
+            'nearest' record (default 'linear')
+        maxGap : float | None
+            Samples between records further apart than this are nan
+            (default None, fill every gap)
+        -------
+        Return resampled column : np.ndarray
+        """
+        if method not in RESAMPLE_METHODS:
+            raise ValueError(f"Unknown resample method {method}, expected one of {RESAMPLE_METHODS}")
+        t = self.timestamps
+        column = self.inOrder(column).astype(np.float64, copy=False)
+        clock = np.asarray(clock, dtype=np.float64)
+        if len(t) == 0:
+            return np.full(len(clock), np.nan)
+        after = np.searchsorted(t, clock, side='right')
+        before = np.maximum(after - 1, 0)
+        after = np.minimum(after, len(t) - 1)
+        if method == 'linear':
+            values = np.interp(clock, t, column)
+        elif method == 'previous':
+            values = column[before]
+        else:
+            nearer = np.where(clock - t[before] <= t[after] - clock, before, after)
+            values = column[nearer]
+        outside = (clock < t[0]) | (clock > t[-1])
+        if maxGap is not None:
+            outside |= (t[after] - t[before] > maxGap) & (clock != t[before])
+        values[outside] = np.nan
+        return values
+
+    def __len__(self):
+        return len(self.timestamps)
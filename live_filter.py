@@ -0,0 +1,53 @@
+import os
+import time
+
+from libs.KalmanFilter import KalmanFilter, PARAMS_FILE
+from libs.FilterMetrics import FilterMetrics
+from libs.SharedRing import RingReader, RING_NAMES
+
+# Host kalman filter on the live telemetry BT.py publishes, in its own process
+
+# Time between reads of the ring and between printed states (s)
+POLL_PERIOD: float = 0.05
+PRINT_PERIOD: float = 1.
+
+# Metrics csv written on exit
+METRICS_FOLDER: str = "BoatData/metrics"
+
+def main():
+    try:
+        reader = RingReader(RING_NAMES['telem'])
+    except FileNotFoundError:
+        print("No live telemetry, start BT.py first")
+        return
+    kf = KalmanFilter()
+    if os.path.exists(PARAMS_FILE):
+        kf.loadParams(PARAMS_FILE)
+    kf.metrics = FilterMetrics()
+    lastTime = None
+    printed = time.monotonic()
+    try:
+        while True:
+            records = reader.read()
+            names = records.dtype.names
+            for values in records.tolist():
+                telem = dict(zip(names, values))
+                # Host clock may jump back
+                kf.step(telem, None if lastTime is None else max(telem["timestamp"] - lastTime, 0.))
+                lastTime = telem["timestamp"]
+            if time.monotonic() - printed >= PRINT_PERIOD:
+                printed = time.monotonic()
+                x, y, _, _, heading, _ = kf.x.flatten()
+                print(f"x {x:.2f} m  y {y:.2f} m  heading {heading:.1f} deg"
+                      f"  ({len(reader)} behind, {reader.overrun} lost)")
+            time.sleep(POLL_PERIOD)
+    except KeyboardInterrupt:
+        print(kf.metrics.report())
+        if not os.path.exists(METRICS_FOLDER):
+            os.makedirs(METRICS_FOLDER)
+        kf.metrics.toCsv(os.path.join(METRICS_FOLDER, "metrics" + time.asctime().replace(':','.').replace(' ','_') + ".csv"))
+    finally:
+        reader.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import numpy as np
+
+import BT
+from libs.BatchAnalysis import loadTelemetry
+from libs.CommandQueue import CommandQueue
+from libs.FakeBoat import FakeBoat
+from libs.LiveState import LiveState
+from libs.TelemetryLog import readLog
+
+# Runs BT's device loop, recorder and display against a FakeBoat at each
+# rate, reporting what was lost and how late things were
+
+RATES: tuple[float, ...] = (10., 100., 1000., 5000.)
+SECONDS: float = 5.
+
+# Time between drive key presses, for the command latency (s)
+PRESS_PERIOD: float = 0.1
+
+def pressKeys(commands: CommandQueue, stop: threading.Event):
+    while not stop.wait(PRESS_PERIOD):
+        commands.put('f')
+
+def runLevel(rate: float, seconds: float, source) -> dict[str, float]:
+    "Run the pipeline for seconds against a FakeBoat at rate"
+    state = LiveState(connected=False, gps_avail=False, rc_avail=False, initialised=False,
+                      rc_mode=True, moving_waypoint=False, kalman=BT.KalmanState(),
+                      arduino=BT.ArduinoState())
+    commands = CommandQueue()
+    boats = []
+    def makeBoat(address: str) -> FakeBoat:
+        boats.append(FakeBoat(address, rate, source, statusPeriod=seconds))
+        return boats[-1]
+
+    with tempfile.TemporaryDirectory() as folder:
+        device = threading.Thread(target=asyncio.run, args=(BT.runDeviceLoop('fake', None, makeBoat, folder, liveState=state, commands=commands),),
+                                  name="Device", daemon=True)
+        device.start()
+        stop = threading.Event()
+        presser = threading.Thread(target=pressKeys, args=(commands, stop), daemon=True)
+        presser.start()
+        frames = BT.runDisplay(seconds, state, commands)
+        stop.set()
+        commands.put('x')
+        device.join()
+        recorded = sum(len(readLog(os.path.join(folder, f))) for f in os.listdir(folder)
+                       if f.startswith('telem') and f.endswith('.bin'))
+
+    boat = boats[0]
+    delays = boat.delays.toArray() * 1000.
+    latencies = commands.latencies.toArray() * 1000.
+    return {
+        'rate': rate,
+        'sent': boat.sent['telem'],
+        'drop': 100. * (1 - recorded / boat.sent['telem']) if boat.sent['telem'] else 0.,
+        'delay_p50': np.median(delays),
+        'delay_p99': np.percentile(delays, 99),
+        'callback_us': np.median(boat.callbackSeconds.toArray()) * 1e6,
+        'fps': frames / seconds,
+        'command_ms': np.median(latencies) if len(latencies) else np.nan,
+    }
+
+def main():
+    args = sys.argv[1:]
+    options = {}
+    while args and args[0].startswith('--'):
+        option, _, value = args.pop(0)[2:].partition('=')
+        options[option] = value
+    if set(options) - {'seconds', 'source'}:
+        print("Usage: python load_test.py [--seconds=5] [--source=telemetry] [rate ...]")
+        exit()
+    rates = [float(rate) for rate in args] if args else RATES
+    seconds = float(options.get('seconds', SECONDS))
+    source = loadTelemetry(options['source']) if 'source' in options else None
+
+    rows = [runLevel(rate, seconds, source) for rate in rates]
+    print(f"\n{'rate Hz':>8} {'sent':>8} {'drop %':>7} {'delay p50 ms':>13} {'p99 ms':>8}"
+          f" {'callback us':>12} {'fps':>6} {'command ms':>11}")
+    for row in rows:
+        print(f"{row['rate']:>8.0f} {row['sent']:>8} {row['drop']:>7.2f} {row['delay_p50']:>13.2f}"
+              f" {row['delay_p99']:>8.2f} {row['callback_us']:>12.2f} {row['fps']:>6.1f} {row['command_ms']:>11.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import sys
+
+from libs.Parity import findPairs, runParity
+from libs.KalmanFilter import KalmanFilter, PARAMS
+
+def main():
+    args = sys.argv[1:]
+    options = {}
+    while args and args[0].startswith('--'):
+        option, _, value = args.pop(0)[2:].partition('=')
+        options[option] = value
+    if len(args) < 2 or set(options) - {'params', 'workers'}:
+        print("Usage: python parity_check.py [--params=params.json] [--workers=N] summary.csv telem.json|folder [...]")
+        exit()
+
+    kf = KalmanFilter()
+    if 'params' in options:
+        kf.loadParams(options['params'])
+    params = {param: getattr(kf, param) for param in PARAMS}
+    workers = int(options['workers']) if 'workers' in options else None
+
+    pairs = findPairs(args[1:])
+    rows = runParity(pairs, params, args[0], workers)
+    flagged = sum(1 for row in rows if row['error'] or row['windows'])
+    print(f"{len(pairs)} sessions, {flagged} diverged or failed -> {args[0]}")
+
+if __name__ == "__main__":
+    main()